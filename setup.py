@@ -6,9 +6,14 @@ from setuptools import setup,  find_packages
 install_requires = [
     'cmdln',
     'python-ldap',
-    'SQLAlchemy == 0.5.5'
+    'SQLAlchemy >= 0.7, < 1.1'
     ]
 
+extras_require = {
+    # multi-worker serving mode in vyvyan_daemon.py
+    'prefork': ['gunicorn'],
+    }
+
 setup(name='vyvyan',
       author='david kovach',
       author_email='dave@devopsadvice.com',
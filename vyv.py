@@ -21,6 +21,7 @@ import textwrap
 import time
 import datetime
 import os
+import shlex
 from jinja2 import * 
 # urllib2 sucks when you need to use POST and you don't know beforehand
 # that you need to use POST. we use 'requests' instead so that we
@@ -40,19 +41,130 @@ class VyvyanCLIError(Exception):
     pass
 
 
+# one HTTP session for everything we send to the api server, so the
+# connection is kept alive across requests (see --batch)
+http = requests.Session()
+
+
 # swap a dict around
 def swap_dict(odict):
     return dict([(v, k) for (k, v) in odict.iteritems()])
 
 
-# if someone runs: vyv
-def get_commands(cfg, module_map):
+# metadata we've already loaded during this run, keyed by module. a
+# single vyv run never needs to look at the metadata more than once
+metadata_memo = {}
+# modules whose metadata has already been checked with the api server
+# during this run, there's no point in asking it again
+metadata_checked = set()
+
+
+def metadata_cache_file(cfg, module):
+    """
+    returns the path of the on-disk metadata cache for a module.
+    the api server and port are part of the name so pointing vyv
+    at a different server doesn't pick up the wrong metadata
+    """
+    return os.path.join(cfg.metadata_cache_dir, "%s_%s_%s.json" % (cfg.api_server, cfg.api_port, module))
+
+
+def read_metadata_cache(cfg, module):
+    """
+    loads the cached metadata for a module. returns None if there
+    isn't any, or if it can't be read
+    """
+    try:
+        cached = myjson.load(open(metadata_cache_file(cfg, module)))
+        if 'metadata' in cached and 'fetched' in cached:
+            return cached
+    except Exception, e:
+        pass
+    return None
+
+
+def write_metadata_cache(cfg, module, cached):
+    """
+    writes the metadata for a module out to the cache directory.
+    the file is written under a temporary name and renamed into
+    place, so a concurrent vyv never reads half a file. failing
+    to write the cache is not fatal, we just fetch again next time
+    """
     try:
-        response = requests.get('http://'+cfg.api_server+':'+cfg.api_port+'/'+'API_userdata/metadata', auth=(cfg.api_admin_user, cfg.api_admin_pass))
+        if not os.path.isdir(cfg.metadata_cache_dir):
+            os.makedirs(cfg.metadata_cache_dir, 0700)
+        cfile = metadata_cache_file(cfg, module)
+        tmpfile = "%s.%s" % (cfile, os.getpid())
+        f = open(tmpfile, 'w')
+        myjson.dump(cached, f)
+        f.close()
+        os.rename(tmpfile, cfile)
+    except Exception, e:
+        log.debug("Unable to write metadata cache for %s: %s" % (module, e))
+
+
+def get_metadata(cfg, module, force=False):
+    """
+    returns the metadata for a module.
+
+    the last copy we got from the api server is kept on disk along
+    with its ETag. within metadata_cache_ttl seconds of fetching it
+    we use it as-is. after that (or when force is set) we ask the
+    server with If-None-Match, which answers 304 if nothing changed.
+    either way there is at most one request per module per run
+    """
+    if module in metadata_memo and (not force or module in metadata_checked):
+        return metadata_memo[module]
+
+    cached = read_metadata_cache(cfg, module)
+    if cached and not force and time.time() - cached['fetched'] < cfg.metadata_cache_ttl:
+        log.debug("Using cached metadata for %s" % module)
+        metadata_memo[module] = cached['metadata']
+        return cached['metadata']
+
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    response = http.get('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/metadata', auth=(cfg.api_admin_user, cfg.api_admin_pass), headers=headers)
+    if response.status_code == 304 and cached:
+        log.debug("Cached metadata for %s is still current" % module)
+        mmeta = cached['metadata']
+    else:
         mmeta = myjson.loads(response.content)
-        buf = ""
         if mmeta['status'] != 0:
             raise VyvyanCLIError("Error output:\n%s" % mmeta['msg'])
+        cached = {'etag': response.headers.get('ETag'), 'metadata': mmeta}
+    cached['fetched'] = time.time()
+    write_metadata_cache(cfg, module, cached)
+    metadata_memo[module] = mmeta
+    metadata_checked.add(module)
+    return mmeta
+
+
+def resolve_call(cfg, module, call):
+    """
+    maps a command (or its short alias) to a call in the module's
+    metadata. if the command isn't there, the cached metadata may
+    predate it, so fetch it again from the server before giving up.
+    returns the metadata and the call name
+    """
+    for refresh in (False, True):
+        mmeta = get_metadata(cfg, module, force=refresh)
+        # map short aliases to calls
+        callmap = {}
+        for ccall in mmeta['data']['methods'].keys():
+            callmap[mmeta['data']['methods'][ccall]['short']] = ccall
+        if call in callmap.keys():
+            return mmeta, callmap[call]
+        if call in mmeta['data']['methods'].keys():
+            return mmeta, call
+    return mmeta, call
+
+
+# if someone runs: vyv
+def get_commands(cfg, module_map):
+    try:
+        mmeta = get_metadata(cfg, 'API_userdata')
+        buf = ""
         buf += "Available commands:\n\n"
         for k in sorted(mmeta['data']['methods'].keys()):
             buf += "%s (%s) - %s" % (mmeta['data']['methods'][k]['short'], k, mmeta['data']['methods'][k]['description'])
@@ -64,37 +176,26 @@ def get_commands(cfg, module_map):
 
 
 # if someone runs: vyv <command>
-def get_command_args(cfg, module_map):
+def get_command_args(cfg, module_map, command=None):
     try:
         # create a reverse module map...for reasons
         revmodule_map = swap_dict(module_map)
+        if not command:
+            command = sys.argv[1]
 
         # fetch our metadata, set some vars
-        response = requests.get('http://'+cfg.api_server+':'+cfg.api_port+'/'+'API_userdata/metadata', auth=(cfg.api_admin_user, cfg.api_admin_pass))
-	module = "API_userdata"
-        call = sys.argv[1]
-        mmeta = myjson.loads(response.content)
-
-        # map short aliases to calls
-        callmap = {}
-        for ccall in mmeta['data']['methods'].keys():
-            callmap[mmeta['data']['methods'][ccall]['short']] = ccall
-        if call in callmap.keys():
-            call = callmap[call]
+        module = "API_userdata"
+        (mmeta, call) = resolve_call(cfg, module, command)
 
         # init a buffer to hold things
         buf = ""
 
-        # couldn't get metadata back
-        if mmeta['status'] != 0:
-            raise VyvyanCLIError("Error:\n%s" % mmeta['msg'])
-
         # call does not appear in valid methods
         if not call in mmeta['data']['methods'].keys():
-            raise VyvyanCLIError("Invalid command issued: %s" % sys.argv[1])
+            raise VyvyanCLIError("Invalid command issued: %s" % command)
 
-        # no args defined, just run the thing
-        if not 'args' in mmeta['data']['methods'][call]['optional_args'] and not 'args' in mmeta['data']['methods'][call]['required_args']:
+        # no args needed, just run the thing
+        if not 'args' in mmeta['data']['methods'][call]['required_args'] and not mmeta['data']['methods'][call]['optional_args'].get('min'):
             call_command(cfg, module_map)
             # stop processing
             sys.exit(0)
@@ -127,11 +228,14 @@ def get_command_args(cfg, module_map):
 
 
 # if someone runs: vyv <command> --option1=bleh -o2 foo
-def call_command(cfg, module_map):
+# argv is the command line after "vyv", defaults to our own
+def call_command(cfg, module_map, argv=None):
     try:
+        if argv is None:
+            argv = sys.argv[1:]
         revmodule_map = swap_dict(module_map)
         module = "API_userdata"
-        call = sys.argv[1]
+        call = argv[0]
         buf = {} # our argument buffer for urlencoding
         if module in revmodule_map.keys():
             module = revmodule_map[module] 
@@ -142,17 +246,9 @@ def call_command(cfg, module_map):
         else:
             log.debug("Malformed module: %s" % module)
             raise VyvyanCLIError("Malformed module: %s" % module)
-        response = requests.get('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/metadata', auth=(cfg.api_admin_user, cfg.api_admin_pass))
-        mmeta = myjson.loads(response.content)
-        if mmeta['status'] != 0:
-            raise VyvyanCLIError("Error output:\n%s" % mmeta['msg'])
-
-        # map short aliases to calls
-        callmap = {}
-        for ccall in mmeta['data']['methods'].keys():
-            callmap[mmeta['data']['methods'][ccall]['short']] = ccall
-        if call in callmap.keys():
-            call = callmap[call]
+        (mmeta, call) = resolve_call(cfg, module, call)
+        if not call in mmeta['data']['methods'].keys():
+            raise VyvyanCLIError("Invalid command issued: %s" % argv[0])
 
         # set up our command line options through optparse. will
         # change this to argparse if we upgrade past python 2.7
@@ -194,7 +290,7 @@ def call_command(cfg, module_map):
         # parse our options and build a JSON data payload to pass
         # over to the API service
         # 
-        (options, args) = parser.parse_args(sys.argv[2:])
+        (options, args) = parser.parse_args(argv[1:])
         files = {}
         for k in arglist.keys():
             a = vars(options)[k]
@@ -211,20 +307,24 @@ def call_command(cfg, module_map):
 
             # if options[k] is empty and is a required option, explode
             elif not a and k in required_args: 
-                raise VyvyanCLIError(get_command_args(cfg, module_map))
+                raise VyvyanCLIError(get_command_args(cfg, module_map, argv[0]))
 
-        # make sure we send this as json, not str
-        headers = {"Content-Type":"application/json"}
+        # make sure we send this as json, not str. file uploads need
+        # requests to set its own multipart Content-Type
+        if files:
+            headers = {}
+        else:
+            headers = {"Content-Type":"application/json"}
 
         # make the call out to our API daemon, expect JSON back
         if mmeta['data']['methods'][call]['rest_type'] == 'GET':
-            callresponse = requests.get('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/'+call, data=buf, auth=(cfg.api_admin_user, cfg.api_admin_pass), headers=headers)
+            callresponse = http.get('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/'+call, data=buf, auth=(cfg.api_admin_user, cfg.api_admin_pass), headers=headers)
         elif mmeta['data']['methods'][call]['rest_type'] == 'POST':
-            callresponse = requests.post('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/'+call, data=buf, files=files, auth=(cfg.api_admin_user, cfg.api_admin_pass), headers=headers)
+            callresponse = http.post('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/'+call, data=buf, files=files, auth=(cfg.api_admin_user, cfg.api_admin_pass), headers=headers)
         elif mmeta['data']['methods'][call]['rest_type'] == 'DELETE':
-            callresponse = requests.delete('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/'+call, data=buf, auth=(cfg.api_admin_user, cfg.api_admin_pass), headers=headers)
+            callresponse = http.delete('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/'+call, data=buf, auth=(cfg.api_admin_user, cfg.api_admin_pass), headers=headers)
         elif mmeta['data']['methods'][call]['rest_type'] == 'PUT':
-            callresponse = requests.put('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/'+call, data=buf, files=files, auth=(cfg.api_admin_user, cfg.api_admin_pass), headers=headers)
+            callresponse = http.put('http://'+cfg.api_server+':'+cfg.api_port+'/'+module+'/'+call, data=buf, files=files, auth=(cfg.api_admin_user, cfg.api_admin_pass), headers=headers)
 
         # load the JSON response into the equivalent python variable type
         responsedata = myjson.loads(callresponse.content)
@@ -255,6 +355,95 @@ def call_command(cfg, module_map):
         raise VyvyanCLIError(e)
 
 
+# write a command line out to the audit log
+def write_audit_log(cfg, command_run):
+    try:
+        alog = open(cfg.logdir+'/'+cfg.audit_log_file, 'a')
+    except Exception, e:
+        print "Exception: " + str(e)
+        print "Problem writing to audit log file!"
+        print "Audit file configured as: " + cfg.audit_log_file
+        sys.exit(1)
+    try:
+        ltz = time.tzname[time.daylight]
+        tformat = "%Y-%m-%d %H:%M:%S"
+        timestamp = datetime.datetime.now()
+        if sys.stdin.isatty():
+            username = os.environ['LOGNAME']
+        else:
+            username = "nottyUID=" + str(os.geteuid())
+        buffer = "%s %s: %s: %s\n" % (ltz, timestamp.strftime(tformat), username, command_run)
+        alog.write(buffer)
+        alog.close()
+    except Exception, e:
+        print "Exception: " + str(e)
+        print "Problem writing to audit log file!"
+        print "Audit file configured as: " + cfg.audit_log_file
+        print "logline dump:"
+        print "%s %s: %s: %s" % (ltz, timestamp, username, command_run)
+        alog.close()
+
+
+# if someone runs: vyv --batch <file>
+def run_batch(cfg, module_map, bfile):
+    """
+    runs every command line in bfile ("-" for stdin) through
+    call_command, one after the other. lines look exactly like
+    what you would type after "vyv" (a leading "vyv" is allowed),
+    blank lines and #comments are skipped.
+
+    everything goes over the one keep-alive session and the
+    metadata is only loaded once. a failing line doesn't stop
+    the batch, we report the status of every line at the end
+    and return the number of lines that failed
+    """
+    if bfile == '-':
+        lines = sys.stdin.readlines()
+    else:
+        f = open(bfile)
+        lines = f.readlines()
+        f.close()
+
+    results = []
+    for lineno, line in enumerate(lines, 1):
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError, e:
+            results.append((lineno, line.strip(), "parse error: %s" % e))
+            continue
+        if argv and argv[0] in ('vyv', 'vyv.py'):
+            argv = argv[1:]
+        if not argv:
+            continue
+        write_audit_log(cfg, "%s --batch %s:%s: %s" % (sys.argv[0], bfile, lineno, ' '.join(argv)))
+        log.debug("batch line %s: %s" % (lineno, ' '.join(argv)))
+        try:
+            call_command(cfg, module_map, argv)
+            results.append((lineno, ' '.join(argv), None))
+        except VyvyanCLIError, e:
+            results.append((lineno, ' '.join(argv), "%s" % e))
+        except SystemExit, e:
+            # optparse (bad options, --help) and empty responses
+            # exit, which must not end the whole batch
+            if e.code:
+                results.append((lineno, ' '.join(argv), "exited with status %s" % e.code))
+            else:
+                results.append((lineno, ' '.join(argv), None))
+
+    failed = 0
+    print "\nBatch results:"
+    for lineno, command, error in results:
+        if error:
+            failed += 1
+            print "line %s: FAILED: %s" % (lineno, command)
+            for eline in error.strip().splitlines():
+                print "    %s" % eline
+        else:
+            print "line %s: ok: %s" % (lineno, command)
+    print "%s commands, %s ok, %s failed" % (len(results), len(results)-failed, failed)
+    return failed
+
+
 # prints out response data, according to a jinja2 template defined in
 # the module
 def print_responsedata(responsedata, mmeta, call):
@@ -308,40 +497,13 @@ if __name__ == "__main__":
             raise VyvyanCLIError("Please do not run vyv as root. Your effective uid: %s" % os.geteuid())
 
     # write out the command line we were called with to an audit log
-    try:
-        alog = open(cfg.logdir+'/'+cfg.audit_log_file, 'a')
-    except Exception, e:
-        print "Exception: " + str(e)
-        print "Problem writing to audit log file!"
-        print "Audit file configured as: " + cfg.audit_log_file
-        alog.close()
-        sys.exit(1)
-    try:
-        ltz = time.tzname[time.daylight]
-        tformat = "%Y-%m-%d %H:%M:%S"
-        timestamp = datetime.datetime.now()
-        if sys.stdin.isatty():
-            username = os.environ['LOGNAME']
-        else:
-            username = "nottyUID=" + str(os.geteuid())
-        command_run = ' '.join(sys.argv)
-        buffer = "%s %s: %s: %s\n" % (ltz, timestamp.strftime(tformat), username, command_run)
-        alog.write(buffer)
-        alog.close()
-    except Exception, e:
-        print "Exception: " + str(e)
-        print "Problem writing to audit log file!"
-        print "Audit file configured as: " + cfg.audit_log_file
-        print "logline dump:"
-        print "%s %s: %s: %s" % (ltz, timestamp, username, command_run)
-        alog.close()
+    write_audit_log(cfg, ' '.join(sys.argv))
 
     # doin stuff
     try:
         # if it didn't blow up, populate the module list
         module_map = {}
-        response = requests.get('http://'+cfg.api_server+":"+cfg.api_port+'/API_userdata/metadata', auth=(cfg.api_admin_user, cfg.api_admin_pass))
-        response_dict = myjson.loads(response.content)
+        response_dict = get_metadata(cfg, 'API_userdata')
         module_map['API_userdata'] = response_dict['data']['config']['shortname']
         # a reverse module map, useful in constructing our cmdln
         revmodule_map = swap_dict(module_map)
@@ -349,8 +511,20 @@ if __name__ == "__main__":
         # command line-y stuff. the order of the if statements is very
         # important. please be careful if you have to move things
         #
+        # user ran: vyv --batch <file>, or vyv --batch for stdin
+        if len(sys.argv) >= 2 and sys.argv[1] == '--batch':
+            if len(sys.argv) > 3:
+                raise VyvyanCLIError("usage: vyv --batch [<file>|-]")
+            if len(sys.argv) == 3:
+                bfile = sys.argv[2]
+            else:
+                bfile = '-'
+            log.debug("run_batch called()")
+            if run_batch(cfg, module_map, bfile):
+                sys.exit(1)
+
         # user ran: vyv
-        if len(sys.argv) < 2:
+        elif len(sys.argv) < 2:
             log.debug("get_commands called()")
             print get_commands(cfg, module_map)
 
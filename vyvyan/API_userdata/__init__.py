@@ -17,23 +17,43 @@
     Package for interacting with user and group data in vyvyan
 """
 
-from sqlalchemy import or_, desc, MetaData
+from sqlalchemy import or_, and_, desc, func, exists, MetaData
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.attributes import instance_state
+import sqlalchemy.exc
 import sys
+import csv
+import cPickle
 import passlib.hash 
 import vyvyan
 from vyvyan.vyvyan_models import *
 from vyvyan.common import *
 from vyvyan.validate import *
 
+# for >=2.6 use json, >2.6 use simplejson
+try:
+    import json as myjson
+except ImportError:
+    import simplejson as myjson
+
 class UserdataError(Exception):
     pass      
 
+# how many times to go looking for another free uid/gid when a
+# concurrent add claims the one we picked first
+ID_ALLOC_RETRIES = 10
+
+# rows fetched from the database per round trip when streaming a listing
+STREAM_CHUNK_SIZE = 1000
+
 class API_userdata:
 
     def __init__(self, cfg):
         self.cfg = cfg
         self.version = 1
         self.namespace = 'API_userdata'
+        # users and groups by (domain, name), see __get_user_obj
+        self.cache = VyvyanCache(cfg.cache_size, cfg.cache_ttl)
         self.metadata = {
             'config': {
                 'description': 'allows for the creation and manipulation of users and groups within vyvyan',
@@ -52,7 +72,7 @@ class API_userdata:
                     },
                     'optional_args': {
                         'min': 1,
-                        'max': 1,
+                        'max': 9,
                         'args': {
                             'all': {
                                 'vartype': 'bool',
@@ -64,6 +84,46 @@ class API_userdata:
                                 'desc': 'domain of the user',
                                 'ol': 'd',
                             },
+                            'stream': {
+                                'vartype': 'bool',
+                                'desc': 'stream the listing from the database instead of building it in memory, for very large directories',
+                                'ol': 's',
+                            },
+                            'limit': {
+                                'vartype': 'str',
+                                'desc': 'return at most this many users, the reply carries a "next" cursor for the following page',
+                                'ol': 'l',
+                            },
+                            'after': {
+                                'vartype': 'str',
+                                'desc': 'start after this "domain,username" (the "next" cursor of the previous page)',
+                                'ol': 'n',
+                            },
+                            'user_type': {
+                                'vartype': 'str',
+                                'desc': 'only users of this type',
+                                'ol': 't',
+                            },
+                            'active': {
+                                'vartype': 'str',
+                                'desc': 'only active (true) or inactive (false) users',
+                                'ol': 'A',
+                            },
+                            'shell': {
+                                'vartype': 'str',
+                                'desc': 'only users with this shell',
+                                'ol': 'S',
+                            },
+                            'uid_min': {
+                                'vartype': 'str',
+                                'desc': 'only users with a uid of at least this',
+                                'ol': 'u',
+                            },
+                            'uid_max': {
+                                'vartype': 'str',
+                                'desc': 'only users with a uid of at most this',
+                                'ol': 'U',
+                            },
                         },
                     },
                     'return': {
@@ -76,6 +136,15 @@ class API_userdata:
                             'username',
                         ],
                     },
+                    'return_paged': {
+                        'users': {
+                            'domain': [
+                                'username',
+                                'username',
+                            ],
+                        },
+                        'next': 'domain,username',
+                    },
                 },
                 'list_groups': {
                     'description': 'list groups',
@@ -86,7 +155,7 @@ class API_userdata:
                     },
                     'optional_args': {
                         'min': 1,
-                        'max': 1,
+                        'max': 7,
                         'args': {
                             'all': {
                                 'vartype': 'bool',
@@ -98,6 +167,31 @@ class API_userdata:
                                 'desc': 'domain of the user',
                                 'ol': 'd',
                             },
+                            'stream': {
+                                'vartype': 'bool',
+                                'desc': 'stream the listing from the database instead of building it in memory, for very large directories',
+                                'ol': 's',
+                            },
+                            'limit': {
+                                'vartype': 'str',
+                                'desc': 'return at most this many groups, the reply carries a "next" cursor for the following page',
+                                'ol': 'l',
+                            },
+                            'after': {
+                                'vartype': 'str',
+                                'desc': 'start after this "domain,groupname" (the "next" cursor of the previous page)',
+                                'ol': 'n',
+                            },
+                            'gid_min': {
+                                'vartype': 'str',
+                                'desc': 'only groups with a gid of at least this',
+                                'ol': 'g',
+                            },
+                            'gid_max': {
+                                'vartype': 'str',
+                                'desc': 'only groups with a gid of at most this',
+                                'ol': 'G',
+                            },
                         },
                     },
                     'return': {
@@ -110,20 +204,73 @@ class API_userdata:
                             'groupname',
                         ],
                     },
+                    'return_paged': {
+                        'groups': {
+                            'domain': [
+                                'groupname',
+                                'groupname',
+                            ],
+                        },
+                        'next': 'domain,groupname',
+                    },
                 },
                 'list_domains': {
-                    'description': 'list domains (does not take arguments)',
+                    'description': 'list domains',
                     'short': 'lsd',
                     'rest_type': 'GET',
                     'admin_only': False,
                     'required_args': {
                     },
                     'optional_args': {
+                        'min': 0,
+                        'max': 2,
+                        'args': {
+                            'limit': {
+                                'vartype': 'str',
+                                'desc': 'return at most this many domains, the reply carries a "next" cursor for the following page',
+                                'ol': 'l',
+                            },
+                            'after': {
+                                'vartype': 'str',
+                                'desc': 'start after this domain (the "next" cursor of the previous page)',
+                                'ol': 'n',
+                            },
+                        },
                     },
                     'return': [
                         'domain',
                         'domain',
                     ],
+                    'return_paged': {
+                        'domains': [
+                            'domain',
+                            'domain',
+                        ],
+                        'next': 'domain',
+                    },
+                },
+                'cache_stats': {
+                    'description': 'show how the user/group lookup cache of the worker answering is doing',
+                    'short': 'cs',
+                    'rest_type': 'GET',
+                    'admin_only': False,
+                    'required_args': {
+                    },
+                    'optional_args': {
+                        'min': 0,
+                        'max': 0,
+                    },
+                    'return': {
+                        'entries': 'number of users/groups cached',
+                        'size': 'most entries kept',
+                        'ttl': 'seconds an entry is trusted for',
+                        'hits': 'lookups answered from the cache',
+                        'misses': 'lookups that went to the database',
+                        'hit_rate': 'hits / (hits + misses)',
+                        'expired': 'entries found past their ttl',
+                        'evictions': 'entries pushed out to make room',
+                        'invalidations': 'entries dropped by writes',
+                    },
                 },
                 'udisplay': {
                     'description': 'display a user\'s info',
@@ -234,6 +381,50 @@ class API_userdata:
                         'string': 'success',
                     },
                 },
+                'ubulkadd': {
+                    'description': 'create many users at once from a JSON-lines or CSV file (one user per line, same fields as uadd, ssh keys go in "ssh_key")',
+                    'short': 'uba',
+                    'rest_type': 'POST',
+                    'admin_only': True,
+                    'required_args': {
+                        'args': {
+                            'users': {
+                                'vartype': 'file',
+                                'desc': 'a JSON-lines or CSV (with a header row) file of users to add',
+                                'ol': 'f',
+                            },
+                        },
+                    },
+                    'optional_args': {
+                        'min': 0,
+                        'max': 3,
+                        'args': {
+                            'domain': {
+                                'vartype': 'str',
+                                'desc': "domain for users that don't specify one (default: %s)" % cfg.default_domain,
+                                'ol': 'd',
+                            },
+                            'format': {
+                                'vartype': 'str',
+                                'desc': 'file format, "json" or "csv" (default: guess from the file)',
+                                'ol': 'm',
+                            },
+                            'abort_on_error': {
+                                'vartype': 'bool',
+                                'desc': 'add nothing if any user fails to validate',
+                                'ol': 'a',
+                            },
+                        },
+                    },
+                    'return': {
+                        'added': [
+                            {'username': 'username', 'domain': 'domain', 'uid': 'uid'},
+                        ],
+                        'errors': [
+                            {'line': 'line', 'username': 'username', 'error': 'error'},
+                        ],
+                    },
+                },
                 'uremove': {
                     'description': 'delete a user entry from the users table',
                     'short': 'urm',
@@ -639,7 +830,8 @@ class API_userdata:
             query: the query dict being passed to us from the called URI
 
         [return value]
-        returns a dict of lists of users per domain
+        returns a dict of lists of users per domain. with a limit, returns
+        {'users': <that dict>, 'next': <cursor>}, next is "" on the last page
         """
         try:
             self.cfg.log.debug(query.keys())
@@ -663,14 +855,19 @@ class API_userdata:
             # check for min/max number of optional arguments
             common.check_num_opt_args(query, self.namespace, 'list_users')
 
-            # iterate through all domains and spit out some users
+            # hand back a generator, the daemon writes it out as it goes
+            if 'stream' in query.keys() and query['stream']:
+                if 'limit' in query.keys() and query['limit']:
+                    self.cfg.log.debug("API_userdata/list_users: stream and limit can't be used together")
+                    raise UserdataError("API_userdata/list_users: stream and limit can't be used together")
+                return self.__stream_users(lambda: self.__user_listing(query, domain), domain)
+
+            # iterate through all domains and spit out some users.
+            # filtering and paging are done by the query
             buf = {} 
             self.cfg.log.debug("API_userdata/list_users: querying for all users")
-            if domain:
-                usertable = self.cfg.dbsess.query(Users).\
-                filter(Users.domain==domain).all()
-            else:
-                usertable = self.cfg.dbsess.query(Users).all()
+            usertable, nextpage = self.__listing_page(self.__user_listing(query, domain), query,
+                lambda u: "%s,%s" % (u.domain, u.username))
             for u in usertable:
                 if u.domain not in buf.keys():
                   buf[u.domain] = []
@@ -681,6 +878,10 @@ class API_userdata:
                     act = "inactive"
                 buf[u.domain].append("%s uid:%s %s" % (u.username, u.uid, act))
 
+            # a page past the end is empty, not an error
+            if nextpage is not None:
+                return {'users': buf, 'next': nextpage}
+
             # if the user specified a domain but it's empty
             if buf == {} and domain:
                 self.cfg.log.debug("API_userdata/list_users: no users in domain %s" % domain)
@@ -708,7 +909,8 @@ class API_userdata:
             query: the query dict being passed to us from the called URI
 
         [return value]
-        returns a dict of lists of groups per domain
+        returns a dict of lists of groups per domain. with a limit, returns
+        {'groups': <that dict>, 'next': <cursor>}, next is "" on the last page
         """
         try:
             self.cfg.log.debug(query.keys())
@@ -732,20 +934,29 @@ class API_userdata:
             # check for min/max number of optional arguments
             common.check_num_opt_args(query, self.namespace, 'list_groups')
 
-            # iterate through all domains and spit out some groups
+            # hand back a generator, the daemon writes it out as it goes
+            if 'stream' in query.keys() and query['stream']:
+                if 'limit' in query.keys() and query['limit']:
+                    self.cfg.log.debug("API_userdata/list_groups: stream and limit can't be used together")
+                    raise UserdataError("API_userdata/list_groups: stream and limit can't be used together")
+                return self.__stream_groups(lambda: self.__group_listing(query, domain), domain)
+
+            # iterate through all domains and spit out some groups.
+            # filtering and paging are done by the query
             buf = {} 
             self.cfg.log.debug("API_userdata/list_groups: querying for all groups")
-            if domain:
-                grouptable = self.cfg.dbsess.query(Groups).\
-                filter(Groups.domain==domain).all()
-            else:
-                grouptable = self.cfg.dbsess.query(Groups).all()
+            grouptable, nextpage = self.__listing_page(self.__group_listing(query, domain), query,
+                lambda g: "%s,%s" % (g.domain, g.groupname))
             for g in grouptable:
                 if g.domain not in buf.keys():
                   buf[g.domain] = []
             for g in grouptable:
                 buf[g.domain].append("%s gid:%s" % (g.groupname, g.gid))
 
+            # a page past the end is empty, not an error
+            if nextpage is not None:
+                return {'groups': buf, 'next': nextpage}
+
             # if the user specified a domain but it's empty
             if buf == {} and domain:
                 self.cfg.log.debug("API_userdata/list_groups: no groups in domain %s" % domain)
@@ -773,7 +984,8 @@ class API_userdata:
             query: the query dict being passed to us from the called URI
 
         [return value]
-        returns a list of domains
+        returns a list of domains. with a limit, returns
+        {'domains': <that list>, 'next': <cursor>}, next is "" on the last page
         """
         try:
             # setting our valid query keys
@@ -786,13 +998,6 @@ class API_userdata:
                     self.cfg.log.debug("API_userdata/list_domains: unknown querykey \"%s\"\ndumping valid_qkeys: %s" % (qk, valid_qkeys))
                     raise UserdataError("API_userdata/list_domains: unknown querykey \"%s\"\ndumping valid_qkeys: %s" % (qk, valid_qkeys))
 
-            # if the user specifies a domain, restrict output.
-            # otherwise return userdata for all domains
-            if 'domain' not in query.keys() or not query['domain']:
-                domain = None
-            else:
-                domain = query['domain']
-
             # check for min/max number of optional arguments
             common.check_num_opt_args(query, self.namespace, 'list_domains')
 
@@ -800,18 +1005,19 @@ class API_userdata:
             buf = []
             self.cfg.log.debug("API_userdata/list_domains: querying for all domains")
 
-            # iterate through all users and spit out some domains
-            usertable = self.cfg.dbsess.query(Users).all()
-            for u in usertable:
-                if u.domain not in buf:
-                  buf.append(u.domain)
+            # the write paths keep the domains table up to date, so
+            # there's no need to look through users and groups
+            q = select([Domains.domain]).order_by(Domains.domain)
+            if 'after' in query.keys() and query['after']:
+                v_domain(query['after'])
+                q = q.where(Domains.domain > query['after'])
+            domaintable, nextpage = self.__listing_page(q, query, lambda d: d.domain)
+            for d in domaintable:
+                buf.append(d.domain)
 
-            # iterate through all groups and spit out some domains
-            # just in case we have some oddball domain with groups and no users
-            grouptable = self.cfg.dbsess.query(Groups).all()
-            for g in grouptable:
-                if g.domain not in buf:
-                  buf.append(g.domain)
+            # a page past the end is empty, not an error
+            if nextpage is not None:
+                return {'domains': buf, 'next': nextpage}
 
             # if nothing exists
             if buf == []:
@@ -826,6 +1032,30 @@ class API_userdata:
             raise UserdataError("API_userdata/list_domains: query failed for groups. Error: %s" % e)
 
 
+    def cache_stats(self, query):
+        """
+        [description]
+        reports on the user/group lookup cache. every worker process
+        has its own, this is the one that answered
+
+        [parameter info]
+        required:
+            query: the query dict being passed to us from the called URI
+
+        [return value]
+        returns a dict of the cache's counters
+        """
+        try:
+            # no arguments to this one
+            if query.keys():
+                self.cfg.log.debug("API_userdata/cache_stats: unknown querykeys %s" % query.keys())
+                raise UserdataError("API_userdata/cache_stats: unknown querykeys %s" % query.keys())
+            return self.cache.stats()
+        except Exception, e:
+            self.cfg.log.debug("API_userdata/cache_stats: %s" % e)
+            raise UserdataError("API_userdata/cache_stats: %s" % e)
+
+
 
 
 
@@ -869,23 +1099,30 @@ class API_userdata:
             # check for min/max number of optional arguments
             common.check_num_opt_args(query, self.namespace, 'udisplay')
 
-            # find us a username to display, validation done in the __get_user_obj function
+            # find us a username to display. we only read, so the
+            # user and its groups are fetched as projections
             try:
-                u = self.__get_user_obj(query['username'], query['domain']) 
+                v_name(query['username'])
+                v_domain(query['domain'])
+                u = self.cfg.dbsess.execute(UserDetail.select().\
+                    where(Users.username==query['username']).\
+                    where(Domains.domain==query['domain'])).first()
             except:
                 self.cfg.log.debug("API_userdata/udisplay: user %s not found (domain: %s)" % (query['username'], query['domain']))
                 raise UserdataError("API_userdata/udisplay: user %s not found (domain: %s)" % (query['username'], query['domain']))
 
             # got a user, populate the return 
             if u:
+                u = UserDetail(u)
                 ret = {}
                 ret['user'] = u.to_dict()
                 ret['groups'] = []
                 # user exists, find out what groups it's in 
-                glist = self.__get_groups_by_user(u.username, u.domain)
-                if glist:
-                    for g in glist:
-                        ret['groups'].append(g.to_dict())
+                for g in self.cfg.dbsess.execute(GroupDetail.select().\
+                        where(Groups.id==UserGroupMapping.groups_id).\
+                        where(UserGroupMapping.users_id==u.id).\
+                        order_by(UserGroupMapping.id)):
+                    ret['groups'].append(GroupDetail(g).to_dict())
             else:
                 self.cfg.log.debug("API_userdata/udisplay: user %s not found." % query['username'])
                 raise UserdataError("API_userdata/udisplay: user %s not found" % query['username'])
@@ -1010,7 +1247,8 @@ class API_userdata:
                     self.cfg.log.debug("API_userdata/uadd: uid %s exists in domain %s already" % (uid, domain))
                     raise UserdataError("API_userdata/uadd: uid %s exists in domain %s already" % (uid, domain))
             else:
-                uid = self.__next_available_uid(domain)
+                # picked when the user is inserted, see below
+                uid = None
 
             # deal with default groups
             dg = []
@@ -1034,16 +1272,20 @@ class API_userdata:
             passhash = passlib.hash.ldap_salted_sha1.encrypt(password, salt_size=self.cfg.salt_size)
 
             # create the user object, push it to the db, return status
-            u = Users(first_name, last_name, ssh_public_key, passhash, username, domain, uid, user_type, home_dir, shell, email_address, active=True)
-            self.cfg.dbsess.add(u)
-            self.cfg.dbsess.commit()
+            d = self.__register_domain(domain)
+            u = Users(first_name, last_name, ssh_public_key, passhash, username, d, uid, user_type, home_dir, shell, email_address, active=True)
+            if uid:
+                self.cfg.dbsess.add(u)
+                self.cfg.dbsess.flush()
+            else:
+                self.__add_with_free_id(u, 'uid', self.__next_available_uid)
 
-            # if our default group(s) exist, shove the user into it/them
-            if dg:
-                for g in dg:
-                    ugquery = {'username': username, 'groupname': g.groupname, 'domain': domain}
-                    self.utog(ugquery)
-                    self.cfg.log.debug("API_userdata/uadd: adding user %s to default group %s in domain %s" % (username, g.groupname, domain))
+            # shove the user into the default group(s). a brand new user
+            # has no mappings to trip over, and it all commits together
+            for g in dg:
+                self.__map_user(u, g)
+                self.cfg.log.debug("API_userdata/uadd: adding user %s to default group %s in domain %s" % (username, g.groupname, domain))
+            self.cfg.dbsess.commit()
             return 'success'
         except Exception, e:
             # something odd happened, explode violently
@@ -1052,6 +1294,195 @@ class API_userdata:
             raise UserdataError("API_userdata/uadd: error: %s" % e)
 
 
+    def ubulkadd(self, query, files=None):
+        """
+        [description]
+        create many new Users entries from an uploaded file
+
+        every user is validated the way uadd does it. uids for the whole
+        file are allocated in one pass over the domain, then the users
+        and their default group mappings are inserted with one bulk
+        insert each and committed together. rows that fail are reported
+        and skipped, unless abort_on_error is set
+
+        [parameter info]
+        required:
+            query: the query dict being passed to us from the called URI
+            files: a single JSON-lines or CSV file of users
+
+        [return]
+        Returns a dict of the users added and the rows that failed,
+        raises an error if nothing could be done
+        """
+        # setting our valid query keys
+        common = VyvyanCommon(self.cfg)
+        valid_qkeys = common.get_valid_qkeys(self.namespace, 'ubulkadd')
+
+        try:
+            # check for wierd query keys, explode
+            for qk in query.keys():
+                if qk not in valid_qkeys:
+                    self.cfg.log.debug("API_userdata/ubulkadd: unknown querykey \"%s\"\ndumping valid_qkeys: %s" % (qk, valid_qkeys))
+                    raise UserdataError("API_userdata/ubulkadd: unknown querykey \"%s\"\ndumping valid_qkeys: %s" % (qk, valid_qkeys))
+            if not files or len(files) != 1:
+                self.cfg.log.debug("API_userdata/ubulkadd: please upload exactly one file of users")
+                raise UserdataError("API_userdata/ubulkadd: please upload exactly one file of users")
+            # domain, validate or default
+            if 'domain' in query.keys() and query['domain']:
+                default_domain = query['domain']
+                v_domain(default_domain)
+            else:
+                default_domain = self.cfg.default_domain
+            # file format, validate or guess
+            if 'format' in query.keys() and query['format']:
+                fmt = query['format'].lower()
+                if fmt not in ('json', 'csv'):
+                    self.cfg.log.debug("API_userdata/ubulkadd: unknown format: %s" % fmt)
+                    raise UserdataError("API_userdata/ubulkadd: unknown format: %s" % fmt)
+            else:
+                fmt = None
+            abort_on_error = 'abort_on_error' in query.keys() and query['abort_on_error']
+
+            # read and validate every row
+            rows, errors = self.__read_bulk_users(files[0], fmt)
+            users = []
+            for lineno, row in rows:
+                try:
+                    users.append((lineno, self.__bulk_user_row(row, default_domain)))
+                except Exception, e:
+                    errors.append({'line': lineno, 'username': row.get('username'), 'error': "%s" % e})
+
+            # sort the rows out by domain, everything else is done
+            # a domain at a time
+            bydomain = {}
+            for lineno, u in users:
+                bydomain.setdefault(u['domain'], []).append((lineno, u))
+
+            newusers = []
+            newgroups = {}
+            # file line of each user, and the users whose uid we picked
+            # rather than the file, by id()
+            lines = {}
+            allocated = set()
+            for domain in sorted(bydomain.keys()):
+                # find out which of our usernames and uids are taken,
+                # a chunk of the batch per query
+                names = list(set([u['username'] for lineno, u in bydomain[domain]]))
+                usernames = set()
+                for i in range(0, len(names), IN_CHUNK_SIZE):
+                    usernames.update([row.username for row in self.cfg.dbsess.query(Users.username).\
+                    filter(Users.domain_id==Domains.id_of(domain)).\
+                    filter(Users.username.in_(names[i:i+IN_CHUNK_SIZE]))])
+                taken = v_uids_in_db(self.cfg, [u['uid'] for lineno, u in bydomain[domain] if u['uid']], domain)
+
+                # the default groups have to exist, same as uadd
+                dg = []
+                if self.cfg.default_groups:
+                    dg = self.cfg.dbsess.query(Groups).\
+                    filter(Groups.domain_id==Domains.id_of(domain)).\
+                    filter(Groups.groupname.in_(self.cfg.default_groups)).all()
+                    missing = set(self.cfg.default_groups) - set([g.groupname for g in dg])
+                    if missing:
+                        for lineno, u in bydomain[domain]:
+                            errors.append({'line': lineno, 'username': u['username'], 'error': "default groups must exist before we can add users to them! missing group(s): %s in %s" % (', '.join(sorted(missing)), domain)})
+                        continue
+                newgroups[domain] = [g.id for g in dg]
+
+                # weed out duplicates and claim any uids asked for
+                pending = []
+                for lineno, u in bydomain[domain]:
+                    if u['username'] in usernames:
+                        errors.append({'line': lineno, 'username': u['username'], 'error': "user %s exists in domain %s" % (u['username'], domain)})
+                    elif u['uid'] and u['uid'] in taken:
+                        errors.append({'line': lineno, 'username': u['username'], 'error': "uid %s exists in domain %s already" % (u['uid'], domain)})
+                    else:
+                        usernames.add(u['username'])
+                        if u['uid']:
+                            taken.add(u['uid'])
+                        pending.append((lineno, u))
+
+                # hand out the free uids in order to everyone who needs one,
+                # skipping the ones claimed by rows in this file
+                free = self.__free_uids(domain)
+                for lineno, u in pending:
+                    if not u['uid']:
+                        uid = next((i for i in free if i not in taken), None)
+                        if uid is None:
+                            errors.append({'line': lineno, 'username': u['username'], 'error': "No available UIDs!"})
+                            continue
+                        u['uid'] = uid
+                        taken.add(uid)
+                        allocated.add(id(u))
+                    lines[id(u)] = lineno
+                    newusers.append(u)
+
+            errors.sort(key=lambda e: e['line'])
+            if errors and abort_on_error:
+                self.cfg.log.debug("API_userdata/ubulkadd: %s rows failed, nothing was added" % len(errors))
+                raise UserdataError("API_userdata/ubulkadd: %s rows failed, nothing was added:\n%s" % (len(errors), "\n".join(["line %s: %s" % (e['line'], e['error']) for e in errors])))
+
+            if newusers:
+                # hash the passwords. since we're LDAP-oriented we'll use SSHA
+                for u in newusers:
+                    u['password'] = passlib.hash.ldap_salted_sha1.encrypt(u['password'], salt_size=self.cfg.salt_size)
+
+                # push all the users to the db in one go. the rows carry
+                # the domain by name, the table wants its id
+                domain_ids = {}
+                for domain in set([u['domain'] for u in newusers]):
+                    domain_ids[domain] = self.__register_domain(domain).id
+                rows = []
+                for u in newusers:
+                    row = dict([(k, v) for k, v in u.items() if k != 'domain'])
+                    row['domain_id'] = domain_ids[u['domain']]
+                    rows.append(row)
+                # usernames and uids were checked above, but a uadd running
+                # alongside us can still claim one of them before we get
+                # here. try the lot in one insert, if that collides go a row
+                # at a time and sort out just the rows that lost
+                savepoint = self.cfg.dbsess.begin_nested()
+                try:
+                    self.cfg.dbsess.execute(Users.__table__.insert(), rows)
+                    savepoint.commit()
+                except sqlalchemy.exc.IntegrityError, e:
+                    savepoint.rollback()
+                    self.cfg.log.debug("API_userdata/ubulkadd: bulk insert collided, inserting a row at a time. error: %s" % e)
+                    failed = len(errors)
+                    newusers = self.__bulk_insert_rows(newusers, rows, lines, allocated, errors)
+                    errors.sort(key=lambda e: e['line'])
+                    if len(errors) > failed and abort_on_error:
+                        self.cfg.log.debug("API_userdata/ubulkadd: %s rows failed, nothing was added" % len(errors))
+                        raise UserdataError("API_userdata/ubulkadd: %s rows failed, nothing was added:\n%s" % (len(errors), "\n".join(["line %s: %s" % (e['line'], e['error']) for e in errors])))
+
+                # look up the ids we just got and map everyone into
+                # their default groups, again in one go
+                ugmaps = []
+                for domain in newgroups.keys():
+                    if not newgroups[domain]:
+                        continue
+                    names = [u['username'] for u in newusers if u['domain'] == domain]
+                    for i in range(0, len(names), IN_CHUNK_SIZE):
+                        for row in self.cfg.dbsess.query(Users.id).\
+                        filter(Users.domain_id==domain_ids[domain]).\
+                        filter(Users.username.in_(names[i:i+IN_CHUNK_SIZE])):
+                            for gid in newgroups[domain]:
+                                ugmaps.append({'groups_id': gid, 'users_id': row.id})
+                if ugmaps:
+                    self.cfg.dbsess.execute(UserGroupMapping.__table__.insert(), ugmaps)
+                self.cfg.dbsess.commit()
+
+            self.cfg.log.debug("API_userdata/ubulkadd: added %s users, %s rows failed" % (len(newusers), len(errors)))
+            return {
+                'added': [{'username': u['username'], 'domain': u['domain'], 'uid': u['uid']} for u in newusers],
+                'errors': errors,
+            }
+        except Exception, e:
+            # something odd happened, explode violently
+            self.cfg.dbsess.rollback()
+            self.cfg.log.debug("API_userdata/ubulkadd: error: %s" % e)
+            raise UserdataError("API_userdata/ubulkadd: error: %s" % e)
+
+
     def uremove(self, query):
         """
         [description]
@@ -1096,13 +1527,13 @@ class API_userdata:
             # find us a username to delete, validation done in the __get_user_obj function
             u = self.__get_user_obj(username, domain) 
             if u:
-                groups = self.__get_groups_by_user(username, domain)
-                if groups:
-                    for group in groups:
-                        query = {"username": username, "groupname": group.groupname, "domain": domain} 
-                        self.urmg(query) 
+                # drop all of the user's group mappings in one go
+                self.cfg.dbsess.query(UserGroupMapping).\
+                filter(UserGroupMapping.users_id==u.id).delete(synchronize_session=False)
                 self.cfg.dbsess.delete(u)
+                self.__release_domain(domain)
                 self.cfg.dbsess.commit()
+                self.__uncache('user', username, domain)
                 self.cfg.log.debug("API_userdata/uremove: deleted user %s from domain %s" % (username, domain))
                 return "success"
             else:
@@ -1221,6 +1652,7 @@ class API_userdata:
             # push the modified user object to the db, return status
             self.cfg.dbsess.add(u)
             self.cfg.dbsess.commit()
+            self.__uncache('user', username, domain)
             return 'success'
         except Exception, e:
             # something odd happened, explode violently
@@ -1338,9 +1770,16 @@ class API_userdata:
             # check for min/max number of optional arguments
             common.check_num_opt_args(query, self.namespace, 'gdisplay')
 
-            # look for the group
+            # look for the group. we only read, so the group, its members
+            # and its sudo commands are fetched as projections
             try:
-                g = self.__get_group_obj(groupname, domain) 
+                v_name(groupname)
+                g = self.cfg.dbsess.execute(GroupDetail.select().\
+                    where(Groups.groupname==groupname).\
+                    where(Domains.domain==domain)).first()
+                if not g:
+                    raise UserdataError("group not found")
+                g = GroupDetail(g)
                 ret = {} 
                 ret['group'] = g.to_dict()
             except Exception, e:
@@ -1349,17 +1788,17 @@ class API_userdata:
 
             # now that we know the group exists, we can see if it's populated with users
             ret['users'] = []
-            ulist = self.__get_users_by_group(groupname, domain)
-            if ulist:
-                for u in ulist:
-                    ret['users'].append(u.to_dict())
+            for u in self.cfg.dbsess.execute(UserSummary.select().\
+                    where(Users.id==UserGroupMapping.users_id).\
+                    where(UserGroupMapping.groups_id==g.id).\
+                    order_by(UserGroupMapping.id)):
+                ret['users'].append(UserSummary(u).to_dict())
 
             # now that we know the group exists, we can see if it's populated with users
-            sclist = self.__get_sudo_cmds_by_group(groupname, domain)
-            if sclist:
-                commands = []
-                for sc in sclist: 
-                    commands.append(sc.sudocommand)
+            commands = [sc.sudocommand for sc in self.cfg.dbsess.execute(select([GroupSudocommandMapping.sudocommand]).\
+                where(GroupSudocommandMapping.groups_id==g.id).\
+                order_by(GroupSudocommandMapping.id))]
+            if commands:
                 ret['sudo_cmds'] = ','.join(commands)
             else:
                 ret['sudo_cmds'] = "no commands"
@@ -1445,16 +1884,22 @@ class API_userdata:
                     self.cfg.log.debug("API_userdata/gadd: gid exists already: %s" % gid)
                     raise UserdataError("API_userdata/gadd: gid exists already: %s" % gid)
             else:
-                gid = self.__next_available_gid(domain)
+                # picked when the group is inserted, see below
+                gid = None
 
             # create the group object, push it to the db, return status
-            g = Groups(description, groupname, domain, gid)
-            self.cfg.dbsess.add(g)
-            self.cfg.dbsess.commit()
+            d = self.__register_domain(domain)
+            g = Groups(description, groupname, d, gid)
+            if gid:
+                self.cfg.dbsess.add(g)
+                self.cfg.dbsess.flush()
+            else:
+                self.__add_with_free_id(g, 'gid', self.__next_available_gid)
 
-            # map any sudo commands to the group
+            # map any sudo commands to the group, in the same transaction
             if sudo_cmds:
               self.__map_sudoers(g, sudo_cmds)
+            self.cfg.dbsess.commit()
 
             return 'success'
 
@@ -1509,15 +1954,17 @@ class API_userdata:
             g = self.__get_group_obj(groupname, domain) 
             if g:
                 # make sure the group is empty
-                if self.__get_users_by_group(groupname, domain):
+                if self.cfg.dbsess.query(exists().where(UserGroupMapping.groups_id==g.id)).scalar():
                     self.cfg.log.debug("API_userdata/gremove: please remove all users from this group before deleting!")
                     raise UserdataError("API_userdata/gremove: please remove all users from this group before deleting!")
                 # unmap any existing commands
                 self.__unmap_sudoers(g)
                 # delete the group
                 self.cfg.dbsess.delete(g)
+                self.__release_domain(domain)
                 # commit the transaction
                 self.cfg.dbsess.commit()
+                self.__uncache('group', groupname, domain)
                 self.cfg.log.debug("API_userdata/gremove: deleted group %s from domain %s" % (groupname, domain))
                 # declare victory
                 return "success"
@@ -1587,6 +2034,8 @@ class API_userdata:
                 sudo_cmds = query['sudo_cmds'].split(',')
                 if 'ALL' in map(str.upper, sudo_cmds):
                     sudo_cmds = ['ALL']
+            else:
+                sudo_cmds = None
 
             # gid, validate or leave alone 
             if 'gid' in query.keys() and query['gid']:
@@ -1595,16 +2044,17 @@ class API_userdata:
                     raise UserdataError("API_userdata/gmodify: gid exists in domain %s already: %s" % (domain, query['gid']))
                 g.gid = int(query['gid'])
 
-            # push the modified group object to the db, return status
-            self.cfg.dbsess.add(g)
-            self.cfg.dbsess.commit()
-
             # remap sudoers commands
             # NOTE: you must provide the entire sudo_cmds array each time you modify a group
             # or it will delete existing commands
             if sudo_cmds:
               self.__map_sudoers(g, sudo_cmds)
 
+            # push the modified group and its commands to the db in one go
+            self.cfg.dbsess.add(g)
+            self.cfg.dbsess.commit()
+            self.__uncache('group', groupname, domain)
+
             # declare victory
             return 'success'
 
@@ -1748,8 +2198,7 @@ class API_userdata:
                 filter(UserGroupMapping.groups_id==g.id).first():
                     self.cfg.log.debug("API_userdata/utog: mapping exists! refusing to create duplicate mapping")
                     raise UserdataError("API_userdata/utog: mapping exists! refusing to create duplicate mapping")
-                ugmap = UserGroupMapping(g.id, u.id)
-                self.cfg.dbsess.add(ugmap)
+                self.__map_user(u, g)
                 self.cfg.dbsess.commit()
                 return 'success'
 
@@ -1836,6 +2285,307 @@ class API_userdata:
     # internal functions below here #
     #################################
 
+    def __user_listing(self, query, domain=None):
+        """
+        [description]
+        builds the list_users query from its filter and paging arguments.
+        only the columns the listing prints are selected (see UserSummary),
+        ordered by (domain, username) so a page can pick up where the last one stopped
+
+        [parameter info]
+        required:
+            query: the query dict being passed to us from the called URI
+        optional:
+            domain: restrict the listing to this domain
+
+        [return value]
+        returns a sqlalchemy select, without a limit
+        """
+        q = UserSummary.select()
+        if domain:
+            q = q.where(Domains.domain==domain)
+        if 'user_type' in query.keys() and query['user_type']:
+            q = q.where(Users.type==query['user_type'])
+        if 'shell' in query.keys() and query['shell']:
+            q = q.where(Users.shell==query['shell'])
+        if 'active' in query.keys() and query['active']:
+            if query['active'].lower() in ('true', 'yes', '1', 'active'):
+                q = q.where(Users.active==True)
+            elif query['active'].lower() in ('false', 'no', '0', 'inactive'):
+                q = q.where(Users.active==False)
+            else:
+                self.cfg.log.debug("API_userdata/list_users: active must be true or false, not %s" % query['active'])
+                raise UserdataError("API_userdata/list_users: active must be true or false, not %s" % query['active'])
+        if 'uid_min' in query.keys() and query['uid_min']:
+            q = q.where(Users.uid >= self.__int_arg(query['uid_min'], 'uid_min'))
+        if 'uid_max' in query.keys() and query['uid_max']:
+            q = q.where(Users.uid <= self.__int_arg(query['uid_max'], 'uid_max'))
+        if 'after' in query.keys() and query['after']:
+            after_domain, after_name = self.__parse_after(query['after'], domain)
+            q = q.where(or_(Domains.domain > after_domain,
+                and_(Domains.domain==after_domain, Users.username > after_name)))
+        return q.order_by(Domains.domain, Users.username)
+
+
+    def __group_listing(self, query, domain=None):
+        """
+        [description]
+        builds the list_groups query from its filter and paging arguments.
+        only the columns the listing prints are selected (see GroupSummary),
+        ordered by (domain, groupname) so a page can pick up where the last one stopped
+
+        [parameter info]
+        required:
+            query: the query dict being passed to us from the called URI
+        optional:
+            domain: restrict the listing to this domain
+
+        [return value]
+        returns a sqlalchemy select, without a limit
+        """
+        q = GroupSummary.select()
+        if domain:
+            q = q.where(Domains.domain==domain)
+        if 'gid_min' in query.keys() and query['gid_min']:
+            q = q.where(Groups.gid >= self.__int_arg(query['gid_min'], 'gid_min'))
+        if 'gid_max' in query.keys() and query['gid_max']:
+            q = q.where(Groups.gid <= self.__int_arg(query['gid_max'], 'gid_max'))
+        if 'after' in query.keys() and query['after']:
+            after_domain, after_name = self.__parse_after(query['after'], domain)
+            q = q.where(or_(Domains.domain > after_domain,
+                and_(Domains.domain==after_domain, Groups.groupname > after_name)))
+        return q.order_by(Domains.domain, Groups.groupname)
+
+
+    def __listing_page(self, q, query, cursor):
+        """
+        [description]
+        runs a listing query, or one page of it if a limit was asked for.
+        one row past the limit is fetched to tell whether there's a next page
+
+        [parameter info]
+        required:
+            q: the listing select, ordered the way the cursor expects
+            query: the query dict being passed to us from the called URI
+            cursor: function that makes the "after" value for a row
+
+        [return value]
+        returns (rows, next). next is the cursor for the following page,
+        "" on the last page and None when the caller didn't ask for a limit
+        """
+        if 'limit' not in query.keys() or not query['limit']:
+            return self.cfg.dbsess.execute(q).fetchall(), None
+        limit = self.__int_arg(query['limit'], 'limit')
+        if limit < 1:
+            self.cfg.log.debug("API_userdata/__listing_page: limit must be at least 1")
+            raise UserdataError("API_userdata/__listing_page: limit must be at least 1")
+        rows = self.cfg.dbsess.execute(q.limit(limit + 1)).fetchall()
+        if len(rows) > limit:
+            return rows[:limit], cursor(rows[limit - 1])
+        return rows, ""
+
+
+    def __parse_after(self, after, domain=None):
+        """
+        [description]
+        splits a "domain,name" paging cursor. if the listing is restricted
+        to one domain, a bare name will do
+
+        [parameter info]
+        required:
+            after: the cursor
+        optional:
+            domain: the domain the listing is restricted to
+
+        [return value]
+        returns a (domain, name) tuple
+        """
+        if ',' in after:
+            after_domain, after_name = after.split(',', 1)
+        elif domain:
+            after_domain, after_name = domain, after
+        else:
+            self.cfg.log.debug("API_userdata/__parse_after: after must look like \"domain,name\": %s" % after)
+            raise UserdataError("API_userdata/__parse_after: after must look like \"domain,name\": %s" % after)
+        v_domain(after_domain)
+        return after_domain, after_name
+
+
+    def __int_arg(self, value, name):
+        """
+        [description]
+        arguments arrive as strings, turns one into an integer
+
+        [parameter info]
+        required:
+            value: the argument
+            name: the argument's name, for the error
+
+        [return value]
+        returns an int, raises an error if it isn't one
+        """
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            self.cfg.log.debug("API_userdata: %s must be an integer, not %s" % (name, value))
+            raise UserdataError("API_userdata: %s must be an integer, not %s" % (name, value))
+
+
+    def __stream_users(self, listing, domain=None):
+        """
+        [description]
+        list_users for very large directories. only the columns the
+        listing needs are read, STREAM_CHUNK_SIZE rows at a time
+
+        [parameter info]
+        required:
+            listing: builds the listing query (see __user_listing)
+        optional:
+            domain: the domain the listing is restricted to, for errors
+
+        [return value]
+        returns a generator of JSON fragments for the same dict of lists
+        list_users returns. raises an error up front if there's nothing to list
+        """
+        # once the stream starts it's too late to report an error
+        if self.cfg.dbsess.execute(listing().limit(1)).first() is None:
+            if domain:
+                self.cfg.log.debug("API_userdata/list_users: no users in domain %s" % domain)
+                raise UserdataError("API_userdata/list_users: no users in domain %s" % domain)
+            self.cfg.log.debug("API_userdata/list_users: no users found")
+            raise UserdataError("API_userdata/list_users: no users found")
+
+        # nothing in here runs until the response is being written, by
+        # which time the request's session is gone. cfg.dbsess hands us a
+        # fresh one, which the daemon removes when the stream ends.
+        # the listing is ordered by domain so each domain's users arrive together
+        def rows():
+            result = self.cfg.dbsess.execute(listing().execution_options(stream_results=True))
+            try:
+                while True:
+                    chunk = result.fetchmany(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    for u in chunk:
+                        if u.active:
+                            act = "active"
+                        else:
+                            act = "inactive"
+                        yield (u.domain, "%s uid:%s %s" % (u.username, u.uid, act))
+            finally:
+                result.close()
+
+        common = VyvyanCommon(self.cfg)
+        return common.stream_listing(rows(), STREAM_CHUNK_SIZE)
+
+
+    def __stream_groups(self, listing, domain=None):
+        """
+        [description]
+        list_groups for very large directories. only the columns the
+        listing needs are read, STREAM_CHUNK_SIZE rows at a time
+
+        [parameter info]
+        required:
+            listing: builds the listing query (see __group_listing)
+        optional:
+            domain: the domain the listing is restricted to, for errors
+
+        [return value]
+        returns a generator of JSON fragments for the same dict of lists
+        list_groups returns. raises an error up front if there's nothing to list
+        """
+        # once the stream starts it's too late to report an error
+        if self.cfg.dbsess.execute(listing().limit(1)).first() is None:
+            if domain:
+                self.cfg.log.debug("API_userdata/list_groups: no groups in domain %s" % domain)
+                raise UserdataError("API_userdata/list_groups: no groups in domain %s" % domain)
+            self.cfg.log.debug("API_userdata/list_groups: no groups found")
+            raise UserdataError("API_userdata/list_groups: no groups found")
+
+        # see __stream_users, this runs as the response is written
+        def rows():
+            result = self.cfg.dbsess.execute(listing().execution_options(stream_results=True))
+            try:
+                while True:
+                    chunk = result.fetchmany(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    for g in chunk:
+                        yield (g.domain, "%s gid:%s" % (g.groupname, g.gid))
+            finally:
+                result.close()
+
+        common = VyvyanCommon(self.cfg)
+        return common.stream_listing(rows(), STREAM_CHUNK_SIZE)
+
+
+    def __register_domain(self, domain):
+        """
+        [description]
+        makes sure a domain is in the domains table. every write path that
+        can put the first user or group into a domain calls this, users and
+        groups are created against the row it returns
+
+        [parameter info]
+        required:
+            domain: the domain
+
+        [return value]
+        returns the Domains ORM object
+        """
+        # both reads are share-locked. a locking read sees rows committed
+        # after our snapshot (a plain one won't under mysql's repeatable
+        # read), and the lock keeps a concurrent __release_domain from
+        # deleting the row out from under us until we commit
+        d = self.cfg.dbsess.query(Domains).filter(Domains.domain==domain).with_lockmode('read').first()
+        if d:
+            return d
+        savepoint = self.cfg.dbsess.begin_nested()
+        try:
+            self.cfg.dbsess.execute(Domains.__table__.insert(), {'domain': domain})
+            savepoint.commit()
+        except sqlalchemy.exc.IntegrityError, e:
+            # a concurrent add registered it first, which is just as good
+            savepoint.rollback()
+            self.cfg.log.debug("API_userdata/__register_domain: %s was registered concurrently: %s" % (domain, e))
+        return self.cfg.dbsess.query(Domains).filter(Domains.domain==domain).with_lockmode('read').one()
+
+
+    def __release_domain(self, domain):
+        """
+        [description]
+        drops a domain from the domains table once its last user and
+        group are gone. called after a remove, before the commit
+
+        [parameter info]
+        required:
+            domain: the domain
+
+        [return value]
+        no explicit return
+        """
+        # push the pending delete out first so the checks below see it
+        self.cfg.dbsess.flush()
+        # the id is looked up on its own, mysql won't have a DELETE
+        # select from the table it's deleting from
+        domain_id = self.cfg.dbsess.execute(select([Domains.id]).where(Domains.domain==domain)).scalar()
+        if domain_id is None:
+            return
+        savepoint = self.cfg.dbsess.begin_nested()
+        try:
+            self.cfg.dbsess.execute(Domains.__table__.delete().\
+                where(Domains.id==domain_id).\
+                where(~exists().where(Users.domain_id==domain_id)).\
+                where(~exists().where(Groups.domain_id==domain_id)))
+            savepoint.commit()
+        except sqlalchemy.exc.IntegrityError, e:
+            # a concurrent add put something back into the domain since
+            # our checks ran, it stays registered
+            savepoint.rollback()
+            self.cfg.log.debug("API_userdata/__release_domain: %s is in use again, keeping it: %s" % (domain, e))
+
+
     def __get_group_obj(self, groupname, domain):
         """
         [description]
@@ -1844,11 +2594,17 @@ class API_userdata:
         [parameter info]
         required:
             groupname: the groupname we want to parse
+            domain: the domain that contains our group
     
         [return value]
         returns a Groups ORM object or None
         """
         try:
+            # anything in the cache was validated on its way in
+            g = self.__cached_obj('group', groupname, domain)
+            if g:
+                return g
+
             # validate things 
             v_name(groupname)
             v_domain(domain)
@@ -1856,9 +2612,10 @@ class API_userdata:
             # go get our group
             g = self.cfg.dbsess.query(Groups).\
             filter(Groups.groupname==groupname).\
-            filter(Groups.domain==domain).first()
+            filter(Groups.domain_id==Domains.id_of(domain)).first()
     
             if g:
+                self.__cache_obj('group', groupname, domain, g)
                 return g
             else:
                 return None 
@@ -1881,6 +2638,11 @@ class API_userdata:
         returns a Users ORM object or None
         """
         try:
+            # anything in the cache was validated on its way in
+            u = self.__cached_obj('user', username, domain)
+            if u:
+                return u
+
             # validate stuff 
             v_name(username)
             v_domain(domain)
@@ -1888,9 +2650,10 @@ class API_userdata:
             # go get our user
             u = self.cfg.dbsess.query(Users).\
             filter(Users.username==username).\
-            filter(Users.domain==domain).first()
+            filter(Users.domain_id==Domains.id_of(domain)).first()
     
             if u:
+                self.__cache_obj('user', username, domain, u)
                 return u
             else:
                 return None 
@@ -1899,211 +2662,464 @@ class API_userdata:
             raise UserdataError("API_userdata/__get_group_obj: error: %s" % e)
 
 
-    def __next_available_uid(self, domain):
+    def __cached_obj(self, kind, name, domain):
         """
         [description]
-        searches the db for existing UIDS and picks the next available UID within the parameters configured in vyvyan.yaml
-    
+        looks for a user or group in the lookup cache. entries are kept
+        pickled, so every hit is a fresh copy that gets merged into this
+        thread's session without going to the database
+
         [parameter info]
         required:
-            domain: the domain we're checking uids for
-    
+            kind: 'user' or 'group'
+            name: the username or groupname
+            domain: the domain
+
         [return value]
-        returns an integer representing the next available UID
+        returns a Users/Groups ORM object or None
         """
-        try:
-            # get the first allowable uid 
-            i = self.cfg.uid_start
-            uidlist = []
+        data = self.cache.get((kind, domain, name))
+        if data is None:
+            return None
+        obj = cPickle.loads(data)
+        # a copy this session already holds (and may have changed) wins
+        key = instance_state(obj).key
+        if key in self.cfg.dbsess.identity_map:
+            return self.cfg.dbsess.identity_map[key]
+        return self.cfg.dbsess.merge(obj, load=False)
+
+
+    def __cache_obj(self, kind, name, domain, obj):
+        """
+        [description]
+        puts a freshly loaded user or group in the lookup cache. nothing
+        is cached during a batch, which may yet be rolled back
 
-            # fetch all existing users
-            u = self.cfg.dbsess.query(Users).\
-            filter(Users.domain==domain).all()
+        [parameter info]
+        required:
+            kind: 'user' or 'group'
+            name: the username or groupname
+            domain: the domain
+            obj: the Users/Groups ORM object
 
-            # add all known uids to a list
-            for userentry in u:
-                uidlist.append(userentry.uid)
-            uidlist.sort(key=int)
+        [return value]
+        no explicit return
+        """
+        if self.cfg.dbsess().batch or obj in self.cfg.dbsess.dirty:
+            return
+        self.cache.put((kind, domain, name), cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
 
 
-            # if we don't have any users in the users table
-            # return the default first uid as configured in the yaml
-            # otherwise, pick the next open uid and return it
-            if not uidlist:
-                return self.cfg.uid_start
-            else:
-                for uu in uidlist:
-                    if uu < self.cfg.uid_start:
-                        pass
-                    elif not i == uu and i < self.cfg.uid_end:
-                        return i
-                    elif i < self.cfg.uid_end:
-                        i += 1
-                    else:
-                        self.cfg.log.debug("API_userdata/__next_available_uid: No available UIDs!")
-                        raise UserdataError("API_userdata/__next_available_uid: No available UIDs!")
-                return i
+    def __uncache(self, kind, name, domain):
+        """
+        [description]
+        drops a user or group from the lookup cache. every write to a
+        user or group row calls this once it has committed
 
-        except Exception, e:
-            raise UserdataError("API_userdata/__next_available_uid: %s" % e)
+        [parameter info]
+        required:
+            kind: 'user' or 'group'
+            name: the username or groupname
+            domain: the domain
+
+        [return value]
+        no explicit return
+        """
+        self.cache.delete((kind, domain, name))
 
 
-    def __next_available_gid(self, domain):
+    def __read_bulk_users(self, f, fmt=None):
         """
         [description]
-        searches the db for existing GIDS and picks the next available GID within the parameters configured in vyvyan.yaml
-    
+        reads a JSON-lines or CSV file of users for ubulkadd
+
         [parameter info]
         required:
-            domain: the domain we're checking gids for
-    
+            f: the uploaded file
+        optional:
+            fmt: "json" or "csv", guessed from the first line if not given
+
         [return value]
-        returns an integer representing the next available GID
+        returns a list of (line number, row dict) and a list of errors
+        for lines that couldn't be read
         """
-        try: 
-            # get the first allowable gid 
-            i = self.cfg.gid_start
-            gidlist = []
+        lines = f.read().splitlines()
+        if not fmt:
+            fmt = 'csv'
+            for line in lines:
+                if line.strip():
+                    if line.strip().startswith('{'):
+                        fmt = 'json'
+                    break
+
+        rows = []
+        errors = []
+        if fmt == 'json':
+            for lineno, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = myjson.loads(line)
+                    if not isinstance(row, dict):
+                        raise UserdataError("expected a JSON object")
+                    rows.append((lineno, row))
+                except Exception, e:
+                    errors.append({'line': lineno, 'username': None, 'error': "unable to parse line: %s" % e})
+        else:
+            reader = csv.DictReader(lines)
+            for row in reader:
+                if None in row:
+                    errors.append({'line': reader.line_num, 'username': row.get('username'), 'error': "too many fields"})
+                    continue
+                rows.append((reader.line_num, dict([(k.strip(), v.decode('utf-8')) for k, v in row.items() if v is not None])))
+        return rows, errors
+
+
+    def __bulk_user_row(self, row, domain):
+        """
+        [description]
+        validates one row of a ubulkadd file and fills in the defaults,
+        exactly the way uadd does it for a single user
 
-            # fetch all existing groups 
-            g = self.cfg.dbsess.query(Groups).\
-            filter(Groups.domain==domain).all()
+        [parameter info]
+        required:
+            row: the row dict read from the file
+            domain: domain to use if the row doesn't name one
 
-            # add all known uids to a list
-            for groupentry in g:
-                gidlist.append(groupentry.gid)
-            gidlist.sort(key=int)
+        [return value]
+        returns a dict of users table columns, uid is None if one
+        still needs to be allocated. raises an error if the row is bad
+        """
+        valid_keys = ['username', 'password', 'domain', 'first_name', 'last_name', 'user_type', 'shell', 'home_dir', 'email_address', 'uid', 'ssh_key']
+        r = {}
+        for k, v in row.items():
+            if k not in valid_keys:
+                raise UserdataError("unknown field \"%s\", valid fields are: %s" % (k, ', '.join(valid_keys)))
+            if v is not None and v != '':
+                r[k] = unicode(v)
+
+        if 'username' not in r:
+            raise UserdataError("no username provided!")
+        username = r['username']
+        v_name(username)
+        if 'password' not in r:
+            raise UserdataError("no password provided!")
+        if 'domain' in r:
+            domain = r['domain']
+            v_domain(domain)
+        if 'first_name' in r:
+            first_name = r['first_name']
+            v_name(first_name)
+        else:
+            first_name = "John"
+        if 'last_name' in r:
+            last_name = r['last_name']
+            v_name(last_name)
+        else:
+            last_name = "Doe"
+        if 'user_type' in r:
+            user_type = r['user_type']
+            if user_type not in self.cfg.user_types:
+                raise UserdataError("Invalid user type, please use one of the following: " + ', '.join(self.cfg.user_types))
+        else:
+            user_type = self.cfg.def_user_type
+        ssh_keys = []
+        if 'ssh_key' in r:
+            for key in r['ssh_key'].splitlines():
+                if v_ssh2_pubkey(key):
+                    ssh_keys.append(key)
+        if 'uid' in r:
+            uid = int(r['uid'])
+            v_uid(self.cfg, uid)
+        else:
+            uid = None
+
+        return {
+            'first_name': first_name,
+            'last_name': last_name,
+            'ssh_public_key': '\n'.join(ssh_keys),
+            'password': r['password'],
+            'username': username,
+            'domain': domain,
+            'uid': uid,
+            'type': user_type,
+            'hdir': r.get('home_dir') or "%s/%s" % (self.cfg.hdir, username),
+            'shell': r.get('shell') or self.cfg.shell,
+            'email': r.get('email_address') or "%s@%s" % (username, domain),
+            'active': True,
+        }
 
 
-            # if we don't have any groups in the groups table
-            # return the default first gid as configured in the yaml
-            # otherwise pick the next open gid and return it
-            if not gidlist:
-                return self.cfg.gid_start
-            else:
-                for gg in gidlist:
-                    if gg < self.cfg.gid_start:
-                        pass
-                    elif not i == gg and i < self.cfg.gid_end:
-                        return i
-                    elif i < self.cfg.gid_end:
-                        i += 1
-                    else:
-                        self.cfg.log.debug("API_userdata/__next_available_gid: No available GIDs!")
-                        raise UserdataError("API_userdata/__next_available_gid: No available GIDs!")
-                return i
+    def __next_available_uid(self, domain, after=None):
+        """
+        [description]
+        finds the lowest free UID within the parameters configured in vyvyan.yaml
+
+        [parameter info]
+        required:
+            domain: the domain we're checking uids for
+        optional:
+            after: only look above this uid (used to skip one we just lost to another worker)
+
+        [return value]
+        returns an integer representing the next available UID
+        """
+        try:
+            start = self.cfg.uid_start
+            if after is not None and after >= start:
+                start = after + 1
+            if start > self.cfg.uid_end:
+                self.cfg.log.debug("API_userdata/__next_available_uid: No available UIDs!")
+                raise UserdataError("API_userdata/__next_available_uid: No available UIDs!")
+
+            # the bottom of the range is free, we're done
+            if not self.cfg.dbsess.query(Users.uid).\
+            filter(Users.domain_id==Domains.id_of(domain)).\
+            filter(Users.uid==start).first():
+                return start
+
+            # otherwise ask the db for the first taken uid whose successor
+            # isn't taken. with the (domain, uid) key that's an index range
+            # scan, no rows get loaded into python
+            nextuser = aliased(Users)
+            uid = self.cfg.dbsess.query(func.min(Users.uid + 1)).\
+            filter(Users.domain_id==Domains.id_of(domain)).\
+            filter(Users.uid >= start).\
+            filter(Users.uid < self.cfg.uid_end).\
+            filter(~exists().where(and_(nextuser.domain_id==Domains.id_of(domain), nextuser.uid==Users.uid + 1))).scalar()
+            if uid is None:
+                self.cfg.log.debug("API_userdata/__next_available_uid: No available UIDs!")
+                raise UserdataError("API_userdata/__next_available_uid: No available UIDs!")
+            return uid
 
         except Exception, e:
-            raise UserdataError("API_userdata/__next_available_gid: %s" % e)
+            raise UserdataError("API_userdata/__next_available_uid: %s" % e)
 
 
-    def __get_groups_by_user(self, username, domain):
+    def __free_uids(self, domain):
         """
         [description]
-        searches the db for user-group mappings by username 
-    
+        generates the free UIDs in a domain in order, for handing out a lot
+        of them at once. each run of free uids costs two queries: one for
+        where it starts, one for the next taken uid above that
+
         [parameter info]
         required:
-            username: the username to search for 
-            domain: the domain to search in 
-    
+            domain: the domain we're checking uids for
+
         [return value]
-        returns a list of Groups ORMobjects or nothing 
+        yields free UIDs until the configured range runs out
         """
-        try:
-            # fetch our user
-            glist = []
-            u = self.__get_user_obj(username, domain)
-            if not u:
-                self.cfg.log.debug("API_userdata/__get_groups_by_user: user not found: %s" % username)
-                raise UserdataError("API_userdata/__get_groups_by_user: user not found: %s" % username)
+        after = None
+        while True:
+            try:
+                first = self.__next_available_uid(domain, after)
+            except UserdataError:
+                return
+            nexttaken = self.cfg.dbsess.query(func.min(Users.uid)).\
+            filter(Users.domain_id==Domains.id_of(domain)).\
+            filter(Users.uid > first).scalar()
+            if nexttaken is None or nexttaken > self.cfg.uid_end:
+                last = self.cfg.uid_end
+            else:
+                last = nexttaken - 1
+            for uid in xrange(first, last + 1):
+                yield uid
+            after = last
+
+
+    def __next_available_gid(self, domain, after=None):
+        """
+        [description]
+        finds the lowest free GID within the parameters configured in vyvyan.yaml
 
-            # get all groups to which the user is mapped
-            maplist = []
-            maplist = self.cfg.dbsess.query(UserGroupMapping).\
-                filter(UserGroupMapping.users_id==u.id).all()
+        [parameter info]
+        required:
+            domain: the domain we're checking gids for
+        optional:
+            after: only look above this gid (used to skip one we just lost to another worker)
 
-            # add each group mapped to the user to a list, return it
-            if maplist:
-                for ugmap in maplist:
-                    glist.append(self.cfg.dbsess.query(Groups).filter(Groups.id==ugmap.groups_id).first())
-            return glist
+        [return value]
+        returns an integer representing the next available GID
+        """
+        try:
+            start = self.cfg.gid_start
+            if after is not None and after >= start:
+                start = after + 1
+            if start > self.cfg.gid_end:
+                self.cfg.log.debug("API_userdata/__next_available_gid: No available GIDs!")
+                raise UserdataError("API_userdata/__next_available_gid: No available GIDs!")
+
+            # the bottom of the range is free, we're done
+            if not self.cfg.dbsess.query(Groups.gid).\
+            filter(Groups.domain_id==Domains.id_of(domain)).\
+            filter(Groups.gid==start).first():
+                return start
+
+            # otherwise ask the db for the first taken gid whose successor
+            # isn't taken. with the (domain, gid) key that's an index range
+            # scan, no rows get loaded into python
+            nextgroup = aliased(Groups)
+            gid = self.cfg.dbsess.query(func.min(Groups.gid + 1)).\
+            filter(Groups.domain_id==Domains.id_of(domain)).\
+            filter(Groups.gid >= start).\
+            filter(Groups.gid < self.cfg.gid_end).\
+            filter(~exists().where(and_(nextgroup.domain_id==Domains.id_of(domain), nextgroup.gid==Groups.gid + 1))).scalar()
+            if gid is None:
+                self.cfg.log.debug("API_userdata/__next_available_gid: No available GIDs!")
+                raise UserdataError("API_userdata/__next_available_gid: No available GIDs!")
+            return gid
 
         except Exception, e:
-            raise UserdataError("API_userdata/__get_groups_by_user: %s" % e)
+            raise UserdataError("API_userdata/__next_available_gid: %s" % e)
 
 
-    def __get_users_by_group(self, groupname, domain):
+    def __bulk_insert_rows(self, newusers, rows, lines, allocated, errors):
         """
         [description]
-        searches the db for user-group mappings by groupname 
-    
+        inserts ubulkadd's rows one at a time, each in its own savepoint,
+        after the single bulk insert collided with a concurrent add. a
+        row whose uid we picked and lost moves on to the next free uid,
+        the same way __add_with_free_id does. any other collision is
+        reported against the row
+
         [parameter info]
         required:
-            groupname: the groupname to search for 
-            domain: the domain to search in 
-    
+            newusers: the validated users, in the same order as rows
+            rows: the rows to insert
+            lines: the file line of each user, by id()
+            allocated: id()s of the users whose uid we picked
+            errors: the list of failed rows to add to
+
         [return value]
-        returns a list of Groups ORMobjects or nothing 
+        returns the users that were inserted
         """
-        try:
-            # fetch our group
-            ulist = []
-            g = self.__get_group_obj(groupname, domain)
-            if not g:
-                self.cfg.log.debug("API_userdata/__get_users_by_group: group %s not found in %s" % (groupname, domain))
-                raise UserdataError("API_userdata/__get_groups_by_user: group %s not found in %s" % (groupname, domain))
+        added = []
+        for u, row in zip(newusers, rows):
+            for attempt in range(ID_ALLOC_RETRIES):
+                savepoint = self.cfg.dbsess.begin_nested()
+                try:
+                    self.cfg.dbsess.execute(Users.__table__.insert(), row)
+                    savepoint.commit()
+                    added.append(u)
+                    break
+                except sqlalchemy.exc.IntegrityError, e:
+                    savepoint.rollback()
+                # locking reads, see __id_taken
+                if self.cfg.dbsess.query(Users.id).\
+                filter(Users.domain_id==row['domain_id']).\
+                filter(Users.username==u['username']).\
+                with_lockmode('update').first():
+                    error = "user %s exists in domain %s" % (u['username'], u['domain'])
+                elif not self.cfg.dbsess.query(Users.id).\
+                filter(Users.domain_id==row['domain_id']).\
+                filter(Users.uid==row['uid']).\
+                with_lockmode('update').first():
+                    # not a collision we know how to fix, pass on the real cause
+                    error = "%s" % e
+                elif id(u) not in allocated:
+                    error = "uid %s exists in domain %s already" % (row['uid'], u['domain'])
+                else:
+                    self.cfg.log.debug("API_userdata/ubulkadd: uid %s in %s was taken, trying the next one" % (row['uid'], u['domain']))
+                    try:
+                        row['uid'] = u['uid'] = self.__next_available_uid(u['domain'], row['uid'])
+                        continue
+                    except UserdataError, ue:
+                        error = "%s" % ue
+                errors.append({'line': lines[id(u)], 'username': u['username'], 'error': error})
+                break
+            else:
+                errors.append({'line': lines[id(u)], 'username': u['username'], 'error': "unable to claim a free uid in %s after %s tries" % (u['domain'], ID_ALLOC_RETRIES)})
+        return added
+
 
-            # get all users mapped to this group
-            maplist = []
-            maplist = self.cfg.dbsess.query(UserGroupMapping).\
-                filter(UserGroupMapping.groups_id==g.id).all()
+    def __id_taken(self, obj, idattr):
+        """
+        [description]
+        checks whether another user/group now holds obj's uid/gid. this
+        is a locking read: a plain one under REPEATABLE READ (InnoDB's
+        default) would answer from our transaction's snapshot and miss
+        the row a concurrent add just committed
 
-            # add each user mapped to the group to a list, return it
-            if maplist:
-                for ugmap in maplist:
-                    ulist.append(self.cfg.dbsess.query(Users).filter(Users.id==ugmap.users_id).first())
-            return ulist
+        [parameter info]
+        required:
+            obj: the Users or Groups object whose insert failed
+            idattr: 'uid' or 'gid'
 
-        except Exception, e:
-            raise UserdataError("API_userdata/__get_users_by_group: %s" % e)
+        [return value]
+        returns True if the id is taken, False if not
+        """
+        model = type(obj)
+        return self.cfg.dbsess.query(model.id).\
+        filter(model.domain_id==obj.domain_obj.id).\
+        filter(getattr(model, idattr)==getattr(obj, idattr)).\
+        with_lockmode('update').first() is not None
 
 
-    def __get_sudo_cmds_by_group(self, groupname, domain):
+    def __add_with_free_id(self, obj, idattr, allocate):
         """
         [description]
-        searches the db for user-group mappings by groupname 
-    
+        adds a new Users or Groups object under the next free uid/gid.
+        two workers can find the same free id at the same time, the
+        unique (domain, uid) and (domain, gid) keys let only one of them
+        have it. the loser's insert is rolled back to a savepoint and
+        it moves on to the next free id above the one it lost. any
+        other integrity error (a duplicate name, say) is raised as is
+
         [parameter info]
         required:
-            groupname: the groupname to search for 
-            domain: the domain to search in 
-    
+            obj: the Users or Groups object to add
+            idattr: 'uid' or 'gid'
+            allocate: __next_available_uid or __next_available_gid
+
         [return value]
-        returns a list of groups_sudocommands ORMobjects or nothing 
+        no return value, raises an error if no id could be claimed
         """
-        try:
-            # fetch our group
-            g = self.__get_group_obj(groupname, domain)
-            if not g:
-                self.cfg.log.debug("API_userdata/__get_sudo_cmds_by_group: group %s not found in %s" % (groupname, domain))
-                raise UserdataError("API_userdata/__get_sudo_cmds_by_user: group %s not found in %s" % (groupname, domain))
+        after = None
+        for attempt in range(ID_ALLOC_RETRIES):
+            setattr(obj, idattr, allocate(obj.domain, after))
+            savepoint = self.cfg.dbsess.begin_nested()
+            try:
+                self.cfg.dbsess.add(obj)
+                self.cfg.dbsess.flush()
+                savepoint.commit()
+                return
+            except sqlalchemy.exc.IntegrityError, e:
+                savepoint.rollback()
+                if not self.__id_taken(obj, idattr):
+                    raise
+                after = getattr(obj, idattr)
+                self.cfg.log.debug("API_userdata/__add_with_free_id: %s %s in %s was taken, trying the next one. error: %s" % (idattr, after, obj.domain, e))
+            except:
+                savepoint.rollback()
+                raise
+        self.cfg.log.debug("API_userdata/__add_with_free_id: unable to claim a free %s in %s after %s tries" % (idattr, obj.domain, ID_ALLOC_RETRIES))
+        raise UserdataError("API_userdata/__add_with_free_id: unable to claim a free %s in %s after %s tries" % (idattr, obj.domain, ID_ALLOC_RETRIES))
 
-            # get all sudo commands mapped to this group
-            maplist = []
-            maplist = self.cfg.dbsess.query(GroupSudocommandMapping).\
-                filter(GroupSudocommandMapping.groups_id==g.id).all()
 
-            return maplist
+    def __map_user(self, user, group):
+        """
+        [description]
+        map a user into a group. doesn't commit, the caller does once
+        the rest of its changes are in. the caller also makes sure the
+        mapping isn't there already
 
-        except Exception, e:
-            raise UserdataError("API_userdata/__get_sudo_commands_by_group: %s" % e)
+        [parameter info]
+        required:
+            user: the ORM object of the user, already flushed so it has an id
+            group: the ORM object of the group
+
+        [return value]
+        no explicit return
+        """
+        self.cfg.dbsess.add(UserGroupMapping(group.id, user.id))
 
 
     def __map_sudoers(self, group, sudo_cmds):
         """
         [description]
-        map a set of sudo commands to a group
+        map a set of sudo commands to a group. doesn't commit, the
+        caller does once the rest of its changes are in
 
         [parameter info]
         required:
@@ -2129,28 +3145,32 @@ class API_userdata:
                     command = command.strip(' \t\n\r')
                     clean_sudo_cmds.append(command)
 
-                # loop over commands and map them to the group
+                # what's mapped now, in one query
+                current = set([row.sudocommand for row in self.cfg.dbsess.execute(select([GroupSudocommandMapping.sudocommand]).\
+                    where(GroupSudocommandMapping.groups_id==group.id))])
+
+                # map the commands that aren't there yet, in one go
+                new = []
                 for command in clean_sudo_cmds:
-                    if not self.cfg.dbsess.query(GroupSudocommandMapping).\
-                    filter(GroupSudocommandMapping.sudocommand==command).\
-                    filter(GroupSudocommandMapping.groups_id==group.id).first():
-                      gsmap = GroupSudocommandMapping(group.id, command)
-                      self.cfg.dbsess.add(gsmap)
-
-                # loop over existing mappings and ensure they're valid. remove any invalid mappings
-                for gsmap in self.cfg.dbsess.query(GroupSudocommandMapping).filter(GroupSudocommandMapping.groups_id==group.id).all():
-                  if gsmap.sudocommand not in clean_sudo_cmds:
-                    self.cfg.dbsess.delete(gsmap)
-
-                # commit our transaction
-                self.cfg.dbsess.commit()
+                    if command not in current and command not in new:
+                        new.append(command)
+                if new:
+                    self.cfg.dbsess.execute(GroupSudocommandMapping.__table__.insert(),
+                        [{'groups_id': group.id, 'sudocommand': command} for command in new])
+
+                # and drop the ones that aren't wanted any more, also in one go
+                stale = list(current - set(clean_sudo_cmds))
+                if stale:
+                    self.cfg.dbsess.query(GroupSudocommandMapping).\
+                    filter(GroupSudocommandMapping.groups_id==group.id).\
+                    filter(GroupSudocommandMapping.sudocommand.in_(stale)).delete(synchronize_session=False)
 
                 # declare victory
                 return 'success'
 
         except Exception, e:
-            # something odd happened, explode violently
-            self.cfg.dbsess.rollback()
+            # something odd happened, explode violently. rolling
+            # back is left to the caller, along with the commit
             self.cfg.log.debug("API_userdata/__map_sudoers: error: %s" % e)
             raise UserdataError("API_userdata/__map_sudoers: error: %s" % e)
 
@@ -2158,7 +3178,8 @@ class API_userdata:
     def __unmap_sudoers(self, group):
         """
         [description]
-        map a set of sudo commands to a group
+        unmap all of a group's sudo commands. doesn't commit, the
+        caller does once the rest of its changes are in
 
         [parameter info]
         required:
@@ -2174,19 +3195,16 @@ class API_userdata:
                 self.cfg.log.debug("API_userdata/__unmap_sudoers: group not found, missing parameter")
                 raise UserdataError("API_userdata/__unmap_sudoers: group not found, missing parameter")
 
-            # loop over existing mappings and remove
+            # remove every existing mapping in one statement
             else:
-                for gsmap in self.cfg.dbsess.query(GroupSudocommandMapping).filter(GroupSudocommandMapping.groups_id==group.id).all():
-                  self.cfg.dbsess.delete(gsmap)
-
-                # commit our transaction
-                self.cfg.dbsess.commit()
+                self.cfg.dbsess.query(GroupSudocommandMapping).\
+                filter(GroupSudocommandMapping.groups_id==group.id).delete(synchronize_session=False)
 
                 # declare victory
                 return 'success'
 
         except Exception, e:
-            # something odd happened, explode violently
-            self.cfg.dbsess.rollback()
+            # something odd happened, explode violently. rolling
+            # back is left to the caller, along with the commit
             self.cfg.log.debug("API_userdata/__unmap_sudoers: error: %s" % e)
             raise UserdataError("API_userdata/__unmap_sudoers: error: %s" % e)
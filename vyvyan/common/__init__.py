@@ -2,7 +2,16 @@
 #
 import os
 import sys
+import time
 import logging
+import threading
+import collections
+
+# for >=2.6 use json, >2.6 use simplejson
+try:
+    import json as myjson
+except ImportError:
+    import simplejson as myjson
 
 
 # error class for the common module
@@ -97,6 +106,172 @@ class VyvyanCommon(object):
         return sorted(items, cmp=comparer)
 
 
+    def stream_listing(self, rows, chunk=1000):
+        """
+        [description]
+        encodes (key, entry) pairs as a JSON object of lists, a piece at
+        a time, so a listing never has to be held in memory in full.
+        rows must come sorted by key, entries with the same key end up
+        in the same list
+
+        [parameter info]
+            required:
+                rows: an iterable of (key, entry) pairs, sorted by key
+            optional:
+                chunk: how many entries to encode before handing a piece back
+
+        [return]
+        returns a generator of JSON text fragments, joined they decode to
+        {key: [entry, entry], key: [entry]}
+        """
+        encode = myjson.JSONEncoder().encode
+        buf = ['{']
+        count = 0
+        lastkey = None
+        for key, entry in rows:
+            if lastkey is None:
+                buf.append('%s: [%s' % (encode(key), encode(entry)))
+            elif key != lastkey:
+                buf.append('], %s: [%s' % (encode(key), encode(entry)))
+            else:
+                buf.append(', %s' % encode(entry))
+            lastkey = key
+            count += 1
+            if count % chunk == 0:
+                yield ''.join(buf)
+                buf = []
+        if lastkey is not None:
+            buf.append(']')
+        buf.append('}')
+        yield ''.join(buf)
+
+
+class VyvyanCache(object):
+    """
+    A small least-recently-used cache whose entries also expire after
+    ttl seconds. Safe to share between request threads. Each process
+    keeps its own, so with more than one worker an entry can be up to
+    ttl seconds behind a write made by another worker
+    """
+    def __init__(self, size=1000, ttl=10):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        [description]
+        looks up a key, counting the hit or miss. expired entries are
+        dropped on the way
+
+        [parameter info]
+            required:
+                key: the key to look up
+
+        [return]
+        returns the cached value, or None
+        """
+        if not self.size:
+            return None
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.time():
+                self.expired += 1
+                self.misses += 1
+                return None
+            # put it back at the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        [description]
+        stores a value, pushing out the least recently used entry if
+        the cache is full
+
+        [parameter info]
+            required:
+                key: the key to store under
+                value: the value, must not be None
+
+        [return]
+        no return
+        """
+        if not self.size:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        [description]
+        drops a key, if it's there
+
+        [parameter info]
+            required:
+                key: the key to drop
+
+        [return]
+        no return
+        """
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """
+        [description]
+        drops every entry. the counters are kept
+
+        [return]
+        no return
+        """
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        """
+        [description]
+        reports how full the cache is and how well it's doing
+
+        [return]
+        returns a dict of counters
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            if lookups:
+                hit_rate = round(float(self.hits) / lookups, 4)
+            else:
+                hit_rate = 0.0
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': hit_rate,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
 class VyvyanLogger(object):
     """
     Vyvyan logger class
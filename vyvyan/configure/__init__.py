@@ -19,12 +19,19 @@
 import os.path
 import sys
 import shutil
+import time
+import logging
+import threading
 import yaml
 
 # Extra modules
 import xmlrpclib
 import sqlalchemy
 import sqlalchemy.orm
+import sqlalchemy.pool
+import sqlalchemy.event
+import sqlalchemy.exc
+import sqlalchemy.engine.url
 
 # our error class
 class ConfigureError(Exception):
@@ -35,6 +42,126 @@ class ConfigureError(Exception):
 load_paths = ['.', '~', '/etc', '/usr/local/etc']
 
 
+# per-thread stopwatch for VyvyanQueuePool checkouts
+checkout_clock = threading.local()
+
+
+def timed_creator(creator):
+    """
+        Wraps the pool's creator so the time spent opening a brand new
+        connection can be left out of the checkout wait
+    """
+    def connect(connection_record=None):
+        start = time.time()
+        try:
+            if connection_record is None:
+                return creator()
+            return creator(connection_record)
+        finally:
+            checkout_clock.connecting = getattr(checkout_clock, 'connecting', 0.0) + time.time() - start
+    connect.vyvyan_timed = True
+    return connect
+
+
+def time_checkout(dbapi_con, con_record, con_proxy):
+    """
+        Pool checkout listener that stops the clock VyvyanQueuePool
+        started. it's registered ahead of ping_connection, so neither the
+        pre-ping nor a retry after a failed one is counted
+    """
+    start = getattr(checkout_clock, 'start', None)
+    if start is None:
+        return
+    checkout_clock.start = None
+    checkout_clock.waited = time.time() - start - checkout_clock.connecting
+
+
+class VyvyanQueuePool(sqlalchemy.pool.QueuePool):
+    """
+        A QueuePool that logs a warning when a checkout spends longer than
+        checkout_warn queued for a free connection, so the pool can be
+        sized against the thread count. only requests that actually use
+        the database check anything out
+    """
+    # seconds, set from pool_checkout_warn in vyvyan_daemon.yaml
+    checkout_warn = 1.0
+
+    def __init__(self, creator, *args, **kwargs):
+        # recreate() hands the wrapped creator back in, don't wrap it twice
+        if not getattr(creator, 'vyvyan_timed', False):
+            creator = timed_creator(creator)
+        sqlalchemy.pool.QueuePool.__init__(self, creator, *args, **kwargs)
+
+    def timed_checkout(self, checkout):
+        checkout_clock.start = time.time()
+        checkout_clock.connecting = 0.0
+        checkout_clock.waited = 0.0
+        con = checkout(self)
+        checkout_clock.start = None
+        if checkout_clock.waited > self.checkout_warn:
+            logging.getLogger('vyvyan').warn("db pool checkout waited %.1fms (%s)" % (checkout_clock.waited*1000, self.status()))
+        return con
+
+    # sessions check out through connect(), engine.connect() and
+    # raw_connection() through unique_connection()
+    def connect(self):
+        return self.timed_checkout(sqlalchemy.pool.QueuePool.connect)
+
+    def unique_connection(self):
+        return self.timed_checkout(sqlalchemy.pool.QueuePool.unique_connection)
+
+
+def ping_connection(dbapi_con, con_record, con_proxy):
+    """
+        Pool checkout listener that makes sure a connection is still
+        alive before it is handed out. Raising DisconnectionError makes
+        the pool throw the connection away and try another one
+    """
+    cursor = dbapi_con.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except:
+        raise sqlalchemy.exc.DisconnectionError()
+    cursor.close()
+
+
+def sqlite_connect(dbapi_con, con_record):
+    """
+        pysqlite issues its own BEGIN at the wrong moments, which breaks
+        SAVEPOINT. turn that off and let sqlite_begin() do it instead
+    """
+    dbapi_con.isolation_level = None
+
+
+def sqlite_begin(conn):
+    """
+        take the write lock up front. a plain BEGIN that reads first and
+        writes later gets "database is locked" instead of waiting its turn
+        when another thread is writing
+    """
+    conn.execute("BEGIN IMMEDIATE")
+
+
+class VyvyanSession(sqlalchemy.orm.Session):
+    """
+        A Session that can be switched into batch mode. API methods commit
+        (and roll back) on their own, so while a batch is running commit()
+        only flushes and rollback() is left to whoever started the batch,
+        which then commits or rolls back the whole thing once
+    """
+    batch = False
+
+    def commit(self):
+        if self.batch:
+            self.flush()
+        else:
+            sqlalchemy.orm.Session.commit(self)
+
+    def rollback(self):
+        if not self.batch:
+            sqlalchemy.orm.Session.rollback(self)
+
+
 # configuration options common to CLI and Daemon versions. These options
 # should appear in BOTH .yaml files
 class VyvyanConfigure(object):
@@ -107,8 +234,7 @@ class VyvyanConfigure(object):
         """
             Close out connections
         """
-        self.dbconn.close()
-        self.dbsess.close()
+        self.dbsess.remove()
         self.dbengine.dispose()
 
 
@@ -144,6 +270,20 @@ class VyvyanConfigureCli(VyvyanConfigure):
             self.api_port = genconfig['api_port']
         else:
             self.api_port = '8081'
+        # directory to keep the last copy of each module's metadata in,
+        # default is $XDG_CACHE_HOME/vyvyan (~/.cache/vyvyan)
+        if 'metadata_cache_dir' in genconfig and genconfig['metadata_cache_dir']:
+            self.metadata_cache_dir = os.path.expanduser(genconfig['metadata_cache_dir'])
+        else:
+            cachehome = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+            self.metadata_cache_dir = os.path.join(cachehome, 'vyvyan')
+        # seconds to trust the cached metadata without asking the api
+        # server about it at all. after that it is revalidated with
+        # If-None-Match. 0 revalidates on every run. default is 300
+        if 'metadata_cache_ttl' in genconfig and genconfig['metadata_cache_ttl'] is not None:
+            self.metadata_cache_ttl = int(genconfig['metadata_cache_ttl'])
+        else:
+            self.metadata_cache_ttl = 300
 
         logconfig = all_configs['logconfig']
         # audit log filename, default is vyvyan_audit.log
@@ -158,6 +298,35 @@ class VyvyanConfigureCli(VyvyanConfigure):
 # configuration options for the Daemon. these options should appear ONLY
 # in vyvyan_daemon.yaml
 class VyvyanConfigureDaemon(VyvyanConfigure):
+    def db_url(self, dbconfig):
+        """
+            Build the sqlalchemy connection URL from the db section
+            of the config, instead of pasting strings together
+        """
+        query = {}
+        host = dbconfig.get('hostname')
+        port = dbconfig.get('port')
+        if self.db_unix_socket:
+            # postgresql wants the socket directory as its host,
+            # mysql wants the socket file itself
+            if self.db_engine == 'mysql':
+                query['unix_socket'] = self.db_unix_socket
+            else:
+                query['host'] = self.db_unix_socket
+            host = None
+            port = None
+        if self.db_engine == 'sqlite':
+            # for sqlite, dbname is the path to the database file
+            return sqlalchemy.engine.url.URL('sqlite', database=dbconfig.get('dbname'))
+        return sqlalchemy.engine.url.URL(self.db_engine,
+                                         username=dbconfig.get('user'),
+                                         password=dbconfig.get('pass'),
+                                         host=host,
+                                         port=port,
+                                         database=dbconfig.get('dbname'),
+                                         query=query)
+
+
     def load_config(self):
         """
             Takes a config_file name as a parameter and searches through the following
@@ -166,37 +335,161 @@ class VyvyanConfigureDaemon(VyvyanConfigure):
         # module metadata for API module loader
         self.module_metadata = {}
         self.module_templates = {}
+        # bumped every time the module loader runs, the encoded
+        # metadata cache is only valid for a single generation
+        self.module_generation = 0
+        self.metadata_cache = {}
         all_configs = self.all_configs
 
+        # HTTP server settings. this section is optional, older
+        # config files without it get the single-process server
+        if 'server' in all_configs and all_configs['server']:
+            servconfig = all_configs['server']
+        else:
+            servconfig = {}
+        # address to listen on, default is "0.0.0.0"
+        if 'host' in servconfig and servconfig['host']:
+            self.server_host = servconfig['host']
+        else:
+            self.server_host = '0.0.0.0'
+        # port to listen on, default is 8081
+        if 'port' in servconfig and servconfig['port']:
+            self.server_port = int(servconfig['port'])
+        else:
+            self.server_port = 8081
+        # number of worker processes to fork, default is 1
+        # anything above 1 hands the socket over to gunicorn
+        if 'workers' in servconfig and servconfig['workers']:
+            self.server_workers = int(servconfig['workers'])
+        else:
+            self.server_workers = 1
+        # number of request threads per worker, default is 1
+        if 'threads' in servconfig and servconfig['threads']:
+            self.server_threads = int(servconfig['threads'])
+        else:
+            self.server_threads = 1
+        # listen backlog for the shared socket, default is 2048
+        if 'backlog' in servconfig and servconfig['backlog']:
+            self.server_backlog = int(servconfig['backlog'])
+        else:
+            self.server_backlog = 2048
+        # recycle a worker after this many requests, default is 0 (never)
+        if 'max_requests' in servconfig and servconfig['max_requests']:
+            self.server_max_requests = int(servconfig['max_requests'])
+        else:
+            self.server_max_requests = 0
+        # random jitter added to max_requests so the workers don't all
+        # recycle at the same moment, default is 0
+        if 'max_requests_jitter' in servconfig and servconfig['max_requests_jitter']:
+            self.server_max_requests_jitter = int(servconfig['max_requests_jitter'])
+        else:
+            self.server_max_requests_jitter = 0
+        # seconds a silent worker is given before it is killed and
+        # replaced, default is 30
+        if 'timeout' in servconfig and servconfig['timeout']:
+            self.server_timeout = int(servconfig['timeout'])
+        else:
+            self.server_timeout = 30
+        # bind the listen socket with SO_REUSEPORT, default is False
+        if 'reuse_port' in servconfig and servconfig['reuse_port']:
+            self.server_reuse_port = servconfig['reuse_port']
+        else:
+            self.server_reuse_port = False
+        if self.server_workers < 1 or self.server_threads < 1:
+            raise ConfigureError("server workers and threads must be 1 or greater")
+
         # Database related settings
         dbconfig = all_configs['db']
+        # db engine, one of postgresql, postgres, mysql or sqlite
+        if 'engine' in dbconfig and dbconfig['engine'] in ['postgresql', 'postgres', 'mysql', 'sqlite']:
+            self.db_engine = dbconfig['engine']
+        else:
+            raise ConfigureError("DB section of /etc/vyvyan_daemon.yaml is misconfigured! Exiting")
+        # echo generated sql to the console, default is False
+        if 'echo' in dbconfig and dbconfig['echo']:
+            self.db_echo = dbconfig['echo']
+        else:
+            self.db_echo = False
+        # path to a unix domain socket. when set, hostname and port
+        # are ignored. for postgresql this is the socket directory
+        if 'unix_socket' in dbconfig and dbconfig['unix_socket']:
+            self.db_unix_socket = dbconfig['unix_socket']
+        else:
+            self.db_unix_socket = None
+        # every request thread checks out its own connection, so the
+        # default pool size is the number of threads in this process
+        if 'pool_size' in dbconfig and dbconfig['pool_size']:
+            self.db_pool_size = int(dbconfig['pool_size'])
+        else:
+            self.db_pool_size = max(5, self.server_threads)
+        # connections allowed above pool_size under load, default is 10
+        if 'max_overflow' in dbconfig and dbconfig['max_overflow'] is not None:
+            self.db_max_overflow = int(dbconfig['max_overflow'])
+        else:
+            self.db_max_overflow = 10
+        # seconds to wait for a free connection before giving up,
+        # default is 30
+        if 'pool_timeout' in dbconfig and dbconfig['pool_timeout']:
+            self.db_pool_timeout = int(dbconfig['pool_timeout'])
+        else:
+            self.db_pool_timeout = 30
+        # replace connections older than this many seconds, default
+        # is -1 (never). set it below mysql's wait_timeout
+        if 'pool_recycle' in dbconfig and dbconfig['pool_recycle']:
+            self.db_pool_recycle = int(dbconfig['pool_recycle'])
+        else:
+            self.db_pool_recycle = -1
+        # test each connection with a "SELECT 1" on checkout and
+        # replace it if it has gone away, default is False
+        if 'pool_pre_ping' in dbconfig and dbconfig['pool_pre_ping']:
+            self.db_pool_pre_ping = dbconfig['pool_pre_ping']
+        else:
+            self.db_pool_pre_ping = False
+        # log a warning when a checkout waits longer than this many
+        # seconds for a connection, default is 1
+        if 'pool_checkout_warn' in dbconfig and dbconfig['pool_checkout_warn']:
+            self.db_pool_checkout_warn = float(dbconfig['pool_checkout_warn'])
+        else:
+            self.db_pool_checkout_warn = 1.0
+        # extra arguments passed straight through to the DB-API
+        # driver's connect(), default is none
+        if 'connect_args' in dbconfig and dbconfig['connect_args']:
+            self.db_connect_args = dbconfig['connect_args']
+        else:
+            self.db_connect_args = {}
         # try to create a DB engine with sqlalchemy
         try:
             engine = ''
-            # PostgreSQL
-            if dbconfig['engine'] == 'postgresql':
-                dbtuple = (dbconfig['user'], dbconfig['hostname'], dbconfig['dbname'])
-                engine = sqlalchemy.create_engine("postgresql://%s@%s/%s" % dbtuple, echo=dbconfig['echo'])
-            elif dbconfig['engine'] == 'postgres':
-                dbtuple = (dbconfig['user'], dbconfig['hostname'], dbconfig['dbname'])
-                engine = sqlalchemy.create_engine("postgres://%s@%s/%s" % dbtuple, echo=dbconfig['echo'])
-            # MySql
-            elif dbconfig['engine'] == 'mysql':
-                dbtuple = (dbconfig['user'], dbconfig['pass'], dbconfig['hostname'], dbconfig['dbname'])
-                engine = sqlalchemy.create_engine("mysql://%s:%s@%s/%s" % dbtuple, echo=dbconfig['echo'])
-            # uhhhh....
-            else:
-                raise ConfigureError("DB section of /etc/vyvyan_daemon.yaml is misconfigured! Exiting")
-            # now that we have an engine, bind it to a session
-            Session = sqlalchemy.orm.sessionmaker(bind=engine)
-            dbsession = Session()
+            dburl = self.db_url(dbconfig)
+            engineargs = {'echo': self.db_echo, 'connect_args': self.db_connect_args}
+            # sqlite is only good for testing and manages its own pool
+            if self.db_engine != 'sqlite':
+                VyvyanQueuePool.checkout_warn = self.db_pool_checkout_warn
+                engineargs['poolclass'] = VyvyanQueuePool
+                engineargs['pool_size'] = self.db_pool_size
+                engineargs['max_overflow'] = self.db_max_overflow
+                engineargs['pool_timeout'] = self.db_pool_timeout
+                engineargs['pool_recycle'] = self.db_pool_recycle
+            engine = sqlalchemy.create_engine(dburl, **engineargs)
+            # has to go ahead of ping_connection
+            if self.db_engine != 'sqlite':
+                sqlalchemy.event.listen(engine.pool, 'checkout', time_checkout)
+            if self.db_pool_pre_ping:
+                sqlalchemy.event.listen(engine.pool, 'checkout', ping_connection)
+            # the /batch endpoint needs working savepoints
+            if self.db_engine == 'sqlite':
+                sqlalchemy.event.listen(engine, 'connect', sqlite_connect)
+                sqlalchemy.event.listen(engine, 'begin', sqlite_begin)
+            # now that we have an engine, bind it to a session registry.
+            # dbsess hands each thread its own session, the daemon
+            # calls dbsess.remove() at the end of every request
+            Session = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=engine, class_=VyvyanSession))
             self.dbconfig = dbconfig
-            self.dbconn = engine.connect()
             self.dbengine = engine
-            self.dbsess = dbsession
+            self.dbsess = Session
             self.dbnull = sqlalchemy.sql.expression.null()
         except Exception, e:
-            raise ConfigureError("Database configuration error. dbtuple: %s, engine: %s. Error: %s" % (dbtuple, engine, e))
+            raise ConfigureError("Database configuration error. engine: %s, hostname: %s, dbname: %s. Error: %s" % (self.db_engine, dbconfig.get('hostname'), dbconfig.get('dbname'), e))
 
         # General settings
         genconfig = all_configs['general']
@@ -282,6 +575,26 @@ class VyvyanConfigureDaemon(VyvyanConfigure):
         else:
             self.default_groups = ['users',]
 
+        # lookup cache settings. this section is optional, older
+        # config files without it get the defaults
+        if 'cache' in all_configs and all_configs['cache']:
+            cacheconfig = all_configs['cache']
+        else:
+            cacheconfig = {}
+        # most users/groups each worker keeps cached, default is 1000.
+        # 0 turns the cache off
+        if 'size' in cacheconfig and cacheconfig['size'] is not None:
+            self.cache_size = int(cacheconfig['size'])
+        else:
+            self.cache_size = 1000
+        # seconds a cached user/group is trusted for, default is 10
+        if 'ttl' in cacheconfig and cacheconfig['ttl']:
+            self.cache_ttl = float(cacheconfig['ttl'])
+        else:
+            self.cache_ttl = 10.0
+        if self.cache_size < 0 or self.cache_ttl < 0:
+            raise ConfigureError("cache size and ttl must be 0 or greater")
+
         # LDAP settings
         ldconfig = all_configs['ldap']
         # whether to activate the LDAP module. default is False
@@ -318,3 +631,51 @@ class VyvyanConfigureDaemon(VyvyanConfigure):
             self.ldap_default_gid = ldconfig['default_gid']
         else:
             self.ldap_default_gid = '500'
+        # servers to push users and groups to. default is none
+        if 'servers' in ldconfig and ldconfig['servers']:
+            self.ldap_servers = ldconfig['servers']
+        else:
+            self.ldap_servers = []
+        # CN and password to bind as. default CN is "root"
+        if 'ldap_admin_cn' in ldconfig and ldconfig['ldap_admin_cn']:
+            self.ldap_admin_cn = ldconfig['ldap_admin_cn']
+        else:
+            self.ldap_admin_cn = 'root'
+        if 'ldap_admin_pass' in ldconfig and ldconfig['ldap_admin_pass']:
+            self.ldap_admin_pass = ldconfig['ldap_admin_pass']
+        else:
+            self.ldap_admin_pass = ''
+        # most idle bound connections kept per server. default is 4
+        if 'pool_size' in ldconfig and ldconfig['pool_size'] is not None:
+            self.ldap_pool_size = int(ldconfig['pool_size'])
+        else:
+            self.ldap_pool_size = 4
+        # seconds an idle connection is kept before it's unbound.
+        # default is 300
+        if 'pool_idle' in ldconfig and ldconfig['pool_idle']:
+            self.ldap_pool_idle = float(ldconfig['pool_idle'])
+        else:
+            self.ldap_pool_idle = 300.0
+        # seconds idle after which a connection is checked with a
+        # whoami before it's used again. default is 30
+        if 'pool_check' in ldconfig and ldconfig['pool_check'] is not None:
+            self.ldap_pool_check = float(ldconfig['pool_check'])
+        else:
+            self.ldap_pool_check = 30.0
+        if self.ldap_pool_size < 0 or self.ldap_pool_check < 0:
+            raise ConfigureError("ldap pool_size and pool_check must be 0 or greater")
+        # most servers written to at once. default is 8
+        if 'workers' in ldconfig and ldconfig['workers']:
+            self.ldap_workers = int(ldconfig['workers'])
+        else:
+            self.ldap_workers = 8
+        if self.ldap_workers < 1:
+            raise ConfigureError("ldap workers must be 1 or greater")
+        # most operations sent down one connection before waiting on
+        # the results, for bulk runs like refreshes. default is 64
+        if 'window' in ldconfig and ldconfig['window']:
+            self.ldap_window = int(ldconfig['window'])
+        else:
+            self.ldap_window = 64
+        if self.ldap_window < 1:
+            raise ConfigureError("ldap window must be 1 or greater")
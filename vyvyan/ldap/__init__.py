@@ -19,7 +19,13 @@ all user interaction should be done in the vyvyan.API_userdata module
 
 # imports
 import os
+import sys
+import time
 import ldap
+import threading
+import collections
+import contextlib
+from multiprocessing.pool import ThreadPool
 import vyvyan.validate
 import vyvyan.API_userdata as userdata
 
@@ -32,7 +38,8 @@ class LDAPError(Exception):
 def ld_connect(cfg, server):
     """
     [description]
-    open a connection to an LDAP server 
+    open a connection to an LDAP server and bind to it as the admin user.
+    most callers want ld_borrow instead, which hands out pooled connections
 
     [parameter info]
     required:
@@ -42,16 +49,15 @@ def ld_connect(cfg, server):
     [return value]
     returns the open ldap connection object 
     """
+    # stitch together some useful info
+    admin_dn = "cn=%s,dc=%s" % (cfg.ldap_admin_cn, ',dc='.join(cfg.default_domain.split('.')))
+    ld_server_string = "ldaps://"+server
     try:
-      # stitch together some useful info
-      admin_dn = "cn=%s,dc=%s" % (cfg.ldap_admin_cn, ',dc='.join(cfg.default_domain.split('.')))
-      ld_server_string = "ldaps://"+server
-
       # init the connection to the ldap server
       ldcon = ldap.initialize(ld_server_string)
       ldcon.simple_bind_s(admin_dn, cfg.ldap_admin_pass)
     except ldap.LDAPError, e:
-      cfg.log.debug("error connecting to ldap server: %s" % ldap_master)
+      cfg.log.debug("error connecting to ldap server: %s" % server)
       cfg.log.debug("INFO DUMP:\n")
       cfg.log.debug("admin_dn: %s\nld_server_string: %s" % (admin_dn, ld_server_string))
       raise LDAPError(e)
@@ -60,6 +66,602 @@ def ld_connect(cfg, server):
     return ldcon
 
 
+class LDAPConnection(object):
+    """
+    A bound connection handed out by an LDAPPool. Passes everything
+    through to the python-ldap connection underneath, but if the server
+    has dropped us a synchronous operation is retried once on a freshly
+    bound connection
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.ldcon = ld_connect(pool.cfg, pool.server)
+        self.last_used = time.time()
+
+    def reconnect(self):
+        """
+        [description]
+        drop the current connection and bind a new one
+
+        [return value]
+        no explicit return
+        """
+        self.close()
+        self.ldcon = ld_connect(self.pool.cfg, self.pool.server)
+        self.pool.reconnects += 1
+
+    def alive(self):
+        """
+        [description]
+        checks the server still answers on this connection
+
+        [return value]
+        returns True or False
+        """
+        try:
+            self.ldcon.whoami_s()
+            return True
+        except ldap.LDAPError:
+            return False
+
+    def close(self):
+        """
+        [description]
+        unbind, ignoring a connection that's already gone
+
+        [return value]
+        no explicit return
+        """
+        try:
+            self.ldcon.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def __getattr__(self, name):
+        attr = getattr(self.ldcon, name)
+        # only the synchronous calls are retried. an asynchronous one's
+        # message id means nothing on the new connection
+        if not callable(attr) or not name.endswith('_s'):
+            return attr
+        def call(*args, **kwargs):
+            try:
+                return getattr(self.ldcon, name)(*args, **kwargs)
+            except ldap.SERVER_DOWN:
+                self.pool.cfg.log.debug("ldap server %s went away, reconnecting" % self.pool.server)
+                self.reconnect()
+                return getattr(self.ldcon, name)(*args, **kwargs)
+        return call
+
+
+class LDAPPool(object):
+    """
+    Keeps bound connections to one LDAP server between calls, so a run
+    of operations pays for the TLS handshake and bind once rather than
+    every time. Safe to share between threads: each borrower gets a
+    connection to itself, a new one is opened if none are idle
+    """
+    def __init__(self, cfg, server):
+        self.cfg = cfg
+        self.server = server
+        self.idle = []
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reconnects = 0
+
+    def get(self):
+        """
+        [description]
+        hands out an idle connection, or binds a new one. connections
+        idle past ldap_pool_idle are thrown away, ones idle past
+        ldap_pool_check are checked before they are handed out
+
+        [return value]
+        returns an LDAPConnection
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            idle_for = time.time() - conn.last_used
+            if idle_for > self.cfg.ldap_pool_idle:
+                conn.close()
+                continue
+            if idle_for > self.cfg.ldap_pool_check and not conn.alive():
+                conn.close()
+                continue
+            return conn
+        conn = LDAPConnection(self)
+        with self.lock:
+            self.opened += 1
+        return conn
+
+    def put(self, conn):
+        """
+        [description]
+        takes a connection back. past ldap_pool_size idle connections
+        the extras are unbound
+
+        [parameter info]
+        required:
+            conn: the LDAPConnection to give back
+
+        [return value]
+        no explicit return
+        """
+        conn.last_used = time.time()
+        with self.lock:
+            if len(self.idle) < self.cfg.ldap_pool_size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        """
+        [description]
+        unbinds every idle connection
+
+        [return value]
+        no explicit return
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+
+# one pool per server, shared by everything in this process
+pools = {}
+pools_lock = threading.Lock()
+
+def ld_pool(cfg, server):
+    """
+    [description]
+    find the connection pool for a server, creating it the first time
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        server: the LDAP server
+
+    [return value]
+    returns the LDAPPool
+    """
+    with pools_lock:
+        if server not in pools:
+            pools[server] = LDAPPool(cfg, server)
+        return pools[server]
+
+
+@contextlib.contextmanager
+def ld_borrow(cfg, server):
+    """
+    [description]
+    borrow a bound connection to an LDAP server for the length of a with
+    block. it goes back to the pool afterwards unless the server is
+    unreachable or something other than an LDAP error went wrong
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        server: server to connect to
+
+    [return value]
+    yields the connection
+    """
+    pool = ld_pool(cfg, server)
+    conn = pool.get()
+    try:
+        yield conn
+    except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT):
+        conn.close()
+        raise
+    except ldap.LDAPError:
+        pool.put(conn)
+        raise
+    except:
+        conn.close()
+        raise
+    pool.put(conn)
+
+
+def ld_close_pools():
+    """
+    [description]
+    unbind every idle pooled connection, for use on shutdown
+
+    [return value]
+    no explicit return
+    """
+    with pools_lock:
+        for pool in pools.values():
+            pool.clear()
+
+
+class LDAPBulkError(LDAPError):
+    """
+    Raised when some operations in a pipelined run fail. failures is a
+    list of (operation, dn, error), one for each
+    """
+    def __init__(self, failures, total):
+        self.failures = failures
+        msg = "; ".join("%s %s: %s" % f for f in failures[:10])
+        if len(failures) > 10:
+            msg += "; and %s more" % (len(failures) - 10)
+        LDAPError.__init__(self, "%s of %s ldap operations failed: %s" % (len(failures), total, msg))
+
+
+class LDAPServerError(LDAPError):
+    """
+    Raised when a write fails on some of its servers. results maps
+    every server tried to "success" or the error it hit, failed lists
+    the ones worth retrying
+    """
+    def __init__(self, results):
+        self.results = results
+        self.failed = sorted(s for s in results if results[s] != "success")
+        msg = "; ".join("%s: %s" % (s, results[s]) for s in self.failed)
+        LDAPError.__init__(self, "ldap write failed on %s" % msg)
+
+
+def ld_servers(cfg, server=None):
+    """
+    [description]
+    work out which servers an operation should go to
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+    optional:
+        server: a single server or a list of them. defaults to every
+                server in the ldap config
+
+    [return value]
+    returns a list of servers
+    """
+    if not server:
+        return list(cfg.ldap_servers)
+    if isinstance(server, basestring):
+        return [server]
+    return list(server)
+
+
+def ld_fanout(cfg, servers, func):
+    """
+    [description]
+    run func(server) against every server at once, in up to ldap_workers
+    threads. a failure on one server doesn't stop the others
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        servers: the servers to run against
+        func: takes a server, talks to it. LDAP errors are collected
+
+    [return value]
+    returns a dict of server: "success". raises LDAPServerError if any
+    server failed, with every server's outcome in it
+    """
+    def run(myserver):
+        try:
+            func(myserver)
+            return myserver, "success"
+        except (ldap.LDAPError, LDAPError), e:
+            cfg.log.debug("ldap write to %s failed: %s" % (myserver, e))
+            return myserver, str(e)
+
+    if len(servers) > 1:
+        workers = ThreadPool(min(len(servers), cfg.ldap_workers))
+        try:
+            outcomes = workers.map(run, servers)
+        finally:
+            workers.close()
+            workers.join()
+    else:
+        # no point in a thread for a single server
+        outcomes = [run(myserver) for myserver in servers]
+
+    results = dict(outcomes)
+    if [s for s in results if results[s] != "success"]:
+        raise LDAPServerError(results)
+    return results
+
+
+# the attributes vyvyan looks after on each kind of entry. reconciling
+# only reads these back, anything else on an entry is left alone
+USER_ATTRS = ['givenName', 'sn', 'gecos', 'cn', 'uid', 'uidNumber', 'gidNumber',
+              'homeDirectory', 'loginShell', 'mail', 'sshPublicKey']
+GROUP_ATTRS = ['description', 'cn', 'gidNumber', 'memberUid', 'member']
+NETGROUP_ATTRS = ['description', 'cn', 'nisNetgroupTriple']
+
+# short names we write that the server hands back under their long name
+ATTR_ALIASES = {'gn': 'givenname'}
+
+def ld_attrs(record):
+    """
+    [description]
+    normalise an entry's attributes so a record we'd write can be
+    compared with one read back from the server
+
+    [parameter info]
+    required:
+        record: a list of (attribute, value or list of values)
+
+    [return value]
+    returns a dict of lowercased attribute: sorted list of values.
+    objectClass and empty attributes are left out
+    """
+    attrs = {}
+    for attr, value in record:
+        name = attr.lower()
+        name = ATTR_ALIASES.get(name, name)
+        if value is None or name == 'objectclass':
+            continue
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        values = []
+        for v in value:
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            values.append(str(v))
+        attrs[name] = sorted(values)
+    return attrs
+
+
+def ld_domains(ldcon, ou):
+    """
+    [description]
+    find the domains that already have an ou=<ou> on the server, so
+    a refresh can clean out domains vyvyan no longer knows about
+
+    [parameter info]
+    required:
+        ldcon: a borrowed connection
+        ou: the ou to look for, eg. cfg.ldap_users_ou
+
+    [return value]
+    returns a set of domain names
+    """
+    domains = set()
+    contexts = []
+    for dn, attrs in ldcon.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['namingContexts']):
+        for attr, value in attrs.items():
+            if attr.lower() == 'namingcontexts':
+                contexts += value
+    for context in contexts:
+        try:
+            results = ldcon.search_s(context, ldap.SCOPE_SUBTREE, '(&(objectClass=organizationalUnit)(ou=%s))' % ou, ['ou'])
+        except ldap.NO_SUCH_OBJECT:
+            continue
+        for dn, attrs in results:
+            # referrals come back without a dn
+            if not dn:
+                continue
+            # ou=<ou>,dc=example,dc=com is example.com's, anything
+            # deeper or off to the side isn't ours
+            parts = [p.strip() for p in dn.split(',')]
+            if parts[0].lower() != 'ou=%s' % ou.lower() or len(parts) < 2:
+                continue
+            if [p for p in parts[1:] if not p.lower().startswith('dc=')]:
+                continue
+            domains.add('.'.join([p[3:] for p in parts[1:]]).lower())
+    return domains
+
+
+def ld_plan(ldcon, base, search, attrlist, wanted):
+    """
+    [description]
+    work out the writes that bring the entries under base in line with
+    what they should be. reads the managed attributes only, writes nothing
+
+    [parameter info]
+    required:
+        ldcon: a borrowed connection
+        base: the dn to search under
+        search: filter matching the entries vyvyan owns there
+        attrlist: the attributes vyvyan looks after on those entries
+        wanted: a list of (dn, add record) for the entries that should exist
+
+    [return value]
+    returns a dict of 'add': [(dn, record)], 'modify': [(dn, modlist)]
+    and 'delete': [dn]
+    """
+    plan = {'add': [], 'modify': [], 'delete': []}
+
+    # what's there now, keyed on the lowercased dn
+    current = {}
+    try:
+        results = ldcon.search_s(base, ldap.SCOPE_SUBTREE, search, attrlist)
+    except ldap.NO_SUCH_OBJECT:
+        # no ou yet, so nothing in it
+        results = []
+    for dn, attrs in results:
+        # referrals come back without a dn
+        if dn:
+            current[dn.lower()] = (dn, ld_attrs(attrs.items()))
+
+    for dn, record in wanted:
+        if dn.lower() not in current:
+            plan['add'].append((dn, [(a, v) for a, v in record if v is not None]))
+            continue
+        have = current.pop(dn.lower())[1]
+        want = ld_attrs(record)
+        modlist = []
+        for attr in sorted(want):
+            if have.get(attr) != want[attr]:
+                modlist.append((ldap.MOD_REPLACE, attr, want[attr]))
+        for attr in sorted(have):
+            if attr not in want:
+                modlist.append((ldap.MOD_DELETE, attr, None))
+        if modlist:
+            plan['modify'].append((dn, modlist))
+
+    # whatever is left over shouldn't be there
+    for key in sorted(current):
+        plan['delete'].append(current[key][0])
+    return plan
+
+
+def ld_errstr(e):
+    """
+    [description]
+    pull a readable message out of a python-ldap error
+
+    [parameter info]
+    required:
+        e: the ldap.LDAPError
+
+    [return value]
+    returns the message
+    """
+    if e.args and isinstance(e.args[0], dict):
+        err = e.args[0]
+        if err.get('info'):
+            return "%s (%s)" % (err.get('desc'), err['info'])
+        return str(err.get('desc'))
+    return str(e)
+
+
+def ld_apply(cfg, ldcon, plan):
+    """
+    [description]
+    carry out a plan from ld_plan. the operations are pipelined: up to
+    ldap_window of them are sent before waiting on the oldest, so the
+    run isn't one round trip per entry. adds and modifies are sent
+    first, so an entry is never missing while it's being put right. a
+    failed operation doesn't stop the rest
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        ldcon: a borrowed connection
+        plan: the plan from ld_plan
+
+    [return value]
+    no explicit return. raises LDAPBulkError naming the dn behind every
+    operation that failed
+    """
+    ops = [('add', dn, record) for dn, record in plan['add']]
+    ops += [('modify', dn, modlist) for dn, modlist in plan['modify']]
+    ops += [('delete', dn, None) for dn in plan['delete']]
+
+    pending = collections.deque()
+    failures = []
+
+    def collect():
+        # results are picked up oldest first, by message id, which
+        # ties any error to its dn whatever python-ldap version this is
+        op, dn, msgid = pending.popleft()
+        try:
+            ldcon.result(msgid)
+        except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT):
+            # the connection is gone, and with it the rest of the window
+            raise
+        except ldap.LDAPError, e:
+            cfg.log.debug("ldap %s of %s failed: %s" % (op, dn, ld_errstr(e)))
+            failures.append((op, dn, ld_errstr(e)))
+
+    for op, dn, arg in ops:
+        if op == 'add':
+            msgid = ldcon.add(dn, arg)
+        elif op == 'modify':
+            msgid = ldcon.modify(dn, arg)
+        else:
+            msgid = ldcon.delete(dn)
+        pending.append((op, dn, msgid))
+        if len(pending) >= cfg.ldap_window:
+            collect()
+    while pending:
+        collect()
+
+    if failures:
+        raise LDAPBulkError(failures, len(ops))
+
+
+def ld_report(server, plan, dry_run):
+    """
+    [description]
+    print what a reconcile did, or with dry_run what it would do
+
+    [parameter info]
+    required:
+        server: the server the plan is for
+        plan: the plan from ld_plan
+        dry_run: list every operation, not just the counts
+
+    [return value]
+    no explicit return
+    """
+    # one write per server, the servers are reconciled side by side
+    # and separate prints would interleave
+    lines = []
+    if dry_run:
+        for dn, record in plan['add']:
+            lines.append("%s: add %s" % (server, dn))
+        for dn, modlist in plan['modify']:
+            lines.append("%s: modify %s (%s)" % (server, dn, ', '.join(m[1] for m in modlist)))
+        for dn in plan['delete']:
+            lines.append("%s: delete %s" % (server, dn))
+        verb = "would make"
+    else:
+        verb = "made"
+    lines.append("%s: %s %s adds, %s modifies, %s deletes" % (server, verb,
+                 len(plan['add']), len(plan['modify']), len(plan['delete'])))
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+def user_record(cfg, user):
+    """
+    [description]
+    stitch together the LDAP entry for a user
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        user: the ORM user object
+
+    [return value]
+    returns the dn and the add record
+    """
+    # construct an array made of the domain parts, stitch it back together in a way
+    # that LDAP will understand
+    domain_parts = user.domain.split('.')
+    dn = "uid=%s,ou=%s,dc=" % (user.username, cfg.ldap_users_ou)
+    dn += ',dc='.join(domain_parts)
+
+    add_record = [('objectclass', ['inetOrgPerson','person','ldapPublicKey','posixAccount'])]
+    full_name = user.first_name + " " + user.last_name
+    if user.ssh_public_key:
+        attributes = [('gn', user.first_name),
+                      ('sn', user.last_name),
+                      ('gecos', full_name),
+                      ('cn', full_name),
+                      ('uid', user.username),
+                      ('uidNumber', str(user.uid)),
+                      ('gidNumber', cfg.ldap_default_gid),
+                      ('homeDirectory', user.hdir),
+                      ('loginShell', user.shell),
+                      ('mail', user.email),
+                      ('sshPublicKey', user.ssh_public_key),
+                     ]
+    else:
+        attributes = [('gn', user.first_name),
+                      ('sn', user.last_name),
+                      ('gecos', full_name),
+                      ('cn', full_name),
+                      ('uid', user.username),
+                      ('uidNumber', str(user.uid)),
+                      ('gidNumber', cfg.ldap_default_gid),
+                      ('homeDirectory', user.hdir),
+                      ('loginShell', user.shell),
+                      ('mail', user.email),
+                     ]
+    add_record += attributes
+
+    return dn, add_record
+
+
 def uadd(cfg, user, server=None):
     """
     [description]
@@ -70,10 +672,11 @@ def uadd(cfg, user, server=None):
         cfg: the config object. useful everywhere
         user: the ORM user object
     optional: 
-        server: restrict activity to a single server
+        server: restrict activity to a single server, or a list of them
 
     [return value]
-    returns "success"
+    returns a dict of server: "success". raises LDAPServerError if
+    any server failed
     """
     # just checking....
     if user:
@@ -82,64 +685,16 @@ def uadd(cfg, user, server=None):
     else:
         raise LDAPError("empty ORM object passed for user")
 
-    # stitch together the LDAP, fire it into the ldap master server 
-    try:
-        # construct an array made of the domain parts, stitch it back together in a way
-        # that LDAP will understand
-        domain_parts = user.domain.split('.')
-        dn = "uid=%s,ou=%s,dc=" % (user.username, cfg.ldap_users_ou)
-        dn += ',dc='.join(domain_parts)
-
-        add_record = [('objectclass', ['inetOrgPerson','person','ldapPublicKey','posixAccount'])]
-        full_name = user.first_name + " " + user.last_name
-        if user.ssh_public_key:
-            attributes = [('gn', user.first_name),
-                          ('sn', user.last_name),
-                          ('gecos', full_name),
-                          ('cn', full_name),
-                          ('uid', user.username),
-                          ('uidNumber', str(user.uid)),
-                          ('gidNumber', cfg.ldap_default_gid),
-                          ('homeDirectory', user.hdir),
-                          ('loginShell', user.shell),
-                          ('mail', user.email),
-                          ('sshPublicKey', user.ssh_public_key),
-                         ]
-        else:
-            attributes = [('gn', user.first_name),
-                          ('sn', user.last_name),
-                          ('gecos', full_name),
-                          ('cn', full_name),
-                          ('uid', user.username),
-                          ('uidNumber', str(user.uid)),
-                          ('gidNumber', cfg.ldap_default_gid),
-                          ('homeDirectory', user.hdir),
-                          ('loginShell', user.shell),
-                          ('mail', user.email),
-                         ]
-        add_record += attributes
-
-        # connect to ldap server(s) and do stuff
-        if server:
-          servers = [server]
-        else:
-          servers = cfg.ldap_servers
-    
-        for myserver in servers:
-            # create a connection to the server 
-            ldcon = ld_connect(cfg, myserver)
-                print "adding ldap user entry for user %s to domain %s" % (user.username, user.domain)
-                ldcon.add_s(dn,add_record)
-            except ldap.LDAPError, e:
-                # don't leave dangling connections
-                ldcon.unbind()
-                raise LDAPError(e)
-            # close the LDAP connection
-            ldcon.unbind()
-        # give something back to the community
-        return "success" 
-    except ldap.LDAPError, e:
-        raise LDAPError(e)
+    dn, add_record = user_record(cfg, user)
+
+    def write(myserver):
+        # borrow a connection to the server
+        with ld_borrow(cfg, myserver) as ldcon:
+            print "adding ldap user entry for user %s to domain %s on %s" % (user.username, user.domain, myserver)
+            ldcon.add_s(dn,add_record)
+
+    # connect to ldap server(s) and do stuff
+    return ld_fanout(cfg, ld_servers(cfg, server), write)
 
 
 def uremove(cfg, user, server=None):
@@ -152,106 +707,81 @@ def uremove(cfg, user, server=None):
         cfg: the config object. useful everywhere
         user: the ORM user object
     optional: 
-        server: restrict activity to a single server
+        server: restrict activity to a single server, or a list of them
 
     [return value]
-    returns "success" 
+    returns a dict of server: "success". raises LDAPServerError if
+    any server failed
     """
     # just checking...
     if not user:
         raise LDAPError("empty ORM object passed for user")
 
-    # do the needful
-    try:
-        # construct an array made of the domain parts, stitch it back together in a way
-        # that LDAP will understand
-        domain_parts = user.domain.split('.')
-        udn = "uid=%s,ou=%s,dc=" % (user.username, cfg.ldap_users_ou)
-        udn += ',dc='.join(domain_parts)
-
-        # connect to ldap server(s) and do stuff
-        if server:
-          servers = [server]
-        else:
-          servers = cfg.ldap_servers
-        for server in cfg.servers:
-            # create a connection to the server
-            ldcon = ld_connect(cfg, server)
+    # construct an array made of the domain parts, stitch it back together in a way
+    # that LDAP will understand
+    domain_parts = user.domain.split('.')
+    udn = "uid=%s,ou=%s,dc=" % (user.username, cfg.ldap_users_ou)
+    udn += ',dc='.join(domain_parts)
+
+    def write(myserver):
+        # borrow a connection to the server
+        with ld_borrow(cfg, myserver) as ldcon:
             ldcon.delete_s(udn)
-            ldcon.unbind()
 
-        # give something back to the community
-        return "success" 
-    except ldap.LDAPError, e:
-        ldcon.unbind()
-        raise LDAPError(e)
+    # connect to ldap server(s) and do stuff
+    return ld_fanout(cfg, ld_servers(cfg, server), write)
 
 
-def urefresh_all(cfg, server=None):
+def urefresh_all(cfg, server=None, dry_run=False):
     """
     [description]
-    refresh the LDAP users database. drop all users, add them back in again
+    bring the LDAP users database in line with vyvyan. entries are added,
+    modified or deleted only where they differ, the rest are left alone.
+    each server is reconciled in its own worker
 
     [parameter info]
     required:
         cfg: the config object. useful everywhere
     optional: 
-        server: restrict activity to a single server
+        server: restrict activity to a single server, or a list of them
+        dry_run: print the plan and its counts, change nothing
 
     [return value]
-    returns "success" 
+    returns a dict of server: "success". raises LDAPServerError if
+    any server failed
     """
-    # some vars we'll need later
-    domainlist = []
-    ulist = []
-    userlist = []
-
-    # do the needful
-    try:
-        # construct our user list
-        for user in cfg.dbsess.query(Users).\
-        filter(Users.active==True).all():
-            userlist.append(user)
-            if user.domain not in domainlist:
-                domainlist.append(user.domain)
-
-        # suss out the server situation
-        if server:
-            servers = [server]
-        else:
-            servers = cfg.ldap_servers
-
-        # connect to ldap server(s) and do stuff
-        for myserver in servers:
-            for domain in domainlist:
+    # the entries that should exist, by domain. inactive users
+    # aren't in here so they get deleted
+    wanted = {}
+    for user in cfg.dbsess.query(Users).\
+    filter(Users.active==True).all():
+        wanted.setdefault(user.domain, []).append(user_record(cfg, user))
+
+    # every registered domain is reconciled, even with nobody in it
+    domains = set([d.domain for d in cfg.dbsess.query(Domains).all()])
+
+    def write(myserver):
+        plan = {'add': [], 'modify': [], 'delete': []}
+        # borrow a connection to the server
+        with ld_borrow(cfg, myserver) as ldcon:
+            # along with the ones the server has that we've since dropped
+            for domain in sorted(domains | ld_domains(ldcon, cfg.ldap_users_ou)):
                 # make an array of the domain parts. stitch it back together in a way
                 # ldap will understand
                 domain_parts = domain.split('.')
                 udn ="ou=%s,dc=" % cfg.ldap_users_ou
                 udn += ',dc='.join(domain_parts)
 
-                # create a connection to the server
-                ldcon = ld_connect(cfg, myserver)
-                search = '(objectClass=person)'
-
-                # ALL USERS BALEETED
-                for result in ldcon.search_s(udn, ldap.SCOPE_SUBTREE, search):
-                    ldcon.delete_s(result[0])
+                dplan = ld_plan(ldcon, udn, '(objectClass=person)', USER_ATTRS, wanted.get(domain, []))
+                for op in plan:
+                    plan[op] += dplan[op]
+            # every domain's writes go down in one pipelined run
+            if not dry_run:
+                ld_apply(cfg, ldcon, plan)
+        ld_report(myserver, plan, dry_run)
 
-                # unbind thyself
-                ldcon.unbind()
-
-                # add the users back in
-                for user in userlist:
-                    uadd(cfg, user, server=myserver)
-
-        # give something back to the community
-        return "success" 
-
-    # something horrible has happened.
-    except ldap.LDAPError, e:
-        ldcon.unbind()
-        raise LDAPError(e)
+    # connect to ldap server(s) and do stuff
+    return ld_fanout(cfg, ld_servers(cfg, server), write)
 
 
 # we may get rid of this completely...
@@ -265,71 +795,157 @@ def uupdate(cfg, user, server=None):
         cfg: the config object. useful everywhere
         user: the ORM user object
     optional: 
-        server: restrict activity to a single server
+        server: restrict activity to a single server, or a list of them
 
     [return value]
-    no explicit return 
+    returns a dict of server: "success". raises LDAPServerError if
+    any server failed
     """
-    try:
-        # construct an array made of the domain parts, stitch it back together in a way
-        # that LDAP will understand
-        domain_parts = user.domain.split('.')
-        dn = "uid=%s,ou=%s,dc=" % (user.username, cfg.ldap_users_ou)
-        dn += ',dc='.join(domain_parts)
-    
-        # we only really care about active users
-        if not user.active:
-            raise LDAPError("user %s is not active. please set the user active, first." % u.username)
-    
-        # connect ldap server(s) and do stuff
-        if server:
-            servers = [server]
-        else:
-            servers = cfg.ldap_servers
-
-        # stitch together the LDAP, fire it into the ldap master server 
-        full_name = user.first_name + " " + user.last_name
-        if user.ssh_public_key:
-            mod_record = [(ldap.MOD_REPLACE, 'gn', user.first_name),
-                          (ldap.MOD_REPLACE, 'sn', user.last_name),
-                          (ldap.MOD_REPLACE, 'gecos', full_name),
-                          (ldap.MOD_REPLACE, 'cn', full_name),
-                          (ldap.MOD_REPLACE, 'uidNumber', str(user.uid)),
-                          (ldap.MOD_REPLACE, 'gidNumber', cfg.ldap_default_gid),
-                          (ldap.MOD_REPLACE, 'homeDirectory', user.hdir),
-                          (ldap.MOD_REPLACE, 'loginShell', user.shell),
-                          (ldap.MOD_REPLACE, 'mail', user.email),
-                          (ldap.MOD_REPLACE, 'sshPublicKey', user.ssh_public_key),
-                         ]
-        else:
-            mod_record = [(ldap.MOD_REPLACE, 'gn', user.first_name),
-                          (ldap.MOD_REPLACE, 'sn', user.last_name),
-                          (ldap.MOD_REPLACE, 'gecos', full_name),
-                          (ldap.MOD_REPLACE, 'cn', full_name),
-                          (ldap.MOD_REPLACE, 'uidNumber', str(user.uid)),
-                          (ldap.MOD_REPLACE, 'gidNumber', cfg.ldap_default_gid),
-                          (ldap.MOD_REPLACE, 'homeDirectory', user.hdir),
-                          (ldap.MOD_REPLACE, 'loginShell', user.shell),
-                          (ldap.MOD_REPLACE, 'mail', user.email),
-                         ]
-
-        # do the needful, once for each server in the array 
-        for myserver in servers:
-
-            # create a connection to the server
-            ldcon = ld_connect(cfg, myserver)
-                print "updating ldap user entry for user %s on domain %s" % (user.username, user.domain)
-                ldcon.modify_s(dn, mod_record)
-
-            # close the LDAP connection
-            ldcon.unbind()
-
-        # give something back to the community
-        return "success"
+    # construct an array made of the domain parts, stitch it back together in a way
+    # that LDAP will understand
+    domain_parts = user.domain.split('.')
+    dn = "uid=%s,ou=%s,dc=" % (user.username, cfg.ldap_users_ou)
+    dn += ',dc='.join(domain_parts)
+
+    # we only really care about active users
+    if not user.active:
+        raise LDAPError("user %s is not active. please set the user active, first." % user.username)
+
+    # stitch together the LDAP, fire it into the ldap servers
+    full_name = user.first_name + " " + user.last_name
+    if user.ssh_public_key:
+        mod_record = [(ldap.MOD_REPLACE, 'gn', user.first_name),
+                      (ldap.MOD_REPLACE, 'sn', user.last_name),
+                      (ldap.MOD_REPLACE, 'gecos', full_name),
+                      (ldap.MOD_REPLACE, 'cn', full_name),
+                      (ldap.MOD_REPLACE, 'uidNumber', str(user.uid)),
+                      (ldap.MOD_REPLACE, 'gidNumber', cfg.ldap_default_gid),
+                      (ldap.MOD_REPLACE, 'homeDirectory', user.hdir),
+                      (ldap.MOD_REPLACE, 'loginShell', user.shell),
+                      (ldap.MOD_REPLACE, 'mail', user.email),
+                      (ldap.MOD_REPLACE, 'sshPublicKey', user.ssh_public_key),
+                     ]
+    else:
+        mod_record = [(ldap.MOD_REPLACE, 'gn', user.first_name),
+                      (ldap.MOD_REPLACE, 'sn', user.last_name),
+                      (ldap.MOD_REPLACE, 'gecos', full_name),
+                      (ldap.MOD_REPLACE, 'cn', full_name),
+                      (ldap.MOD_REPLACE, 'uidNumber', str(user.uid)),
+                      (ldap.MOD_REPLACE, 'gidNumber', cfg.ldap_default_gid),
+                      (ldap.MOD_REPLACE, 'homeDirectory', user.hdir),
+                      (ldap.MOD_REPLACE, 'loginShell', user.shell),
+                      (ldap.MOD_REPLACE, 'mail', user.email),
+                     ]
+
+    def write(myserver):
+        # borrow a connection to the server
+        with ld_borrow(cfg, myserver) as ldcon:
+            print "updating ldap user entry for user %s on domain %s on %s" % (user.username, user.domain, myserver)
+            ldcon.modify_s(dn, mod_record)
+
+    # do the needful, once for each server in the array 
+    return ld_fanout(cfg, ld_servers(cfg, server), write)
+
+
+def group_records(cfg, group, members=None):
+    """
+    [description]
+    work out the dns and member lists of a group's posixGroup and
+    nisNetgroup entries
 
-    except ldap.LDAPError, e:
-        ldcon.unbind()
-        raise LDAPError(e)
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        group: the ORM group object
+    optional:
+        members: the usernames in the group, if the caller already has
+                 them. otherwise they're loaded through group.users
+
+    [return value]
+    returns gdn, ngdn, memberoflist, memberlist, netgrouplist
+    """
+    if not group:
+        raise LDAPError("group object not supplied, aborting")
+
+    # construct an array made of the domain parts, stitch it back together in a way
+    # that LDAP will understand to create our group
+    domain_parts = group.domain.split('.')
+    gdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_groups_ou)
+    gdn += ',dc='.join(domain_parts)
+    ngdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_netgroups_ou)
+    ngdn += ',dc='.join(domain_parts)
+
+    # construct the list of users in this group three ways
+    # ACHTUNG: we may not need both memberlist and memberoflist. test this!
+    memberoflist = [] # groupOfNames stylee
+    memberlist = [] # posixGroup steez
+    netgrouplist = [] # nisNetgroups are still a thing?
+    # iterate over all users assigned to this group. group.users
+    # loads the lot in one query
+    if members is None:
+        members = [user.username for user in group.users]
+    for username in members:
+        # construct the memberOf list for groupOfNames
+        memberoflist.append(username)
+        # construct the member list for posixGroup
+        ldap_user_dn = "uid=%s,ou=%s,dc=" % (username, cfg.ldap_groups_ou)
+        ldap_user_dn += ',dc='.join(domain_parts)
+        memberlist.append(ldap_user_dn)
+        # construct the netgroup list for nisNetgroup
+        netgrouplist.append("(-,%s,)" % username)
+
+    return gdn, ngdn, memberoflist, memberlist, netgrouplist
+
+
+def group_add_records(cfg, group, members=None):
+    """
+    [description]
+    stitch together the posixGroup and nisNetgroup entries for a group
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        group: the ORM group object
+    optional:
+        members: the usernames in the group, see group_records
+
+    [return value]
+    returns the group dn, its add record, the netgroup dn and its add record
+    """
+    gdn, ngdn, memberoflist, memberlist, netgrouplist = group_records(cfg, group, members)
+
+    # construct the Group record to add 
+    g_add_record = [('objectClass', ['top', 'posixGroup', 'groupOfNames'])]
+    if memberoflist:
+        g_attributes = [('description', group.description),
+                       ('cn', group.groupname),
+                       ('gidNumber', str(group.gid)),
+                       ('memberUid', memberoflist),
+                       ('member', memberlist),
+                      ]
+    else:
+        g_attributes = [('description', group.description),
+                       ('cn', group.groupname),
+                       ('gidNumber', str(group.gid)),
+                      ]
+
+    # construct the nisNetgroup record to add 
+    ng_add_record = [('objectClass', ['top', 'nisNetgroup'])]
+    if netgrouplist:
+        ng_attributes = [('description', group.description),
+                       ('cn', group.groupname),
+                       ('nisNetgroupTriple', netgrouplist),
+                      ]
+    else:
+        ng_attributes = [('description', group.description),
+                       ('cn', group.groupname),
+                      ]
+
+    # stitch the records together
+    g_add_record += g_attributes
+    ng_add_record += ng_attributes
+
+    return gdn, g_add_record, ngdn, ng_add_record
 
 
 def gadd(cfg, group, server=None):
@@ -342,98 +958,27 @@ def gadd(cfg, group, server=None):
         cfg: the config object. useful everywhere
         group: the ORM group object
     optional: 
-        server: restrict activity to a single server
+        server: restrict activity to a single server, or a list of them
 
     [return value]
-    returns "success"
+    returns a dict of server: "success". raises LDAPServerError if
+    any server failed
     """
-    try:
-        if group:
-            # construct an array made of the domain parts, stitch it back together in a way
-            # that LDAP will understand to create our group
-            domain_parts = group.domain.split('.')
-            gdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_groups_ou)
-            gdn += ',dc='.join(domain_parts)
-            ngdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_netgroups_ou)
-            ngdn += ',dc='.join(domain_parts)
+    gdn, g_add_record, ngdn, ng_add_record = group_add_records(cfg, group)
 
-            # construct the list of users in this group three ways
-            # ACHTUNG: we may not need both memberlist and memberoflist. test this!
-            memberoflist = [] # groupOfNames stylee
-            memberlist = [] # posixGroup steez
-            netgrouplist = [] # nisNetgroups are still a thing?
-            # iterate over all users assigned to this group
-            for ugmap in cfg.dbsess.query(UserGroupMapping).\
-                    filter(UserGroupMapping.groups_id==group.id):
-                user = cfg.dbsess.query(Users).\
-                filter(Users.id==ugmap.users_id).first()
-                # construct the memberOf list for groupOfNames
-                memberoflist.append(user.username)
-                # construct the member list for posixGroup
-                ldap_user_dn = "uid=%s,ou=%s,dc=" % (user.username, cfg.ldap_groups_ou)
-                ldap_user_dn += ',dc='.join(domain_parts)
-                memberlist.append(ldap_user_dn)
-                # construct the netgroup list for nisNetgroup
-                netgrouplist.append("(-,%s,)" % user.username)
-        else:
-            raise LDAPError("group object not supplied, aborting")
-    
-        # connect ldap server(s) and do stuff
-        if server:
-            servers = [server]
-        else:
-            servers = cfg.ldap_servers
-    
-        for myserver in servers:
-            # construct the Group record to add 
-            g_add_record = [('objectClass', ['top', 'posixGroup', 'groupOfNames'])]
-            if memberoflist:
-                g_attributes = [('description', group.description),
-                               ('cn', group.groupname),
-                               ('gidNumber', str(group.gid)),
-                               ('memberUid', memberoflist),
-                               ('member', memberlist),
-                              ]
-            else:
-                g_attributes = [('description', group.description),
-                               ('cn', group.groupname),
-                               ('gidNumber', str(group.gid)),
-                              ]
-
-            # construct the nisNetgroup record to add 
-            g_add_record = [('objectClass', ['top', 'nisNetgroup'])]
-            if netgrouplist:
-                ng_attributes = [('description', group.description),
-                               ('cn', group.groupname),
-                               ('nisNetgroupTriple', netgrouplist),
-                              ]
-            else:
-                ng_attributes = [('description', group.description),
-                               ('cn', group.groupname),
-                              ]
-
-            # stitch the records together
-            g_add_record += g_attributes
-            ng_add_record += ng_attributes
-
-            # create a connection to the ldap server
-            ldcon = ld_connect(cfg, myserver)
-   
+    def write(myserver):
+        # borrow a connection to the ldap server
+        with ld_borrow(cfg, myserver) as ldcon:
             # talk about our feelings
-            print "adding ldap Group record for %s" % (gdn)
-            print "adding ldap nisNetgroup record for %s" % (ngdn)
+            print "adding ldap Group record for %s on %s" % (gdn, myserver)
+            print "adding ldap nisNetgroup record for %s on %s" % (ngdn, myserver)
 
             # slam the records into the server
             ldcon.add_s(gdn, g_add_record)
             ldcon.add_s(ngdn, ng_add_record)
-            ldcon.unbind()
-    
-        # give something back to the community
-        return "success"
 
-    except ldap.LDAPError, e:
-        ldcon.unbind()
-        raise LDAPError(e)
+    # connect ldap server(s) and do stuff
+    return ld_fanout(cfg, ld_servers(cfg, server), write)
 
 
 def gupdate(cfg, group, server=None):
@@ -446,88 +991,48 @@ def gupdate(cfg, group, server=None):
         cfg: the config object. useful everywhere
         group: the ORM group object
     optional: 
-        server: restrict activity to a single server
+        server: restrict activity to a single server, or a list of them
 
     [return value]
-    returns "success"
+    returns a dict of server: "success". raises LDAPServerError if
+    any server failed
     """
-    try:
-        if group:
-            # construct an array made of the domain parts, stitch it back together in a way
-            # that LDAP will understand to create our group
-            domain_parts = group.domain.split('.')
-            gdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_groups_ou)
-            gdn += ',dc='.join(domain_parts)
-            ngdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_netgroups_ou)
-            ngdn += ',dc='.join(domain_parts)
-
-            # construct the list of users in this group three ways
-            # ACHTUNG: we may not need both memberlist and memberoflist. test this!
-            memberoflist = [] # groupOfNames stylee
-            memberlist = [] # posixGroup steez
-            netgrouplist = [] # nisNetgroups are still a thing?
-            # iterate over all users assigned to this group
-            for ugmap in cfg.dbsess.query(UserGroupMapping).\
-                    filter(UserGroupMapping.groups_id==group.id):
-                user = cfg.dbsess.query(Users).\
-                filter(Users.id==ugmap.users_id).first()
-                # construct the memberOf list for groupOfNames
-                memberoflist.append(user.username)
-                # construct the member list for posixGroup
-                ldap_user_dn = "uid=%s,ou=%s,dc=" % (user.username, cfg.ldap_groups_ou)
-                ldap_user_dn += ',dc='.join(domain_parts)
-                memberlist.append(ldap_user_dn)
-                # construct the netgroup list for nisNetgroup
-                netgrouplist.append("(-,%s,)" % user.username)
-        else:
-            raise LDAPError("group object not supplied, aborting")
-    
-        # connect ldap server(s) and do stuff
-        if server:
-            servers = [server]
-        else:
-            servers = cfg.ldap_servers
-   
-        for myserver in servers:
-            # construct the Group record to add 
-            if memberoflist:
-                g_attributes = [(ldap.MOD_REPLACE, 'description', group.description),
-                                (ldap.MOD_REPLACE, 'gidNumber', str(group.gid)),
-                                (ldap.MOD_REPLACE, 'memberUid', memberoflist),
-                                (ldap.MOD_REPLACE, 'member', memberlist),
-                               ]
-            else:
-                g_attributes = [(ldap.MOD_REPLACE, 'description', group.description),
-                                (ldap.MOD_REPLACE, 'gidNumber', str(group.gid)),
-                               ]
-
-            # construct the nisNetgroup record to add 
-            if netgrouplist:
-                ng_attributes = [(ldap.MOD_REPLACE, 'description', group.description),
-                                 (ldap.MOD_REPLACE, 'nisNetgroupTriple', netgrouplist),
-                               ]
-            else:
-                ng_attributes = [(ldap.MOD_REPLACE, 'description', group.description),
-                               ]
+    gdn, ngdn, memberoflist, memberlist, netgrouplist = group_records(cfg, group)
+
+    # construct the Group record to update
+    if memberoflist:
+        g_attributes = [(ldap.MOD_REPLACE, 'description', group.description),
+                        (ldap.MOD_REPLACE, 'gidNumber', str(group.gid)),
+                        (ldap.MOD_REPLACE, 'memberUid', memberoflist),
+                        (ldap.MOD_REPLACE, 'member', memberlist),
+                       ]
+    else:
+        g_attributes = [(ldap.MOD_REPLACE, 'description', group.description),
+                        (ldap.MOD_REPLACE, 'gidNumber', str(group.gid)),
+                       ]
+
+    # construct the nisNetgroup record to update
+    if netgrouplist:
+        ng_attributes = [(ldap.MOD_REPLACE, 'description', group.description),
+                         (ldap.MOD_REPLACE, 'nisNetgroupTriple', netgrouplist),
+                       ]
+    else:
+        ng_attributes = [(ldap.MOD_REPLACE, 'description', group.description),
+                       ]
 
-            # create a connection to the ldap server
-            ldcon = ld_connect(cfg, myserver)
-   
+    def write(myserver):
+        # borrow a connection to the ldap server
+        with ld_borrow(cfg, myserver) as ldcon:
             # talk about our feelings
-            print "updating ldap Group record for %s" % (gdn)
-            print "updating ldap nisNetgroup record for %s" % (ngdn)
+            print "updating ldap Group record for %s on %s" % (gdn, myserver)
+            print "updating ldap nisNetgroup record for %s on %s" % (ngdn, myserver)
 
             # slam the records into the server
             ldcon.modify_s(gdn, g_attributes)
             ldcon.modify_s(ngdn, ng_attributes)
-            ldcon.unbind()
-    
-        # give something back to the community
-        return "success"
 
-    except ldap.LDAPError, e:
-        ldcon.unbind()
-        raise LDAPError(e)
+    # connect ldap server(s) and do stuff
+    return ld_fanout(cfg, ld_servers(cfg, server), write)
 
 
 def gremove(cfg, group, server=None):
@@ -540,87 +1045,83 @@ def gremove(cfg, group, server=None):
         cfg: the config object. useful everywhere
         group: the ORM group object
     optional: 
-        server: restrict activity to a single server
+        server: restrict activity to a single server, or a list of them
 
     [return value]
-    returns "success"
+    returns a dict of server: "success". raises LDAPServerError if
+    any server failed
     """
-    try:
-        if group:
-            # construct an array made of the domain parts, stitch it back together in a way
-            # that LDAP will understand to create our group
-            domain_parts = group.domain.split('.')
-            gdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_groups_ou)
-            gdn += ',dc='.join(domain_parts)
-            ngdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_netgroups_ou)
-            ngdn += ',dc='.join(domain_parts)
-        else:
-            raise LDAPError("group object not supplied, aborting")
-    
-        # connect ldap server(s) and do stuff
-        if server:
-            servers = [server]
-        else:
-            servers = cfg.ldap_servers
-   
-        for myserver in servers:
-            # create a connection to the ldap server
-            ldcon = ld_connect(cfg, myserver)
-   
+    if group:
+        # construct an array made of the domain parts, stitch it back together in a way
+        # that LDAP will understand to create our group
+        domain_parts = group.domain.split('.')
+        gdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_groups_ou)
+        gdn += ',dc='.join(domain_parts)
+        ngdn = "cn=%s,ou=%s,dc=" % (group.groupname, cfg.ldap_netgroups_ou)
+        ngdn += ',dc='.join(domain_parts)
+    else:
+        raise LDAPError("group object not supplied, aborting")
+
+    def write(myserver):
+        # borrow a connection to the ldap server
+        with ld_borrow(cfg, myserver) as ldcon:
             # talk about our feelings
-            print "removing ldap Group record for %s" % (gdn)
-            print "removing ldap nisNetgroup record for %s" % (ngdn)
+            print "removing ldap Group record for %s on %s" % (gdn, myserver)
+            print "removing ldap nisNetgroup record for %s on %s" % (ngdn, myserver)
 
             # slam the records into the server
             ldcon.delete_s(gdn)
             ldcon.delete_s(ngdn)
-            ldcon.unbind()
-    
-        # give something back to the community
-        return "success"
 
-    except ldap.LDAPError, e:
-        ldcon.unbind()
-        raise LDAPError(e)
+    # connect ldap server(s) and do stuff
+    return ld_fanout(cfg, ld_servers(cfg, server), write)
 
 
-def grefresh_all(cfg, server=None):
+def grefresh_all(cfg, server=None, dry_run=False):
     """
     [description]
-    refresh the LDAP groups database. drop all groups, add them back in again
+    bring the LDAP groups and netgroups in line with vyvyan. entries are
+    added, modified or deleted only where they differ, the rest are left
+    alone. each server is reconciled in its own worker
 
     [parameter info]
     required:
         cfg: the config object. useful everywhere
     optional: 
-        server: restrict activity to a single server
+        server: restrict activity to a single server, or a list of them
+        dry_run: print the plan and its counts, change nothing
 
     [return value]
-    returns "success" 
+    returns a dict of server: "success". raises LDAPServerError if
+    any server failed
     """
-    # some vars we'll need later
-    domainlist = []
-    glist = []
-    nglist = []
-    grouplist = []
-
-    # do the needful
-    try:
-        # construct our group list
-        for group in cfg.dbsess.query(Groups).all()
-            grouplist.append(group)
-            if group.domain not in domainlist:
-                domainlist.append(group.domain)
-
-        # suss out the server situation
-        if server:
-            servers = [server]
-        else:
-            servers = cfg.ldap_servers
-
-        # connect to ldap server(s) and do stuff
-        for myserver in servers:
-            for domain in domainlist:
+    # every membership in one query, as bare (group id, username)
+    # rows, rather than a Users object per member of every group
+    members = {}
+    for groups_id, username in cfg.dbsess.query(UserGroupMapping.groups_id, Users.username).\
+    filter(UserGroupMapping.users_id==Users.id).\
+    order_by(UserGroupMapping.groups_id, Users.username).all():
+        members.setdefault(groups_id, []).append(username)
+
+    # the entries that should exist, by domain, with the member lists
+    # built from the map above
+    groups_wanted = {}
+    netgroups_wanted = {}
+    for group in cfg.dbsess.query(Groups).all():
+        gdn, g_add_record, ngdn, ng_add_record = group_add_records(cfg, group, members.get(group.id, []))
+        groups_wanted.setdefault(group.domain, []).append((gdn, g_add_record))
+        netgroups_wanted.setdefault(group.domain, []).append((ngdn, ng_add_record))
+
+    # every registered domain is reconciled, even with nothing in it
+    domains = set([d.domain for d in cfg.dbsess.query(Domains).all()])
+
+    def write(myserver):
+        plan = {'add': [], 'modify': [], 'delete': []}
+        # borrow a connection to the server
+        with ld_borrow(cfg, myserver) as ldcon:
+            # along with the ones the server has that we've since dropped
+            ldomains = ld_domains(ldcon, cfg.ldap_groups_ou) | ld_domains(ldcon, cfg.ldap_netgroups_ou)
+            for domain in sorted(domains | ldomains):
                 # make an array of the domain parts. stitch it back together in a way
                 # ldap will understand
                 domain_parts = domain.split('.')
@@ -629,33 +1130,17 @@ def grefresh_all(cfg, server=None):
                 ngdn ="ou=%s,dc=" % cfg.ldap_netgroups_ou
                 ngdn += ',dc='.join(domain_parts)
 
-                # create a connection to the server
-                ldcon = ld_connect(cfg, myserver)
+                for dplan in (ld_plan(ldcon, gdn, '(objectClass=posixGroup)', GROUP_ATTRS, groups_wanted.get(domain, [])),
+                              ld_plan(ldcon, ngdn, '(objectClass=nisNetgroup)', NETGROUP_ATTRS, netgroups_wanted.get(domain, []))):
+                    for op in plan:
+                        plan[op] += dplan[op]
+            # every domain's writes go down in one pipelined run
+            if not dry_run:
+                ld_apply(cfg, ldcon, plan)
+        ld_report(myserver, plan, dry_run)
 
-                # ALL GROUPS BALEETED
-                search = '(objectClass=posixGroup)'
-                for result in ldcon.search_s(gdn, ldap.SCOPE_SUBTREE, search):
-                    ldcon.delete_s(result[0])
-
-                # ALL NETGROUPS BALEETED 
-                search = '(objectClass=nisNetgroup)'
-                for result in ldcon.search_s(ngdn, ldap.SCOPE_SUBTREE, search):
-                    ldcon.delete_s(result[0])
-
-                # unbind thyself
-                ldcon.unbind()
-
-                # add the groups back in
-                for group in grouplist:
-                    gadd(cfg, group, server=myserver)
-
-        # give something back to the community
-        return "success" 
-
-    # something horrible has happened.
-    except ldap.LDAPError, e:
-        ldcon.unbind()
-        raise LDAPError(e)
+    # connect to ldap server(s) and do stuff
+    return ld_fanout(cfg, ld_servers(cfg, server), write)
 
 
 def ldapimport(cfg, domain=None, server=None):
@@ -697,13 +1182,12 @@ def ldapimport(cfg, domain=None, server=None):
         # suss out the domain situation
         if not domain:
             # connect to ldap server and grab a list of all domains (ie. namingContext) 
-            ldcon = ld_connect(cfg, server)
-            search_filter = '(objectClass=namingContext)'
-            for result in ldcon.search_s('', ldap.SCOPE_BASE, search_filter, None):
-                # i kind of don't know that this will work. hopeful though.
-                # turn 'dc=' notation into a regular dotted domain
-                domainlist.append(result[1].replace(',dc=', '.').replace('dc=', ''))
-            ldcon.unbind()
+            with ld_borrow(cfg, server) as ldcon:
+                search_filter = '(objectClass=namingContext)'
+                for result in ldcon.search_s('', ldap.SCOPE_BASE, search_filter, None):
+                    # i kind of don't know that this will work. hopeful though.
+                    # turn 'dc=' notation into a regular dotted domain
+                    domainlist.append(result[1].replace(',dc=', '.').replace('dc=', ''))
         else:
             domainlist = [domain]
 
@@ -736,33 +1220,29 @@ def ldapimport(cfg, domain=None, server=None):
 
             
             # connect to ldap server and do stuff
-            ldcon = ld_connect(cfg, server)
-
-            # first, harvest groups
-            # don't know that we need this. keeping it here for posterity
-            #attr = ['memberUid', 'gidNumber', 'description', 'cn']
-            for result in ldcon.search_s(gdn, ldap.SCOPE_SUBTREE, '(objectClass=posixGroup)', None):
-                if result[1]:
-                    grouplist[domain].append(result[1])
-
-            # next, harvest netgroups
-            # TODO: do we need these?
-            for result in ldcon.search_s(ngdn, ldap.SCOPE_SUBTREE, '(objectClass=nisNetgroup)', None):
-                if result[1]:
-                    netgrouplist[domain].append(result[1])
-
-            # next, harvest users
-            for result in ldcon.search_s(udn, ldap.SCOPE_SUBTREE, '(objectClass=posixAccount)', None):
-                if result[1]:
-                    userlist[domain].append(result[1])
-
-            # finally, harvest sudoers info
-            for result in ldcon.search_s(sdn, ldap.SCOPE_SUBTREE, '(objectClass=sudoRole)', None):
-                if result[1]:
-                    sudoerslist[domain].append(result[1])
-
-            # clean up after ourselves
-            ldcon.unbind()
+            with ld_borrow(cfg, server) as ldcon:
+                # first, harvest groups
+                # don't know that we need this. keeping it here for posterity
+                #attr = ['memberUid', 'gidNumber', 'description', 'cn']
+                for result in ldcon.search_s(gdn, ldap.SCOPE_SUBTREE, '(objectClass=posixGroup)', None):
+                    if result[1]:
+                        grouplist[domain].append(result[1])
+
+                # next, harvest netgroups
+                # TODO: do we need these?
+                for result in ldcon.search_s(ngdn, ldap.SCOPE_SUBTREE, '(objectClass=nisNetgroup)', None):
+                    if result[1]:
+                        netgrouplist[domain].append(result[1])
+
+                # next, harvest users
+                for result in ldcon.search_s(udn, ldap.SCOPE_SUBTREE, '(objectClass=posixAccount)', None):
+                    if result[1]:
+                        userlist[domain].append(result[1])
+
+                # finally, harvest sudoers info
+                for result in ldcon.search_s(sdn, ldap.SCOPE_SUBTREE, '(objectClass=sudoRole)', None):
+                    if result[1]:
+                        sudoerslist[domain].append(result[1])
 
             # need to do a bunch of parsing and re-arranging of sudoers to hopefully
             # figure out what group needs what sudo commands and suchlike
@@ -818,142 +1298,9 @@ def ldapimport(cfg, domain=None, server=None):
 #MARK
 # this shit ain't nearly done
 
-
-                            # pull the user data out of the ldap schema
-                            username = result[0][1]['uid'][0]
-                            if result[0][1]['sshPublicKey']:
-                                # THIS SHOULD USE THE LIST VERSION, NOT A SINGLE MEMBER
-                                # in case they have multiple keys
-                                ssh_public_key = result[0][1]['sshPublicKey'][0]
-                            else:
-                                ssh_public_key = None
-                            uid = result[0][1]['uidNumber'][0]
-                            first_name, last_name = result[0][1]['gecos'][0].split(None, 1)
-                            hdir = result[0][1]['homeDirectory'][0]
-                            shell = result[0][1]['loginShell'][0]
-                            email = result[0][1]['mail'][0]
-                            # ldap doesn't store user type data so
-                            # use the default type
-                            user_type = cfg.def_user_type
-                            # create a new user object and fire it into
-                            # the db, face first.
-                            u = Users(first_name, last_name, ssh_public_key, username, site_id, realm, uid, user_type, hdir, shell, email, True)
-                            cfg.dbsess.add(u)
-                            cfg.dbsess.commit()
-                            # map the user we just created into the
-                            # group we're currently operating on
-                            ugmap = UserGroupMapping(g.id, u.id)
-                            cfg.dbsess.add(ugmap)
-                            cfg.dbsess.commit()
-                        else:
-                            print "User \"%s\" not created. The user is in a group in LDAP but does not actually exist in LDAP.\nMost likely this is a system user (such as \"nobody\" or \"apache\") that should not exist in LDAP." % user
-        # if the group doesn't exist, create it then map any users it
-        # may have into the vyvyan group definition
-        else:
-            groupname = result[1]['cn'][0]
-            print "group \"%s\" does not exist, creating from ldap info" % (groupname+'.'+fqn)
-            description = result[1]['description']
-            gid = int(result[1]['gidNumber'][0])
-            g = Groups(description, groupname, site_id, realm, gid)
-            cfg.dbsess.add(g)
-            cfg.dbsess.commit()
-            if userlist:
-                for user in userlist:
-                    u = vyvyan.validate.v_get_user_obj(cfg, user+'.'+fqn)
-                    if u:
-                        print "mapping user \"%s\" into group \"%s\"" % (u.username+'.'+fqn, groupname+'.'+fqn)
-                        ugmap = UserGroupMapping(g.id, u.id)
-                        cfg.dbsess.add(ugmap)
-                        cfg.dbsess.commit()
-                    else:
-                        # fetch user info from ldap, stuff into new
-                        # user, map user into group
-                        dn = "uid=%s,ou=%s,dc=" % (user, cfg.ldap_users_ou)
-                        dn += ',dc='.join(d)
-                        search = '(objectClass=person)'
-                        try:
-                            result = ldcon.search_s(dn, ldap.SCOPE_BASE, search)
-                        except ldap.LDAPError, e:
-                            print "Entity not found, skipping."
-                            print e
-                            result = False
-                        if result:
-                            # pull the user data out of the ldap schema
-                            username = result[0][1]['uid'][0]
-                            print "user \"%s\" does not exist, creating from ldap info and mapping into group \"%s\"" % (username+'.'+fqn, groupname+'.'+fqn)
-                            if result[0][1]['sshPublicKey']:
-                                ssh_public_key = result[0][1]['sshPublicKey'][0]
-                            else:
-                                ssh_public_key = None
-                            uid = result[0][1]['uidNumber'][0]
-                            first_name, last_name = result[0][1]['gecos'][0].split(None, 1)
-                            hdir = result[0][1]['homeDirectory'][0]
-                            shell = result[0][1]['loginShell'][0]
-                            email = result[0][1]['mail'][0]
-                            # ldap doesn't store user type data so
-                            # use the default type
-                            user_type = cfg.def_user_type
-                            # create a new user object and fire it into
-                            # the db, face first.
-                            u = Users(first_name, last_name, ssh_public_key, username, site_id, realm, uid, user_type, hdir, shell, email, True)
-                            cfg.dbsess.add(u)
-                            cfg.dbsess.commit()
-                            # map the user we just created into the
-                            # group we're currently operating on
-                            ugmap = UserGroupMapping(g.id, u.id)
-                            cfg.dbsess.add(ugmap)
-                            cfg.dbsess.commit()
-                        else:
-                            print "User \"%s\" not created. The user is in a group in LDAP but does not actually exist in LDAP.\nMost likely this is a system user (such as \"nobody\" or \"apache\") that should not exist in LDAP." % user
-    # now that we're done with the groups, let's go back in and make
-    # sure we create any leftover users that weren't in a group
-    dn = "ou=%s,dc=" % cfg.ldap_users_ou
-    dn += ',dc='.join(d)
-    search = '(objectClass=person)'
-    try:
-        results = ldcon.search_s(dn, ldap.SCOPE_BASE, search)
+    # something horrible has happened.
     except ldap.LDAPError, e:
-        print "Entity not found, skipping."
-        print e
-        results = False
-    if results:
-        for result in results:
-            username = result[0][1]['uid'][0]
-            u = vyvyan.validate.v_get_user_obj(cfg, username+'.'+fqn)
-            if u:
-                print "user exists, skipping"
-            else:
-                # create a new user object and fire it into
-                # the db, face first.
-                print "user \"%s\" does not exist, creating from ldap info" % (username+'.'+fqn)
-                if result[0][1]['sshPublicKey']:
-                    ssh_public_key = result[0][1]['sshPublicKey'][0]
-                else:
-                    ssh_public_key = None
-                uid = result[0][1]['uidNumber'][0]
-                first_name, last_name = result[0][1]['gecos'][0].split(None, 1)
-                hdir = result[0][1]['homeDirectory'][0]
-                shell = result[0][1]['loginShell'][0]
-                email = result[0][1]['mail'][0]
-                # ldap doesn't store user type data so
-                # use the default type
-                user_type = cfg.def_user_type
-                u = Users(first_name, last_name, ssh_public_key, username, site_id, realm, uid, user_type, hdir, shell, email, True)
-                cfg.dbsess.add(u)
-                cfg.dbsess.commit()
-                # map the user we just created into the
-                # group we're currently operating on
-                ugmap = UserGroupMapping(g.id, u.id)
-                cfg.dbsess.add(ugmap)
-                cfg.dbsess.commit()
-    else:
-        print "No users found!"
-
-
-
-
-
-
+        raise LDAPError(e)
 
 
 
@@ -985,19 +1332,15 @@ def update_ldap_passwd(cfg, username):
         dn += ',dc='.join(d)
     else:
         raise LDAPError("user \"%s\" not found, aborting" % username)
-    ldcon = ld_connect(cfg, ldap_master)
     try:
-        raw_res = ldcon.search_s(dn, ldap.SCOPE_BASE)
-        if 'userPassword' in raw_res[0][1].keys():
-            print 'User %s ALREADY has LDAP password set' % u.username
-        else:
-            print 'User %s does NOT have LDAP password set' % u.username
-        newpass = password_prompt(8,'sha1')
-        try:
+        with ld_borrow(cfg, ldap_master) as ldcon:
+            raw_res = ldcon.search_s(dn, ldap.SCOPE_BASE)
+            if 'userPassword' in raw_res[0][1].keys():
+                print 'User %s ALREADY has LDAP password set' % u.username
+            else:
+                print 'User %s does NOT have LDAP password set' % u.username
+            newpass = password_prompt(8,'sha1')
             ldcon.modify_s(dn, [(ldap.MOD_REPLACE, 'userPassword', newpass)])
-        except ldap.LDAPError, e:
-            raise LDAPError(e)
-        ldcon.unbind()
     except ldap.LDAPError, e:
         raise LDAPError(e)
 
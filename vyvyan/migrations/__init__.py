@@ -0,0 +1,443 @@
+# Copyright 2015 WebEffects Network, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+vyvyan.migrations
+
+versioned schema changes for the vyvyan database. every migration
+has a version number, the versions that have been applied are kept
+in the schema_version table. vyvyan_migrate.py applies them, the
+daemon only reports what's pending
+
+migrations must not use vyvyan_models, the models describe the schema
+as of the latest migration and not as of the one being run. tables
+are reflected from the database instead
+"""
+
+import datetime
+import sqlalchemy
+import sqlalchemy.engine.reflection
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, ForeignKey
+
+
+# our error class
+class MigrationError(Exception):
+    pass
+
+
+version_metadata = MetaData()
+schema_version = Table('schema_version', version_metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('description', String(200)),
+    Column('applied', DateTime),
+)
+
+
+def reflect_table(conn, name):
+    """
+    [description]
+    loads a table's definition from the database
+
+    [parameter info]
+    required:
+        conn: a connection to the vyvyan database
+        name: the table name
+
+    [return value]
+    returns a sqlalchemy Table
+    """
+    return Table(name, MetaData(), autoload=True, autoload_with=conn)
+
+
+def quote(conn, name):
+    """
+    [description]
+    quotes a table, column or constraint name for hand-written DDL
+    (groups is a reserved word as of mysql 8.0.2)
+
+    [parameter info]
+    required:
+        conn: a connection to the vyvyan database
+        name: the name to quote
+
+    [return value]
+    returns the quoted name
+    """
+    return conn.dialect.identifier_preparer.quote_identifier(name)
+
+
+def has_column(conn, table, column):
+    """
+    [description]
+    checks whether a table has a column. migrations before m005 look
+    for domain, which databases created from the current schema don't have
+
+    [parameter info]
+    required:
+        conn: a connection to the vyvyan database
+        table: the table name
+        column: the column name
+
+    [return value]
+    True/False
+    """
+    return column in reflect_table(conn, table).c
+
+
+def index_exists(conn, table, columns, unique=False):
+    """
+    [description]
+    looks for an index covering exactly these columns, in this order.
+    we go by columns rather than by name since older databases were
+    created by hand and their keys are called all sorts of things
+
+    [parameter info]
+    required:
+        conn: a connection to the vyvyan database
+        table: the table name
+        columns: list of column names
+    optional:
+        unique: only count unique indexes
+
+    [return value]
+    True/False
+    """
+    insp = sqlalchemy.engine.reflection.Inspector.from_engine(conn)
+    for idx in insp.get_indexes(table):
+        if list(idx['column_names']) == list(columns) and (idx['unique'] or not unique):
+            return True
+    # mysql and postgresql report the primary key separately
+    pk = insp.get_pk_constraint(table)
+    if pk and list(pk.get('constrained_columns', [])) == list(columns):
+        return True
+    return False
+
+
+def create_index(conn, name, table, columns, unique=False):
+    """
+    [description]
+    creates an index unless an equivalent one is already there
+
+    [parameter info]
+    required:
+        conn: a connection to the vyvyan database
+        name: what to call the index
+        table: the table name
+        columns: list of column names
+    optional:
+        unique: create a unique index
+
+    [return value]
+    True if the index was created, False if it already existed
+    """
+    if index_exists(conn, table, columns, unique):
+        return False
+    t = reflect_table(conn, table)
+    sqlalchemy.Index(name, *[t.c[c] for c in columns], **{'unique': unique}).create(bind=conn)
+    return True
+
+
+def find_duplicates(conn, table, columns):
+    """
+    [description]
+    finds rows that would stop a unique index on columns from being built
+
+    [parameter info]
+    required:
+        conn: a connection to the vyvyan database
+        table: the table name
+        columns: list of column names
+
+    [return value]
+    returns a list of the duplicated value tuples
+    """
+    t = reflect_table(conn, table)
+    cols = [t.c[c] for c in columns]
+    q = sqlalchemy.select(cols).group_by(*cols).having(sqlalchemy.func.count() > 1)
+    return [tuple(row) for row in conn.execute(q)]
+
+
+def m001_unique_ids(conn):
+    """
+    no two users (or groups) in a domain may share a uid (or gid). the
+    uid/gid allocator relies on these keys to settle races between workers
+    """
+    for table, column in (('users', 'uid'), ('groups', 'gid')):
+        # m005 puts the key on (domain_id, uid/gid) for newer schemas
+        if not has_column(conn, table, 'domain') or index_exists(conn, table, ['domain', column], unique=True):
+            continue
+        dups = find_duplicates(conn, table, ['domain', column])
+        if dups:
+            raise MigrationError("%s has duplicate %ss, fix these by hand and run the migration again: %s" % (table, column, ', '.join(["%s in %s" % (d[1], d[0]) for d in dups])))
+        create_index(conn, '%s_domain_%s' % (table, column), table, ['domain', column], unique=True)
+
+
+def m002_lookup_indexes(conn):
+    """
+    indexes for the lookups API_userdata and vyvyan.ldap actually do:
+    active users, mappings by user and by group, sudo commands by group.
+    duplicate user/group mappings are meaningless, extra copies are
+    dropped before the unique key goes on
+    """
+    create_index(conn, 'users_active', 'users', ['active'])
+
+    if not index_exists(conn, 'user_group_mapping', ['users_id', 'groups_id'], unique=True):
+        ugmap = reflect_table(conn, 'user_group_mapping')
+        for users_id, groups_id in find_duplicates(conn, 'user_group_mapping', ['users_id', 'groups_id']):
+            keep = conn.execute(sqlalchemy.select([sqlalchemy.func.min(ugmap.c.id)]).\
+                where(ugmap.c.users_id==users_id).\
+                where(ugmap.c.groups_id==groups_id)).scalar()
+            conn.execute(ugmap.delete().\
+                where(ugmap.c.users_id==users_id).\
+                where(ugmap.c.groups_id==groups_id).\
+                where(ugmap.c.id!=keep))
+        create_index(conn, 'user_group_mapping_users_groups', 'user_group_mapping', ['users_id', 'groups_id'], unique=True)
+    create_index(conn, 'user_group_mapping_groups_id', 'user_group_mapping', ['groups_id'])
+
+    create_index(conn, 'group_sudocommand_mapping_groups_sudo', 'group_sudocommand_mapping', ['groups_id', 'sudocommand'])
+
+
+def m003_listing_indexes(conn):
+    """
+    list_users and list_groups page through (domain, name) and filter on
+    type and shell. the primary keys run (name, domain), the wrong way
+    round to seek on a domain. uid ranges within a domain are already
+    covered by the (domain, uid) key from m001
+    """
+    if has_column(conn, 'users', 'domain'):
+        create_index(conn, 'users_domain_username', 'users', ['domain', 'username'], unique=True)
+    if has_column(conn, 'groups', 'domain'):
+        create_index(conn, 'groups_domain_groupname', 'groups', ['domain', 'groupname'], unique=True)
+    create_index(conn, 'users_type', 'users', ['type'])
+    create_index(conn, 'users_shell', 'users', ['shell'])
+
+
+def m004_domain_registry(conn):
+    """
+    a table of every domain with users or groups in it, kept up to date
+    by the API_userdata write paths so list_domains doesn't have to look
+    through users and groups. filled in from what's there now
+    """
+    domains = Table('domains', MetaData(),
+        Column('id', Integer, primary_key=True),
+        Column('domain', String(100), nullable=False, unique=True),
+    )
+    domains.create(bind=conn, checkfirst=True)
+    users = reflect_table(conn, 'users')
+    groups = reflect_table(conn, 'groups')
+    if 'domain' not in users.c or 'domain' not in groups.c:
+        # past m005, every domain in use is in the table by definition
+        return
+    registered = set([row[0] for row in conn.execute(sqlalchemy.select([domains.c.domain]))])
+    found = conn.execute(sqlalchemy.union(sqlalchemy.select([users.c.domain]), sqlalchemy.select([groups.c.domain])))
+    new = [{'domain': row[0]} for row in found if row[0] not in registered]
+    if new:
+        conn.execute(domains.insert(), new)
+
+
+def m005_domain_ids(conn):
+    """
+    users and groups refer to their domain by domains.id instead of
+    repeating the name. domain_id takes the name's place in the primary
+    key and in the (domain, ...) keys from m001 and m003. sqlite can't
+    change a primary key or drop a column in place, its tables are
+    copied into new ones instead
+    """
+    # anything added since m004 that somehow missed the registry
+    m004_domain_registry(conn)
+    domains = reflect_table(conn, 'domains')
+    for table, name, number in (('users', 'username', 'uid'), ('groups', 'groupname', 'gid')):
+        t = reflect_table(conn, table)
+        if 'domain' in t.c:
+            if 'domain_id' not in t.c:
+                conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (quote(conn, table), quote(conn, 'domain_id'), domains.c.id.type.compile(dialect=conn.dialect)))
+                t = reflect_table(conn, table)
+            conn.execute(t.update().values(domain_id=sqlalchemy.select([domains.c.id]).\
+                where(domains.c.domain==t.c.domain).as_scalar()))
+            if conn.dialect.name == 'sqlite':
+                copy_without_domain(conn, table)
+            else:
+                drop_domain(conn, table)
+        create_index(conn, '%s_domain_%s' % (table, number), table, ['domain_id', number], unique=True)
+        create_index(conn, '%s_domain_%s' % (table, name), table, ['domain_id', name], unique=True)
+
+
+def drop_domain(conn, table):
+    """
+    [description]
+    swaps domain for domain_id in a table's primary key and drops the
+    domain column, along with every index that has it in. for mysql and
+    postgresql
+
+    [parameter info]
+    required:
+        conn: a connection to the vyvyan database
+        table: the table name
+
+    [return value]
+    no explicit return
+    """
+    insp = sqlalchemy.engine.reflection.Inspector.from_engine(conn)
+    t = reflect_table(conn, table)
+    for idx in insp.get_indexes(table):
+        if 'domain' in idx['column_names']:
+            sqlalchemy.Index(idx['name'], *[t.c[c] for c in idx['column_names']]).drop(bind=conn)
+    idtype = t.c.domain_id.type.compile(dialect=conn.dialect)
+    pk = insp.get_pk_constraint(table)
+    pkcols = [c == 'domain' and 'domain_id' or c for c in pk.get('constrained_columns', [])]
+    qtable = quote(conn, table)
+    qdomain_id = quote(conn, 'domain_id')
+    if conn.dialect.name == 'mysql':
+        conn.execute("ALTER TABLE %s MODIFY %s %s NOT NULL" % (qtable, qdomain_id, idtype))
+        conn.execute("ALTER TABLE %s DROP PRIMARY KEY" % qtable)
+    else:
+        conn.execute("ALTER TABLE %s ALTER COLUMN %s SET NOT NULL" % (qtable, qdomain_id))
+        conn.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (qtable, quote(conn, pk['name'])))
+    conn.execute("ALTER TABLE %s ADD PRIMARY KEY (%s)" % (qtable, ', '.join([quote(conn, c) for c in pkcols])))
+    conn.execute("ALTER TABLE %s DROP COLUMN %s" % (qtable, quote(conn, 'domain')))
+    conn.execute("ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (%s)" % (qtable,
+        quote(conn, '%s_domain_id_fkey' % table), qdomain_id, quote(conn, 'domains'), quote(conn, 'id')))
+
+
+def copy_without_domain(conn, table):
+    """
+    [description]
+    the sqlite version of drop_domain: builds a new table with domain_id
+    where domain was, copies the rows over and puts it in the old one's
+    place. indexes without domain in them are recreated, the ones with
+    domain are left to the caller
+
+    [parameter info]
+    required:
+        conn: a connection to the vyvyan database
+        table: the table name
+
+    [return value]
+    no explicit return
+    """
+    insp = sqlalchemy.engine.reflection.Inspector.from_engine(conn)
+    indexes = [idx for idx in insp.get_indexes(table) if 'domain' not in idx['column_names']]
+    meta = MetaData()
+    Table('domains', meta, autoload=True, autoload_with=conn)
+    old = Table(table, meta, autoload=True, autoload_with=conn)
+    pkcols = [c.name == 'domain' and 'domain_id' or c.name for c in old.primary_key.columns]
+    columns = []
+    for c in old.c:
+        if c.name == 'domain':
+            continue
+        if c.name == 'domain_id':
+            columns.append(Column('domain_id', c.type, ForeignKey('domains.id'), nullable=False, primary_key=('domain_id' in pkcols)))
+        else:
+            default = None
+            if c.server_default is not None:
+                default = c.server_default.arg
+            columns.append(Column(c.name, c.type, nullable=c.nullable, primary_key=(c.name in pkcols), server_default=default))
+    new = Table('%s_new' % table, meta, *columns)
+    new.create(bind=conn)
+    names = ', '.join([quote(conn, c.name) for c in new.c])
+    conn.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (quote(conn, new.name), names, names, quote(conn, table)))
+    conn.execute("DROP TABLE %s" % quote(conn, table))
+    conn.execute("ALTER TABLE %s RENAME TO %s" % (quote(conn, new.name), quote(conn, table)))
+    for idx in indexes:
+        create_index(conn, idx['name'], table, idx['column_names'], unique=idx['unique'])
+
+
+# every migration, in the order they're applied. never renumber or
+# remove one that has shipped, add new ones to the end
+migrations = [
+    (1, 'unique (domain, uid) and (domain, gid) keys', m001_unique_ids),
+    (2, 'indexes for active users, group membership and sudo commands', m002_lookup_indexes),
+    (3, 'indexes for paging and filtering user and group listings', m003_listing_indexes),
+    (4, 'domains registry table', m004_domain_registry),
+    (5, 'users and groups refer to domains by id', m005_domain_ids),
+]
+
+
+def applied_versions(engine):
+    """
+    [description]
+    finds out which migrations have been applied
+
+    [parameter info]
+    required:
+        engine: the sqlalchemy engine for the vyvyan database
+
+    [return value]
+    returns a set of version numbers
+    """
+    conn = engine.connect()
+    try:
+        if not engine.dialect.has_table(conn, 'schema_version'):
+            return set()
+        return set([row.version for row in conn.execute(sqlalchemy.select([schema_version.c.version]))])
+    finally:
+        conn.close()
+
+
+def pending(engine):
+    """
+    [description]
+    lists the migrations that haven't been applied yet
+
+    [parameter info]
+    required:
+        engine: the sqlalchemy engine for the vyvyan database
+
+    [return value]
+    returns a list of (version, description) tuples
+    """
+    applied = applied_versions(engine)
+    return [(version, description) for version, description, func in migrations if version not in applied]
+
+
+def migrate(engine, target=None, log=None):
+    """
+    [description]
+    applies pending migrations in order. each one runs in its own
+    transaction along with its schema_version row (mysql commits
+    DDL as it goes, which is why every migration checks before it
+    changes anything and can safely be run again)
+
+    [parameter info]
+    required:
+        engine: the sqlalchemy engine for the vyvyan database
+    optional:
+        target: stop after this version
+        log: a logger to report progress to
+
+    [return value]
+    returns a list of the versions applied
+    """
+    schema_version.create(bind=engine, checkfirst=True)
+    applied = applied_versions(engine)
+    done = []
+    for version, description, func in migrations:
+        if version in applied:
+            continue
+        if target is not None and version > target:
+            break
+        if log:
+            log.info("applying migration %s: %s" % (version, description))
+        conn = engine.connect()
+        trans = conn.begin()
+        try:
+            func(conn)
+            conn.execute(schema_version.insert(), version=version, description=description, applied=datetime.datetime.now())
+            trans.commit()
+        except Exception, e:
+            trans.rollback()
+            raise MigrationError("migration %s (%s) failed: %s" % (version, description, e))
+        finally:
+            conn.close()
+        done.append(version)
+    return done
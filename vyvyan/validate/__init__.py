@@ -27,6 +27,10 @@ import re
 # All of the models and sqlalchemy are brought in
 # to simplify referencing
 from vyvyan.vyvyan_models import *
+from sqlalchemy import and_, exists
+
+# how many ids go into a single IN (...) when checking a whole list
+IN_CHUNK_SIZE = 500
 
 class ValidationError(Exception):
     pass
@@ -139,23 +143,44 @@ def v_uid_in_db(cfg, uid, domain=None):
     """
     # make sure we're within operational parameters
     v_uid(cfg, uid)
-    uidlist = []
-    # go get our list
+    # let the db answer with a single indexed lookup
     if domain:
-        u = cfg.dbsess.query(Users).\
-            filter(Users.domain==domain).all()
+        q = exists().where(and_(Users.domain_id==Domains.id_of(domain), Users.uid==uid))
     else:
-        u = cfg.dbsess.query(Users).all()
-    # put em in a list
-    for userentry in u:
-        uidlist.append(userentry.uid)
-    # finally, check 'em
-    uid_set = set(uidlist)
-    if uid in uid_set:
+        q = exists().where(Users.uid==uid)
+    if cfg.dbsess.query(q).scalar():
         return True
     else:
         return False
 
+# Looks for many UIDs in the db, returns the ones that are present
+def v_uids_in_db(cfg, uids, domain=None):
+    """
+    [description]
+    looks for a whole list of UIDs in the db at once
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        uids: the UIDs we're trying to find
+    optional:
+        domain: the domain to look in
+
+    [return value]
+    a set of the UIDs that are already in the db
+    """
+    uids = list(set(uids))
+    # make sure we're within operational parameters
+    for uid in uids:
+        v_uid(cfg, uid)
+    found = set()
+    for i in range(0, len(uids), IN_CHUNK_SIZE):
+        q = cfg.dbsess.query(Users.uid).filter(Users.uid.in_(uids[i:i+IN_CHUNK_SIZE]))
+        if domain:
+            q = q.filter(Users.domain_id==Domains.id_of(domain))
+        found.update([row.uid for row in q])
+    return found
+
 # Looks for a GID in the db and returns true if present, false if absent
 def v_gid_in_db(cfg, gid, domain=None):
     """
@@ -174,23 +199,44 @@ def v_gid_in_db(cfg, gid, domain=None):
     """
     # make sure we're within operational parameters
     v_gid(cfg, gid)
-    gidlist = []
-    # go get our list
+    # let the db answer with a single indexed lookup
     if domain:
-        g = cfg.dbsess.query(Groups).\
-            filter(Groups.domain==domain).all()
+        q = exists().where(and_(Groups.domain_id==Domains.id_of(domain), Groups.gid==gid))
     else:
-        g = cfg.dbsess.query(Groups).all()
-    # put em in a list
-    for groupentry in g:
-        gidlist.append(groupentry.gid)
-    # finally, check 'em
-    gid_set = set(gidlist)
-    if gid in gid_set:
+        q = exists().where(Groups.gid==gid)
+    if cfg.dbsess.query(q).scalar():
         return True
     else:
         return False
 
+# Looks for many GIDs in the db, returns the ones that are present
+def v_gids_in_db(cfg, gids, domain=None):
+    """
+    [description]
+    looks for a whole list of GIDs in the db at once
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        gids: the GIDs we're looking for
+    optional:
+        domain: the domain to look in
+
+    [return value]
+    a set of the GIDs that are already in the db
+    """
+    gids = list(set(gids))
+    # make sure we're within operational parameters
+    for gid in gids:
+        v_gid(cfg, gid)
+    found = set()
+    for i in range(0, len(gids), IN_CHUNK_SIZE):
+        q = cfg.dbsess.query(Groups.gid).filter(Groups.gid.in_(gids[i:i+IN_CHUNK_SIZE]))
+        if domain:
+            q = q.filter(Groups.domain_id==Domains.id_of(domain))
+        found.update([row.gid for row in q])
+    return found
+
 # Validates UNIX gids
 def v_gid(cfg, gid):
     """
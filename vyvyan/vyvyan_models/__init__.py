@@ -15,13 +15,35 @@
 vyvyan's ORM
 """
 
-from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Boolean, Date
+from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Boolean, Date, select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relation, backref
 
 Base = declarative_base()
 
 
+class Domains(Base):
+    __tablename__ = 'domains'
+
+    domain = Column(String, unique=True)
+    id = Column(Integer, primary_key=True)
+
+    def to_dict(self):
+        return dict([(k, getattr(self, k)) for k in self.__dict__.keys() if k in self.__table__.columns])
+
+    def __init__(self, domain):
+        self.domain = domain
+
+    def __repr__(self):
+        return "<Domains('%s')>" % (self.domain)
+
+    # a domain's id by name, as a scalar subquery, so lookups by domain
+    # name can filter on users.domain_id/groups.domain_id in one statement
+    @classmethod
+    def id_of(cls, domain):
+        return select([cls.id]).where(cls.domain==domain).as_scalar()
+
+
 class Users(Base):
     __tablename__ = 'users'
 
@@ -30,7 +52,7 @@ class Users(Base):
     ssh_public_key = Column(String)
     password = Column(String)
     username = Column(String, primary_key=True)
-    domain = Column(String, primary_key=True)
+    domain_id = Column(Integer, ForeignKey(Domains.id), primary_key=True)
     uid = Column(Integer)
     id = Column(Integer, primary_key=True)
     type = Column(String)
@@ -45,7 +67,7 @@ class Users(Base):
         self.ssh_public_key = ssh_public_key
         self.password = password
         self.username = username
-        self.domain = domain
+        self.domain_obj = domain
         self.uid = uid
         self.type = type
         self.hdir = hdir
@@ -54,7 +76,14 @@ class Users(Base):
         self.active = active
 
     def to_dict(self):
-        return dict([(k, getattr(self, k)) for k in self.__dict__.keys() if not k.startswith("_")])
+        # domain_id is ours, callers get the domain name as they always have
+        d = dict([(k, getattr(self, k)) for k in self.__dict__.keys() if k in self.__table__.columns and k != 'domain_id'])
+        d['domain'] = self.domain
+        return d
+
+    @property
+    def domain(self):
+        return self.domain_obj.domain
 
     def __repr__(self):
         return "<Users('%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s')>" % (self.first_name, self.last_name, self.ssh_public_key, self.username, self.domain, self.uid, self.type, self.hdir, self.shell, self.email, self.active)
@@ -65,19 +94,26 @@ class Groups(Base):
 
     description = Column(String)
     groupname = Column(String, primary_key=True)
-    domain = Column(String, primary_key=True)
+    domain_id = Column(Integer, ForeignKey(Domains.id), primary_key=True)
     gid = Column(Integer)
     id = Column(Integer, primary_key=True)
 
     def to_dict(self):
-        return dict([(k, getattr(self, k)) for k in self.__dict__.keys() if not k.startswith("_")])
+        # domain_id is ours, callers get the domain name as they always have
+        d = dict([(k, getattr(self, k)) for k in self.__dict__.keys() if k in self.__table__.columns and k != 'domain_id'])
+        d['domain'] = self.domain
+        return d
 
     def __init__(self, description, groupname, domain, gid):
         self.description = description
         self.groupname = groupname
-        self.domain = domain
+        self.domain_obj = domain
         self.gid = gid
 
+    @property
+    def domain(self):
+        return self.domain_obj.domain
+
     def __repr__(self):
         return "<Groups('%s', '%s', '%s', '%s')>" % (self.description, self.groupname, self.domain, self.sudo_cmds)
 
@@ -90,7 +126,7 @@ class UserGroupMapping(Base):
     id = Column(Integer, primary_key=True)
 
     def to_dict(self):
-        return dict([(k, getattr(self, k)) for k in self.__dict__.keys() if not k.startswith("_")])
+        return dict([(k, getattr(self, k)) for k in self.__dict__.keys() if k in self.__table__.columns])
 
     def __init__(self, groups_id, users_id):
         self.groups_id = groups_id
@@ -107,7 +143,7 @@ class GroupSudocommandMapping(Base):
     id = Column(Integer, primary_key=True)
 
     def to_dict(self):
-        return dict([(k, getattr(self, k)) for k in self.__dict__.keys() if not k.startswith("_")])
+        return dict([(k, getattr(self, k)) for k in self.__dict__.keys() if k in self.__table__.columns])
 
     def __init__(self, groups_id, sudocommand):
         self.groups_id = groups_id
@@ -115,3 +151,97 @@ class GroupSudocommandMapping(Base):
 
     def __repr__(self):
         return "<UserGroupMapping('%s', '%s')>" % (self.groups_id, self.sudocommand)
+
+
+# relations are declared once all the classes exist. they're viewonly:
+# memberships and sudo commands are still written through the mapping
+# classes, these are only there so the reads can be loaded in one go
+# (joinedload/subqueryload) instead of one query per mapping row
+Users.groups = relation(Groups, secondary=UserGroupMapping.__table__,
+    primaryjoin=Users.id==UserGroupMapping.users_id,
+    secondaryjoin=Groups.id==UserGroupMapping.groups_id,
+    order_by=UserGroupMapping.id, viewonly=True)
+
+Groups.users = relation(Users, secondary=UserGroupMapping.__table__,
+    primaryjoin=Groups.id==UserGroupMapping.groups_id,
+    secondaryjoin=Users.id==UserGroupMapping.users_id,
+    order_by=UserGroupMapping.id, viewonly=True)
+
+Groups.sudo_commands = relation(GroupSudocommandMapping,
+    primaryjoin=Groups.id==GroupSudocommandMapping.groups_id,
+    order_by=GroupSudocommandMapping.id, viewonly=True)
+
+UserGroupMapping.user = relation(Users,
+    primaryjoin=UserGroupMapping.users_id==Users.id, viewonly=True)
+
+UserGroupMapping.group = relation(Groups,
+    primaryjoin=UserGroupMapping.groups_id==Groups.id, viewonly=True)
+
+GroupSudocommandMapping.group = relation(Groups,
+    primaryjoin=GroupSudocommandMapping.groups_id==Groups.id, viewonly=True)
+
+# users and groups keep their domain as a domain_id. the Domains row
+# comes along in the same SELECT, so .domain (the name) is always there
+# without another query. the constructors take the Domains object
+Users.domain_obj = relation(Domains, lazy='joined', innerjoin=True)
+
+Groups.domain_obj = relation(Domains, lazy='joined', innerjoin=True)
+
+
+class Projection(object):
+    """
+    a compact, read-only row holding a handful of columns. the read
+    paths select just these columns with a plain SELECT instead of
+    building ORM objects (identity map, change tracking, every column
+    of the table) for data that's only going to be encoded and sent.
+    subclasses list their columns in __slots__ and columns, same order,
+    and the tables to select them from in from_obj
+    """
+    __slots__ = ()
+    columns = ()
+    from_obj = None
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read-only" % self.__class__.__name__)
+
+    @classmethod
+    def select(cls):
+        return select(list(cls.columns), from_obj=cls.from_obj)
+
+    def to_dict(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+    def __repr__(self):
+        return "<%s(%s)>" % (self.__class__.__name__, ', '.join(["'%s'" % getattr(self, name) for name in self.__slots__]))
+
+
+# a user as listed, by list_users and in a group's member list
+class UserSummary(Projection):
+    __slots__ = ('domain', 'username', 'uid', 'active')
+    columns = (Domains.domain, Users.username, Users.uid, Users.active)
+    from_obj = [Users.__table__.join(Domains.__table__)]
+
+
+# a user as displayed. everything but the password hash
+class UserDetail(Projection):
+    __slots__ = ('first_name', 'last_name', 'ssh_public_key', 'username', 'domain', 'uid', 'id', 'type', 'hdir', 'shell', 'email', 'active')
+    columns = (Users.first_name, Users.last_name, Users.ssh_public_key, Users.username, Domains.domain, Users.uid, Users.id, Users.type, Users.hdir, Users.shell, Users.email, Users.active)
+    from_obj = [Users.__table__.join(Domains.__table__)]
+
+
+# a group as listed, by list_groups
+class GroupSummary(Projection):
+    __slots__ = ('domain', 'groupname', 'gid')
+    columns = (Domains.domain, Groups.groupname, Groups.gid)
+    from_obj = [Groups.__table__.join(Domains.__table__)]
+
+
+# a group as displayed, and in a user's group list
+class GroupDetail(Projection):
+    __slots__ = ('description', 'groupname', 'domain', 'gid', 'id')
+    columns = (Groups.description, Groups.groupname, Domains.domain, Groups.gid, Groups.id)
+    from_obj = [Groups.__table__.join(Domains.__table__)]
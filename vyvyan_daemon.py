@@ -3,7 +3,9 @@
 # system imports
 import os
 import sys
+import types
 import datetime
+import hashlib
 import bottle
 import traceback
 from bottle import static_file
@@ -13,6 +15,7 @@ from jinja2 import *
 
 # vyvyan imports
 from vyvyan import configure
+from vyvyan import migrations
 from vyvyan.common import *
 
 # for >=2.6 use json, >2.6 use simplejson
@@ -38,6 +41,13 @@ class VyvyanDaemonError(Exception):
     pass
 
 
+# every request gets its own database session, hand it back
+# to the pool once the request is finished
+@httpservice.hook('after_request')
+def __close_dbsess():
+    cfg.dbsess.remove()
+
+
 # create a json-able dict of important info
 def __generate_json_header():
     jbuf = {}
@@ -48,6 +58,28 @@ def __generate_json_header():
     return jbuf
 
 
+# send a response whose data is a generator of JSON fragments (see
+# VyvyanCommon.stream_listing). the envelope goes out first and the data
+# follows as the generator produces it. bottle has already run the
+# after_request hook by the time the body is read, so the generator
+# gets a fresh session and we hand that one back when it's done
+def __stream_response(jbuf):
+    chunks = jbuf.pop('data')
+    head = myjson.JSONEncoder().encode(jbuf)
+    try:
+        yield '%s, "data": ' % head[:-1]
+        for chunk in chunks:
+            yield chunk
+        yield '}'
+    except Exception, e:
+        # the status has already gone out, all we can do is stop short
+        # and leave the client with a body that won't parse
+        cfg.log.debug("error streaming %s: %s" % (jbuf['request'], e))
+        traceback.print_exc()
+    finally:
+        cfg.dbsess.remove()
+
+
 # authenticate incoming connections
 def __auth_conn(jbuf, authtype):
     try:
@@ -97,6 +129,9 @@ def load_modules(auth=True):
     old_metadata = cfg.module_metadata
     cfg.module_metadata = {}
     cfg.module_templates = {}
+    # start a new generation, which invalidates any cached metadata
+    cfg.module_generation += 1
+    cfg.metadata_cache = {}
     # base path we're being called from, to find our modules
     basepath = sys.path[0]
     try:
@@ -143,6 +178,8 @@ def load_modules(auth=True):
                         #cfg.log.debug("template file: %s" % tfile)
                         #cfg.log.debug("template: %s" % template)
                         cfg.log.debug("template load error: %s" % e)
+                    # templates ship to the CLI as part of the metadata
+                    inst.metadata['templates'] = cfg.module_templates[i]
                 except Exception, e:
                     cfg.log.debug("import error: %s" % e)
             else:
@@ -159,6 +196,69 @@ def load_modules(auth=True):
         return myjson.JSONEncoder().encode(jbuf)
 
 
+def __cached_metadata(jbuf, pname):
+    """
+    returns the ETag and encoded JSON response for a module's metadata.
+    metadata only changes when load_modules() runs, so the ETag and the
+    encoded metadata are built once per module generation and reused
+    until the next reload. the envelope around them (timestamp,
+    nodename) is fresh every time
+    """
+    cached = cfg.metadata_cache.get(pname)
+    if not cached or cached[0] != cfg.module_generation:
+        metadata = cfg.module_metadata[pname].metadata
+        # hash the content, not the envelope, so every worker hands out
+        # the same ETag for the same metadata
+        etag = 'W/"%s"' % hashlib.sha1(myjson.JSONEncoder(sort_keys=True).encode(metadata)).hexdigest()
+        cached = (cfg.module_generation, etag, myjson.JSONEncoder().encode(metadata))
+        cfg.metadata_cache[pname] = cached
+    # splice the cached data into this request's envelope, the same
+    # way __stream_response does
+    head = myjson.JSONEncoder().encode(jbuf)
+    return cached[1], '%s, "data": %s}' % (head[:-1], cached[2])
+
+
+def __etag_matches(etag, if_none_match):
+    """
+    weak comparison of an ETag against an If-None-Match header
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        if tag.strip().replace('W/', '', 1) == etag.replace('W/', '', 1):
+            return True
+    return False
+
+
+def __lookup_call(pname, callpath):
+    """
+    returns the module instance and the metadata for one of its calls
+    """
+    if pname not in cfg.module_metadata:
+        raise VyvyanDaemonError("no such module: %s" % pname)
+    pnameMetadata = cfg.module_metadata[pname]
+    if callpath not in pnameMetadata.metadata['methods']:
+        raise VyvyanDaemonError("no such call: /%s/%s" % (pname, callpath))
+    return pnameMetadata, pnameMetadata.metadata['methods'][callpath]
+
+
+def __check_args(pname, callpath, pnameCallpath, query, filenames):
+    """
+    makes sure every required argument in the call's metadata was
+    supplied, either in the query or as an uploaded file
+    """
+    if 'args' in pnameCallpath['required_args']:
+        for k, arg in pnameCallpath['required_args']['args'].items():
+            if arg['vartype'] == 'file':
+                supplied = k in filenames
+            else:
+                supplied = k in query.keys() and query[k]
+            if not supplied:
+                raise VyvyanDaemonError("missing required argument \"%s\" for call \"/%s/%s\"" % (k, pname, callpath))
+
+
 @httpservice.route('/')
 def index():
     """
@@ -286,8 +386,6 @@ def callable_path(pname, callpath):
         files = []
         for kkkk in filesdata.keys():
             files.append(filesdata[kkkk].file)
-        pnameMetadata = cfg.module_metadata[pname]
-        pnameMetadata.metadata['templates'] = cfg.module_templates[pname]
 
         # every API module has a 'metadata' construct
         # hard wire it into callpath options
@@ -295,10 +393,15 @@ def callable_path(pname, callpath):
         if callpath == 'metadata':
             # uncomment for debugging
             #cfg.log.debug(myjson.JSONEncoder(indent=4).encode(pnameMetadata.metadata))
-            jbuf['data'] = pnameMetadata.metadata
-            return myjson.JSONEncoder().encode(jbuf)
+            etag, body = __cached_metadata(jbuf, pname)
+            response.set_header('ETag', etag)
+            # the client already has this generation's metadata
+            if __etag_matches(etag, bottle.request.headers.get('If-None-Match')):
+                response.status = 304
+                return ""
+            return body
         else:
-            pnameCallpath = pnameMetadata.metadata['methods'][callpath]
+            pnameMetadata, pnameCallpath = __lookup_call(pname, callpath)
 
         # we got an actual callpath! do stuff.
         # uncomment for debugging
@@ -311,6 +414,7 @@ def callable_path(pname, callpath):
                 if not reauthed:
                     response.content_type='text/html'
                     raise bottle.HTTPError(401, '/'+pname+'/'+callpath)
+            __check_args(pname, callpath, pnameCallpath, query, filesdata.keys())
 
             # fetch the method we were asked to call and instantiate it in "buf"
             # this is the magic bit of anonymous function calls that allows
@@ -327,6 +431,10 @@ def callable_path(pname, callpath):
             # uncomment for debugging
             #cfg.log.debug(myjson.JSONEncoder(indent=4).encode(jbuf))
 
+            # streamed listings are written out as they're read
+            if isinstance(jbuf['data'], types.GeneratorType):
+                return __stream_response(jbuf)
+
             # return our buffer
             return myjson.JSONEncoder().encode(jbuf)
 
@@ -345,6 +453,120 @@ def callable_path(pname, callpath):
         return myjson.JSONEncoder().encode(jbuf)
 
 
+@httpservice.route('/batch', method='POST')
+def batch():
+    """
+    runs a list of calls in order, in a single database transaction,
+    and returns the result of each. the body is a JSON list of
+    {"module": ..., "call": ..., "args": {...}} or an object:
+
+        {"calls": [...], "continue_on_error": false}
+
+    by default the batch is all-or-nothing: the first failure rolls
+    everything back. with continue_on_error each call runs in its own
+    savepoint, failed calls are rolled back and the rest are committed.
+    file uploads aren't supported in a batch
+    """
+    response.content_type='application/json'
+    jbuf = __generate_json_header()
+    jbuf['request'] = "/batch"
+    # authenticate the incoming request, admin calls are checked below
+    authed, jbuf = __auth_conn(jbuf, 'info')
+    if not authed:
+        response.content_type='text/html'
+        raise bottle.HTTPError(401, '/batch')
+
+    sess = None
+    try:
+        body = bottle.request.json
+        if body is None:
+            body = myjson.loads(bottle.request.body.read())
+        continue_on_error = False
+        if isinstance(body, dict):
+            calls = body.get('calls')
+            continue_on_error = bool(body.get('continue_on_error'))
+        else:
+            calls = body
+        if not isinstance(calls, list) or not calls:
+            raise VyvyanDaemonError("batch must be a non-empty list of calls")
+
+        # look everything up and check auth and arguments before
+        # running anything
+        admin = False
+        work = []
+        for i, item in enumerate(calls):
+            if not isinstance(item, dict) or not item.get('module') or not item.get('call'):
+                raise VyvyanDaemonError("batch item %s: must be an object with a module and a call" % i)
+            pname = item['module']
+            callpath = item['call']
+            pnameMetadata, pnameCallpath = __lookup_call(pname, callpath)
+            query = {}
+            for k, v in (item.get('args') or {}).items():
+                # arguments arrive from the CLI as native strings, keep it
+                # that way. the API leans on str methods, eg. str.upper
+                if v is None or v is False:
+                    continue
+                if isinstance(v, unicode):
+                    query[k] = v.encode('utf-8')
+                else:
+                    query[k] = str(v)
+            __check_args(pname, callpath, pnameCallpath, query, [])
+            if pnameCallpath['admin_only']:
+                admin = True
+            work.append((pname, callpath, getattr(pnameMetadata, callpath), query))
+        if admin:
+            reauthed, jbuf = __auth_conn(jbuf, 'admin')
+            if not reauthed:
+                response.content_type='text/html'
+                raise bottle.HTTPError(401, '/batch')
+
+        # API methods commit on their own, in batch mode that just
+        # flushes and we commit once at the end
+        sess = cfg.dbsess()
+        sess.batch = True
+        results = []
+        failed = 0
+        for i, (pname, callpath, buf, query) in enumerate(work):
+            result = {'module': pname, 'call': callpath, 'status': 0, 'data': "", 'msg': ""}
+            if continue_on_error:
+                savepoint = sess.begin_nested()
+            try:
+                result['data'] = buf(query)
+                # a batch goes out in one piece, so a streamed result is
+                # read in full here
+                if isinstance(result['data'], types.GeneratorType):
+                    result['data'] = myjson.loads(''.join(result['data']))
+                if continue_on_error:
+                    savepoint.commit()
+            except Exception, e:
+                if not continue_on_error:
+                    raise VyvyanDaemonError("batch item %s (/%s/%s) failed, nothing was committed. Error: %s" % (i, pname, callpath, e))
+                savepoint.rollback()
+                cfg.log.debug("batch item %s (/%s/%s) failed: %s" % (i, pname, callpath, e))
+                failed += 1
+                result['status'] = 1
+                result['msg'] = "%s" % e
+            results.append(result)
+        sess.batch = False
+        sess.commit()
+        cfg.log.debug("batch of %s calls committed, %s failed" % (len(work), failed))
+        jbuf['data'] = results
+        return myjson.JSONEncoder().encode(jbuf)
+
+    # catch and re-raise HTTP auth errors
+    except bottle.HTTPError:
+        raise bottle.HTTPError(401, '/batch')
+    except Exception, e:
+        if sess:
+            sess.batch = False
+            sess.rollback()
+        jbuf['status'] = 1
+        jbuf['data'] = ""
+        jbuf['msg'] = "Exception in batch(). Error: %s" % e
+        traceback.print_exc()
+        return myjson.JSONEncoder().encode(jbuf)
+
+
 @httpservice.route('/favicon.ico')
 def get_favicon():
     """
@@ -368,7 +590,31 @@ if __name__ == '__main__':
     except Exception, e:
         raise VyvyanDaemonError(e)
     cfg.log.debug("initializing logger in vyvyan_daemon.py")
-    # run our module loader once at startup
+    # let whoever is starting us know if the schema is behind
+    try:
+        todo = migrations.pending(cfg.dbengine)
+        if todo:
+            cfg.log.warn("database schema is out of date, run vyvyan_migrate.py. pending migrations: %s" % ', '.join(["%s (%s)" % (version, description) for version, description in todo]))
+            print "WARNING: %s pending database migration(s), run vyvyan_migrate.py" % len(todo)
+    except Exception, e:
+        cfg.log.warn("unable to check for pending database migrations: %s" % e)
+    # run our module loader once at startup. in prefork mode this
+    # happens in the master so every worker starts with modules loaded
     load_modules(auth=False)
     # the daemon
-    bottle.run(httpservice, host='0.0.0.0', port=8081, reloader=False)
+    if cfg.server_workers > 1 or cfg.server_threads > 1:
+        # don't let the workers inherit the master's db sockets,
+        # each worker thread opens its own connection on first use
+        cfg.close_connections()
+        cfg.log.debug("starting %s workers with %s threads each on %s:%s" % (cfg.server_workers, cfg.server_threads, cfg.server_host, cfg.server_port))
+        if cfg.server_threads > 1:
+            worker_class = 'gthread'
+        else:
+            worker_class = 'sync'
+        bottle.run(httpservice, server='gunicorn', host=cfg.server_host, port=cfg.server_port,
+                   workers=cfg.server_workers, threads=cfg.server_threads, worker_class=worker_class,
+                   backlog=cfg.server_backlog, max_requests=cfg.server_max_requests,
+                   max_requests_jitter=cfg.server_max_requests_jitter, timeout=cfg.server_timeout,
+                   reuse_port=cfg.server_reuse_port, preload_app=True, reloader=False)
+    else:
+        bottle.run(httpservice, host=cfg.server_host, port=cfg.server_port, reloader=False)
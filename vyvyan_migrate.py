@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+# Copyright 2015 WebEffects Network, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# brings the vyvyan database schema up to date. reads the db section
+# of vyvyan_daemon.yaml, same as the daemon
+
+# system imports
+import sys
+from optparse import OptionParser
+
+# vyvyan imports
+from vyvyan import configure
+from vyvyan import migrations
+from vyvyan.common import *
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="Usage: vyvyan_migrate.py [options]\n\napplies any pending schema migrations to the vyvyan database")
+    parser.add_option('-s', '--status', action="store_true", help="list applied and pending migrations, change nothing")
+    parser.add_option('-t', '--to', type="int", help="only migrate up to this version")
+    (options, args) = parser.parse_args()
+
+    cfg = configure.VyvyanConfigureDaemon('vyvyan_daemon.yaml')
+    cfg.load_config()
+    cfg.log = VyvyanLogger(cfg)
+
+    try:
+        if options.status:
+            applied = migrations.applied_versions(cfg.dbengine)
+            for version, description, func in migrations.migrations:
+                if version in applied:
+                    state = "applied"
+                else:
+                    state = "pending"
+                print "%3s  %-8s %s" % (version, state, description)
+            sys.exit(0)
+
+        todo = migrations.pending(cfg.dbengine)
+        if not todo:
+            print "database schema is up to date"
+            sys.exit(0)
+        done = migrations.migrate(cfg.dbengine, target=options.to, log=cfg.log)
+        for version, description, func in migrations.migrations:
+            if version in done:
+                print "applied migration %s: %s" % (version, description)
+    except migrations.MigrationError, e:
+        print "Error: %s" % e
+        cfg.log.debug("vyvyan_migrate.py: %s" % e)
+        sys.exit(1)
@@ -12,6 +12,21 @@
 /*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;
 /*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;
 
+--
+-- Table structure for table `domains`
+--
+
+DROP TABLE IF EXISTS `domains`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `domains` (
+  `id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  `domain` varchar(100) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `domain` (`domain`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `groups`
 --
@@ -23,11 +38,14 @@ CREATE TABLE `groups` (
   `description` varchar(150) DEFAULT NULL,
   `sudo_cmds` varchar(2000) DEFAULT NULL,
   `groupname` varchar(64) NOT NULL,
-  `domain` varchar(100) NOT NULL,
+  `domain_id` bigint(20) unsigned NOT NULL,
   `gid` int(11) NOT NULL,
   `id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
-  PRIMARY KEY (`groupname`,`domain`),
-  UNIQUE KEY `id` (`id`)
+  PRIMARY KEY (`groupname`,`domain_id`),
+  UNIQUE KEY `id` (`id`),
+  UNIQUE KEY `groups_domain_gid` (`domain_id`,`gid`),
+  UNIQUE KEY `groups_domain_groupname` (`domain_id`,`groupname`),
+  CONSTRAINT `groups_domain_id_fkey` FOREIGN KEY (`domain_id`) REFERENCES `domains` (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -44,7 +62,8 @@ CREATE TABLE `group_sudocommand_mapping` (
   `sudocommand` varchar(100) NOT NULL,
   PRIMARY KEY (`id`),
   UNIQUE KEY `id` (`id`),
-  KEY `group_supdocommand_mapping_groups_id_fkey` (`groups_id`)
+  KEY `group_supdocommand_mapping_groups_id_fkey` (`groups_id`),
+  KEY `group_sudocommand_mapping_groups_sudo` (`groups_id`,`sudocommand`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -63,7 +82,8 @@ CREATE TABLE `user_group_mapping` (
   PRIMARY KEY (`id`),
   UNIQUE KEY `id` (`id`),
   KEY `user_group_mapping_groups_id_fkey` (`groups_id`),
-  KEY `user_group_mapping_users_id_fkey` (`users_id`)
+  KEY `user_group_mapping_users_id_fkey` (`users_id`),
+  UNIQUE KEY `user_group_mapping_users_groups` (`users_id`,`groups_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -80,7 +100,7 @@ CREATE TABLE `users` (
   `ssh_public_key` varchar(1500) DEFAULT NULL,
   `password` varchar(1500) DEFAULT NULL,
   `username` varchar(64) NOT NULL,
-  `domain` varchar(100) NOT NULL,
+  `domain_id` bigint(20) unsigned NOT NULL,
   `uid` int(11) NOT NULL,
   `id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
   `type` varchar(15) DEFAULT NULL,
@@ -89,6 +109,12 @@ CREATE TABLE `users` (
   `active` tinyint(1) DEFAULT '1',
   `email` varchar(100) DEFAULT NULL,
   UNIQUE KEY `id` (`id`),
-  PRIMARY KEY (`username`,`domain`)
+  PRIMARY KEY (`username`,`domain_id`),
+  UNIQUE KEY `users_domain_uid` (`domain_id`,`uid`),
+  KEY `users_active` (`active`),
+  UNIQUE KEY `users_domain_username` (`domain_id`,`username`),
+  KEY `users_type` (`type`),
+  KEY `users_shell` (`shell`),
+  CONSTRAINT `users_domain_id_fkey` FOREIGN KEY (`domain_id`) REFERENCES `domains` (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;